@@ -0,0 +1,126 @@
+import asyncio
+import concurrent.futures
+import io
+import os
+import sys
+import server
+
+# --- ASGI Entry Point ---
+# uvicorn asgi:app --workers 4 (uvicorn is not a dependency of the API: pip install uvicorn)
+# The Flask app is WSGI: every request runs on a bounded pool of FIRES_ASGI_THREADS threads (by
+# default as many as the engine has connections, so none waits for one), while the event loop
+# only moves bytes. Idle keep-alive connections and slow clients then cost no thread. Streamed
+# responses (/api/fires/stream) are read on a separate pool sized for FIRES_STREAM_MAX_CLIENTS, so
+# connected stream clients never hold the threads of the other requests.
+
+ASGI_THREADS = int(os.environ.get('FIRES_ASGI_THREADS', server.DB_POOL_SIZE + server.DB_MAX_OVERFLOW))
+
+def build_environ(scope, body):
+    """The WSGI environ of an ASGI HTTP request."""
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope.get('headers', []):
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{name}'
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    return environ
+
+class WsgiToAsgi:
+    """Serves a WSGI app over ASGI, running it on a pool of `max_threads` threads."""
+
+    def __init__(self, wsgi_app, max_threads, max_streams):
+        self.wsgi_app = wsgi_app
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_threads, thread_name_prefix='asgi-request')
+        self.stream_executor = concurrent.futures.ThreadPoolExecutor(max_streams, thread_name_prefix='asgi-stream')
+
+    def _call_wsgi(self, environ):
+        """Runs the app. Returns (status, headers, body), body being an iterator for streamed responses."""
+        response = {}
+        def start_response(status, headers, exc_info=None):
+            response['status'], response['headers'] = int(status.split(' ', 1)[0]), headers
+        iterable = self.wsgi_app(environ, start_response)
+        headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in response['headers']]
+        if any(name == b'content-length' for name, _ in headers):
+            # A complete body (every response but the streamed ones): read it on this thread
+            try:
+                return response['status'], headers, b''.join(iterable)
+            finally:
+                if hasattr(iterable, 'close'):
+                    iterable.close()
+        return response['status'], headers, iterable
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        if scope['type'] != 'http':
+            return
+
+        body = b''
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        loop = asyncio.get_running_loop()
+        status, headers, response_body = await loop.run_in_executor(self.executor, self._call_wsgi, build_environ(scope, body))
+        await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+        if isinstance(response_body, bytes):
+            await send({'type': 'http.response.body', 'body': response_body})
+            return
+        await self._stream(loop, receive, send, response_body)
+
+    async def _stream(self, loop, receive, send, iterable):
+        iterator = iter(iterable)
+        disconnected = asyncio.ensure_future(self._wait_for_disconnect(receive))
+        try:
+            while True:
+                chunk = loop.run_in_executor(self.stream_executor, next, iterator, None)
+                done, _ = await asyncio.wait({chunk, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+                if disconnected in done:
+                    # The chunk being read is dropped when it comes (e.g. the next stream heartbeat)
+                    chunk.add_done_callback(lambda _: self._close(iterable))
+                    return
+                data = chunk.result()
+                if data is None:
+                    break
+                await send({'type': 'http.response.body', 'body': data, 'more_body': True})
+            await send({'type': 'http.response.body', 'body': b''})
+            self._close(iterable)
+        finally:
+            disconnected.cancel()
+
+    async def _wait_for_disconnect(self, receive):
+        while (await receive())['type'] != 'http.disconnect':
+            pass
+
+    def _close(self, iterable):
+        if hasattr(iterable, 'close'):
+            # Runs the generator's cleanup (e.g. the stream's client count) off the event loop
+            self.stream_executor.submit(iterable.close)
+
+app = WsgiToAsgi(server.app, ASGI_THREADS, server.STREAM_MAX_CLIENTS + 4)
@@ -1,8 +1,21 @@
 import git
-import json
 import sqlite3
 import os
+import argparse
+import multiprocessing
 from datetime import datetime, timezone
+from git_blobs import list_commits, iter_file_blobs
+from snapshot_cache import SnapshotCache
+from snapshot_parsers import make_snapshot_parser, SNAPSHOT_PARSERS
+from fire_state import create_fire_state_table, fire_fingerprint, FireStateStore, DEFAULT_EVICTION_HORIZON
+from raw_payloads import store_raw_payload
+from fire_history import create_fire_history_table, backfill_fire_deltas, FireHistoryEncoder
+from daily_stats import create_daily_stats_table, rebuild_daily_stats
+from fire_search import create_fire_search_table, rebuild_fire_search
+from fire_geo import create_fire_geo_table, rebuild_fire_geo
+from fire_intervals import create_fire_intervals_table, rebuild_fire_intervals
+from resource_series import create_resource_rollup_table, rebuild_resource_rollup
+from bd_manager import apply_migrations, get_data_version, increment_data_version, update_last_processed_commit_hash
 
 # --- Database Setup ---
 DB_NAME = "fires.sqlite"
@@ -47,10 +60,37 @@ def init_db():
         meios_aquaticos INTEGER,
         active_in_commit BOOLEAN,          -- 'active' flag from the JSON in this commit
         change_type TEXT,                  -- 'NEW', 'UPDATED', 'DISAPPEARED'
-        raw_data TEXT,                     -- Full JSON data for this fire in this commit
+        raw_data TEXT,                     -- Full JSON data (older databases; now in raw_payloads, see raw_payloads.py)
         FOREIGN KEY (fire_id) REFERENCES fires(fire_id)
     )
     ''')
+
+    # Script metadata (last processed commit), shared with the incremental bd_manager.py
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS script_metadata (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    ''')
+
+    # Checkpoint of the last known JSON per fire, so bd_manager.py can continue from this rebuild
+    create_fire_state_table(cursor)
+    # Per day and district aggregates served by the API, computed once the rebuild is done
+    create_daily_stats_table(cursor)
+    # Full-text index of the place names, for the API search, also built at the end
+    create_fire_search_table(cursor)
+    # R*Tree of the fire positions, for the map queries, also built at the end
+    create_fire_geo_table(cursor)
+    # Activity intervals of the fires, for the time travel API, also built at the end
+    create_fire_intervals_table(cursor)
+    # Resources deployed over time, also built at the end
+    create_resource_rollup_table(cursor)
+    create_fire_history_table(cursor)
+    conn.commit()
+
+    # Indexes and generated columns, shared with bd_manager.py
+    apply_migrations(conn)
+    backfill_fire_deltas(conn) # Only does something for a database written before delta encoding
     conn.commit()
     return conn
 
@@ -75,69 +115,106 @@ def get_file_content_at_commit(repo, commit_hexsha, file_path_in_repo):
         # print(f"Debug: Could not read file {file_path_in_repo} at commit {commit_hexsha[:7]}: {e}")
         return None
 
-def parse_fire_data(json_content):
-    """
-    Parses JSON content into a dictionary of fire data, keyed by fire ID.
-    Returns an empty dictionary if parsing fails or structure is unexpected.
-    """
-    if not json_content:
-        return {}
-    try:
-        data = json.loads(json_content)
-        if data.get("success") and isinstance(data.get("data"), list):
-            # Ensure items in data['data'] are dictionaries and have an 'id'
-            fires_map = {
-                item['id']: item for item in data['data']
-                if isinstance(item, dict) and 'id' in item
-            }
-            return fires_map
-        else:
-            # print(f"Warning: JSON structure not as expected (missing 'success' or 'data' list).")
-            return {}
-    except json.JSONDecodeError as e:
-        # print(f"Warning: JSON decoding error: {e} for content: {json_content[:100]}")
-        return {}
-    except TypeError as e:
-        # print(f"Warning: TypeError during JSON processing (e.g. item not a dict): {e}")
-        return {}
-
+# --- Fire Event Writers ---
+# Shared by the serial and the parallel rebuild, so both write exactly the same rows.
 
-def compare_fire_data_are_different(old_data, new_data):
-    """
-    Compares two fire data dictionaries for meaningful differences.
-    Returns True if relevant fields are different, False otherwise.
-    """
-    if not old_data or not new_data: # Should only happen if old_data is for a new fire
-        return True 
-
-    # Fields that define an update if they change.
-    # 'active' is crucial. 'updated.sec' changing also signifies an update from source.
-    relevant_fields = [
-        'lat', 'lng', 'location', 'man', 'terrain', 'aerial', 'meios_aquaticos',
-        'status', 'statusCode', 'natureza', 'active', 'localidade', 'important',
-        'district', 'concelho', 'freguesia', 'naturezaCode', 'statusColor',
-        # Add other fields from your JSON that you consider important for tracking changes.
-    ]
-    for field in relevant_fields:
-        if old_data.get(field) != new_data.get(field):
-            return True
-
-    # Specifically check the 'updated' timestamp if it exists
-    if old_data.get('updated', {}).get('sec') != new_data.get('updated', {}).get('sec'):
-        return True
-        
-    # If 'updated' is not present, but 'dateTime' is, and it changed (though less likely for existing fire)
-    if 'updated' not in old_data and 'updated' not in new_data:
-        if old_data.get('dateTime', {}).get('sec') != new_data.get('dateTime', {}).get('sec'):
-            return True
-            
-    return False
+def insert_update_log_entry(cursor, history, entry, fire_data):
+    """Inserts a fire_updates row logging `fire_data`, delta-encoded by `history` (see fire_history.py)."""
+    is_keyframe, deltas = history.encode(cursor, entry['fire_id'], fire_data, entry['change_type'])
+    entry['raw_payload_id'] = store_raw_payload(cursor, fire_data) if is_keyframe else None
+    cursor.execute('''
+        INSERT INTO fire_updates (fire_id, commit_hash, commit_timestamp, data_timestamp, status, status_code,
+                                man, terrain, aerial, meios_aquaticos, active_in_commit, change_type, raw_payload_id)
+        VALUES (:fire_id, :commit_hash, :commit_timestamp, :data_timestamp, :status, :status_code,
+                :man, :terrain, :aerial, :meios_aquaticos, :active_in_commit, :change_type, :raw_payload_id)
+    ''', entry)
+    update_id = cursor.lastrowid
+    cursor.executemany("INSERT INTO fire_update_deltas VALUES (?, ?, ?, ?, ?)",
+                       [(entry['fire_id'], field, update_id, old_value, new_value) for field, old_value, new_value in deltas])
+
+def log_fire_update(cursor, history, fire_id, fire_data, commit_hash, commit_timestamp, change_type):
+    """Inserts a NEW or UPDATED entry for a fire present in the commit's JSON into fire_updates."""
+    update_log_entry = {
+        'fire_id': fire_id,
+        'commit_hash': commit_hash,
+        'commit_timestamp': commit_timestamp,
+        'data_timestamp': fire_data.get('updated', {}).get('sec') or \
+                          fire_data.get('dateTime', {}).get('sec'),
+        'status': fire_data.get('status'),
+        'status_code': fire_data.get('statusCode'),
+        'man': fire_data.get('man'),
+        'terrain': fire_data.get('terrain'),
+        'aerial': fire_data.get('aerial'),
+        'meios_aquaticos': fire_data.get('meios_aquaticos'),
+        'active_in_commit': fire_data.get('active', False),
+        'change_type': change_type,
+    }
+    insert_update_log_entry(cursor, history, update_log_entry, fire_data)
+
+def insert_new_fire(cursor, history, fire_id, fire_data, commit_hash, commit_timestamp):
+    """Records a fire never seen before: a row in fires and a NEW entry in fire_updates."""
+    cursor.execute('''
+        INSERT INTO fires (fire_id, lat, lng, location, district, concelho, freguesia, natureza,
+                         first_seen_commit_hash, first_seen_data_timestamp,
+                         last_updated_commit_hash, last_updated_data_timestamp, is_currently_active)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (fire_id, fire_data.get('lat'), fire_data.get('lng'),
+          fire_data.get('location'), fire_data.get('district'),
+          fire_data.get('concelho'), fire_data.get('freguesia'),
+          fire_data.get('natureza'), commit_hash,
+          fire_data.get('dateTime', {}).get('sec'), # first_seen_data_timestamp
+          commit_hash, fire_data.get('updated', {}).get('sec'), # last_updated
+          fire_data.get('active', False)))
+    log_fire_update(cursor, history, fire_id, fire_data, commit_hash, commit_timestamp, 'NEW')
+
+def update_existing_fire(cursor, history, fire_id, fire_data, commit_hash, commit_timestamp):
+    """Records a change to a known fire: updates its row in fires and logs an UPDATED entry."""
+    cursor.execute('''
+        UPDATE fires
+        SET lat = ?, lng = ?, location = ?, district = ?, concelho = ?, freguesia = ?, natureza = ?,
+            last_updated_commit_hash = ?, last_updated_data_timestamp = ?, is_currently_active = ?
+        WHERE fire_id = ?
+    ''', (fire_data.get('lat'), fire_data.get('lng'),
+          fire_data.get('location'), fire_data.get('district'),
+          fire_data.get('concelho'), fire_data.get('freguesia'),
+          fire_data.get('natureza'), commit_hash,
+          fire_data.get('updated', {}).get('sec'),
+          fire_data.get('active', False), fire_id))
+    log_fire_update(cursor, history, fire_id, fire_data, commit_hash, commit_timestamp, 'UPDATED')
+
+def mark_fire_disappeared(cursor, history, fire_id, last_data, commit_hash, commit_timestamp):
+    """Records an active fire missing from the commit's JSON: marks it inactive and logs a DISAPPEARED entry."""
+    cursor.execute('''
+        UPDATE fires
+        SET is_currently_active = ?, last_updated_commit_hash = ?
+        WHERE fire_id = ?
+    ''', (False, commit_hash, fire_id)) # Mark inactive, update commit hash of this observation
+
+    # Log this disappearance event in fire_updates
+    disappeared_log_entry = {
+        'fire_id': fire_id,
+        'commit_hash': commit_hash,
+        'commit_timestamp': commit_timestamp,
+        'data_timestamp': commit_timestamp, # Use commit time as no specific fire data point
+        'status': "Disappeared from source",
+        'status_code': None, # Or a custom code for disappearance
+        'man': last_data.get('man'), # Log last known values
+        'terrain': last_data.get('terrain'),
+        'aerial': last_data.get('aerial'),
+        'meios_aquaticos': last_data.get('meios_aquaticos'),
+        'active_in_commit': False, # Not active as it's not in the commit's data
+        'change_type': 'DISAPPEARED',
+    }
+    insert_update_log_entry(cursor, history, disappeared_log_entry, last_data) # Log the last known state
 
 # --- Main Logic ---
-def process_repository(repo_path, json_file_path_in_repo):
+def process_repository(repo_path, json_file_path_in_repo, workers=1, json_parser=None,
+                       eviction_horizon=DEFAULT_EVICTION_HORIZON):
     """
     Main function to process the Git repository, analyze fire data from JSON files in commits,
     and store the history in an SQLite database.
+    With workers > 1 the history is diffed by a process pool (see `process_commits_in_parallel`).
+    Fires inactive for longer than `eviction_horizon` seconds are not kept in memory (None keeps them all).
     """
     conn = init_db()
     cursor = conn.cursor()
@@ -152,7 +229,7 @@ def process_repository(repo_path, json_file_path_in_repo):
         return
 
     # Get commits in chronological order (oldest to newest)
-    commits = list(repo.iter_commits(reverse=True))
+    commits = list_commits(repo)
     if not commits:
         print("No commits found in the repository.")
         conn.close()
@@ -160,161 +237,266 @@ def process_repository(repo_path, json_file_path_in_repo):
 
     print(f"Processing {len(commits)} commits...")
 
-    # In-memory state tracker for the last known data of each fire_id.
-    # Key: fire_id, Value: dict of the fire data from JSON
-    last_known_fire_states = {}
-
-    for i, commit in enumerate(commits):
-        commit_hash = commit.hexsha
-        # Ensure commit.committed_datetime is offset-aware before calling timestamp()
-        commit_dt_aware = commit.committed_datetime
-        if commit_dt_aware.tzinfo is None or commit_dt_aware.tzinfo.utcoffset(commit_dt_aware) is None:
-            commit_dt_aware = commit_dt_aware.replace(tzinfo=timezone.utc) # Assume UTC if naive
-        commit_timestamp = int(commit_dt_aware.timestamp())
-
-        # print(f"\nProcessing commit {i+1}/{len(commits)}: {commit_hash[:7]} ({commit.committed_datetime})")
-
-        json_content = get_file_content_at_commit(repo, commit_hash, json_file_path_in_repo)
-        current_commit_fires_map = parse_fire_data(json_content)
-
-        if not json_content and not current_commit_fires_map :
-            # print(f"  No valid fire data file '{json_file_path_in_repo}' in commit {commit_hash[:7]}.")
-            # Disappearance logic below will handle fires that were active and are now gone.
-            pass
-
-        processed_fire_ids_in_this_commit = set()
+    if workers > 1:
+        process_commits_in_parallel(conn, repo_path, commits, json_file_path_in_repo, workers, json_parser, eviction_horizon)
+        conn.close()
+        print(f"Processing complete. Database saved to '{DB_NAME}'.")
+        return
 
-        # 1. Process fires present in the current commit's JSON
-        for fire_id, current_fire_data in current_commit_fires_map.items():
-            processed_fire_ids_in_this_commit.add(fire_id)
-            previous_fire_data_state = last_known_fire_states.get(fire_id)
-
-            # Prepare data for the fire_updates table
-            update_log_entry = {
-                'fire_id': fire_id,
-                'commit_hash': commit_hash,
-                'commit_timestamp': commit_timestamp,
-                'data_timestamp': current_fire_data.get('updated', {}).get('sec') or \
-                                  current_fire_data.get('dateTime', {}).get('sec'),
-                'status': current_fire_data.get('status'),
-                'status_code': current_fire_data.get('statusCode'),
-                'man': current_fire_data.get('man'),
-                'terrain': current_fire_data.get('terrain'),
-                'aerial': current_fire_data.get('aerial'),
-                'meios_aquaticos': current_fire_data.get('meios_aquaticos'),
-                'active_in_commit': current_fire_data.get('active', False),
-                'raw_data': json.dumps(current_fire_data)
-            }
-
-            if not previous_fire_data_state:
-                # This is a new fire never seen before by the script
-                # print(f"  NEW fire: {fire_id}")
-                cursor.execute('''
-                    INSERT INTO fires (fire_id, lat, lng, location, district, concelho, freguesia, natureza,
-                                     first_seen_commit_hash, first_seen_data_timestamp,
-                                     last_updated_commit_hash, last_updated_data_timestamp, is_currently_active)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (fire_id, current_fire_data.get('lat'), current_fire_data.get('lng'),
-                      current_fire_data.get('location'), current_fire_data.get('district'),
-                      current_fire_data.get('concelho'), current_fire_data.get('freguesia'),
-                      current_fire_data.get('natureza'), commit_hash,
-                      current_fire_data.get('dateTime', {}).get('sec'), # first_seen_data_timestamp
-                      commit_hash, current_fire_data.get('updated', {}).get('sec'), # last_updated
-                      current_fire_data.get('active', False)))
-                
-                update_log_entry['change_type'] = 'NEW'
-                cursor.execute('''
-                    INSERT INTO fire_updates (fire_id, commit_hash, commit_timestamp, data_timestamp, status, status_code,
-                                            man, terrain, aerial, meios_aquaticos, active_in_commit, change_type, raw_data)
-                    VALUES (:fire_id, :commit_hash, :commit_timestamp, :data_timestamp, :status, :status_code,
-                            :man, :terrain, :aerial, :meios_aquaticos, :active_in_commit, :change_type, :raw_data)
-                ''', update_log_entry)
-            else:
-                # Existing fire, check if its data or active status has changed
-                if compare_fire_data_are_different(previous_fire_data_state, current_fire_data):
+    history = FireHistoryEncoder()
+    # State tracker for the last known data of each fire_id (compact, see fire_state.py),
+    # persisted at each DB commit. A rebuild starts from an empty one.
+    last_known_fire_states = FireStateStore(conn.cursor(), eviction_horizon)
+    last_known_fire_states.reset()
+    # Last commit where each unchanged fire was seen, written once per checkpoint instead of once per commit
+    last_confirmed = {}
+
+    # Parsed fire maps keyed by blob id, so snapshots that come back (e.g. reverts) aren't parsed again
+    snapshot_cache = SnapshotCache(make_snapshot_parser(json_parser))
+    unchanged_snapshot_commits = 0
+    previous_blob_oid = None
+    current_commit_fires_map = {}
+
+    # Every commit's JSON is streamed through a single git process, oldest first
+    commit_blobs = iter_file_blobs(repo, commits, json_file_path_in_repo)
+    for i, (commit_hash, commit_timestamp, blob_oid, json_content) in enumerate(commit_blobs):
+        # print(f"\nProcessing commit {i+1}/{len(commits)}: {commit_hash[:7]} ({commit_timestamp})")
+
+        if i > 0 and blob_oid == previous_blob_oid:
+            # Same blob as the previous commit: every fire in it is unchanged and none can have
+            # disappeared, so skip the parse and diff and only confirm the fires still present.
+            # print(f"  UNCHANGED snapshot ({blob_oid[:7] if blob_oid else 'missing'}), skipping diff.")
+            for fire_id in current_commit_fires_map:
+                last_confirmed[fire_id] = commit_hash
+            unchanged_snapshot_commits += 1
+        else:
+            current_commit_fires_map = snapshot_cache.get(blob_oid, json_content)
+
+            if not json_content and not current_commit_fires_map :
+                # print(f"  No valid fire data file '{json_file_path_in_repo}' in commit {commit_hash[:7]}.")
+                # Disappearance logic below will handle fires that were active and are now gone.
+                pass
+
+            # 1. Process fires present in the current commit's JSON
+            for fire_id, current_fire_data in current_commit_fires_map.items():
+                previous_fire_state = last_known_fire_states.get(fire_id)
+                fingerprint = fire_fingerprint(current_fire_data)
+
+                if not previous_fire_state:
+                    # This is a new fire never seen before by the script
+                    # print(f"  NEW fire: {fire_id}")
+                    insert_new_fire(cursor, history, fire_id, current_fire_data, commit_hash, commit_timestamp)
+                    last_confirmed.pop(fire_id, None)
+                elif previous_fire_state.fingerprint != fingerprint:
+                    # Existing fire whose data or active status has changed
                     # print(f"  UPDATED fire: {fire_id}")
-                    cursor.execute('''
-                        UPDATE fires
-                        SET lat = ?, lng = ?, location = ?, district = ?, concelho = ?, freguesia = ?, natureza = ?,
-                            last_updated_commit_hash = ?, last_updated_data_timestamp = ?, is_currently_active = ?
-                        WHERE fire_id = ?
-                    ''', (current_fire_data.get('lat'), current_fire_data.get('lng'),
-                          current_fire_data.get('location'), current_fire_data.get('district'),
-                          current_fire_data.get('concelho'), current_fire_data.get('freguesia'),
-                          current_fire_data.get('natureza'), commit_hash,
-                          current_fire_data.get('updated', {}).get('sec'),
-                          current_fire_data.get('active', False), fire_id))
-                    
-                    update_log_entry['change_type'] = 'UPDATED'
-                    cursor.execute('''
-                        INSERT INTO fire_updates (fire_id, commit_hash, commit_timestamp, data_timestamp, status, status_code,
-                                                man, terrain, aerial, meios_aquaticos, active_in_commit, change_type, raw_data)
-                        VALUES (:fire_id, :commit_hash, :commit_timestamp, :data_timestamp, :status, :status_code,
-                                :man, :terrain, :aerial, :meios_aquaticos, :active_in_commit, :change_type, :raw_data)
-                    ''', update_log_entry)
+                    update_existing_fire(cursor, history, fire_id, current_fire_data, commit_hash, commit_timestamp)
+                    last_confirmed.pop(fire_id, None)
                 else:
                     # Fire data is identical to the last known state.
-                    # Only update 'last_updated_commit_hash' in 'fires' to show it's still confirmed in this commit.
-                    # No new entry in 'fire_updates' as there's no change to log.
+                    # Only 'last_updated_commit_hash' in 'fires' changes, to show it's still confirmed in this commit;
+                    # it is written at the next checkpoint. No new entry in 'fire_updates' as there's no change to log.
                     # print(f"  UNCHANGED (still present) fire: {fire_id}")
-                    cursor.execute('''
-                        UPDATE fires SET last_updated_commit_hash = ? WHERE fire_id = ?
-                    ''', (commit_hash, fire_id))
+                    last_confirmed[fire_id] = commit_hash
 
-            # Update the in-memory state for this fire
-            last_known_fire_states[fire_id] = current_fire_data
+                # Update the in-memory state for this fire
+                last_known_fire_states.set(fire_id, current_fire_data, commit_timestamp, fingerprint)
 
-        # 2. Process fires that were known (and active) but are NOT in the current commit's JSON (disappeared)
-        previously_known_fire_ids = set(last_known_fire_states.keys())
-        disappeared_fire_ids = previously_known_fire_ids - processed_fire_ids_in_this_commit
-
-        for fire_id in disappeared_fire_ids:
-            last_data = last_known_fire_states[fire_id]
+            # 2. Process fires that were known (and active) but are NOT in the current commit's JSON (disappeared)
             # Consider it "disappeared" if it was marked as active in our state tracker
-            if last_data.get('active', False):
+            disappeared_fire_ids = last_known_fire_states.active_fire_ids - current_commit_fires_map.keys()
+
+            for fire_id in disappeared_fire_ids:
+                last_data = last_known_fire_states.get(fire_id).data
                 # print(f"  DISAPPEARED fire: {fire_id}")
-                cursor.execute('''
-                    UPDATE fires
-                    SET is_currently_active = ?, last_updated_commit_hash = ?
-                    WHERE fire_id = ?
-                ''', (False, commit_hash, fire_id)) # Mark inactive, update commit hash of this observation
-
-                # Log this disappearance event in fire_updates
-                disappeared_log_entry = {
-                    'fire_id': fire_id,
-                    'commit_hash': commit_hash,
-                    'commit_timestamp': commit_timestamp,
-                    'data_timestamp': commit_timestamp, # Use commit time as no specific fire data point
-                    'status': "Disappeared from source",
-                    'status_code': None, # Or a custom code for disappearance
-                    'man': last_data.get('man'), # Log last known values
-                    'terrain': last_data.get('terrain'),
-                    'aerial': last_data.get('aerial'),
-                    'meios_aquaticos': last_data.get('meios_aquaticos'),
-                    'active_in_commit': False, # Not active as it's not in the commit's data
-                    'change_type': 'DISAPPEARED',
-                    'raw_data': json.dumps(last_data) # Store the last known state
-                }
-                cursor.execute('''
-                    INSERT INTO fire_updates (fire_id, commit_hash, commit_timestamp, data_timestamp, status, status_code,
-                                            man, terrain, aerial, meios_aquaticos, active_in_commit, change_type, raw_data)
-                    VALUES (:fire_id, :commit_hash, :commit_timestamp, :data_timestamp, :status, :status_code,
-                            :man, :terrain, :aerial, :meios_aquaticos, :active_in_commit, :change_type, :raw_data)
-                ''', disappeared_log_entry)
-
-            # Update the in-memory state: mark as inactive because it's gone from the current file
-            if fire_id in last_known_fire_states: # Should always be true
-                 last_known_fire_states[fire_id]['active'] = False
+                mark_fire_disappeared(cursor, history, fire_id, last_data, commit_hash, commit_timestamp)
+                last_confirmed.pop(fire_id, None)
 
+                # Update the in-memory state: mark as inactive because it's gone from the current file.
+                # Replaced rather than mutated: the fire dict is shared with the parsed snapshot cache
+                last_known_fire_states.set(fire_id, dict(last_data, active=False), commit_timestamp)
 
         # Commit to DB periodically or at the end
         if (i + 1) % 100 == 0 or (i + 1) == len(commits):
+            # Checkpoint the presence confirmations and fire states together with their events and the last processed commit
+            cursor.executemany('''
+                UPDATE fires SET last_updated_commit_hash = ? WHERE fire_id = ?
+            ''', [(confirmed_commit_hash, fire_id) for fire_id, confirmed_commit_hash in last_confirmed.items()])
+            last_confirmed.clear()
+            last_known_fire_states.checkpoint(commit_hash)
+            update_last_processed_commit_hash(cursor, commit_hash)
+            data_version = increment_data_version(cursor)
+            if (i + 1) == len(commits):
+                rebuild_daily_stats(cursor, commit_hash)
+                rebuild_fire_search(cursor, commit_hash)
+                rebuild_fire_geo(cursor, commit_hash, data_version)
+                rebuild_fire_intervals(cursor)
+                rebuild_resource_rollup(cursor, commit_timestamp)
             conn.commit()
+            history.forget(last_known_fire_states.evict(commit_timestamp))
             print(f"Processed and committed {i+1}/{len(commits)} commits.")
 
+        previous_blob_oid = blob_oid
+
     conn.commit() # Final commit of any remaining transactions
     conn.close()
+    print(f"Skipped the diff for {unchanged_snapshot_commits} commits with an unchanged snapshot "
+          f"(parsed snapshot cache: {snapshot_cache.hits} hits, {snapshot_cache.misses} misses).")
+    print(f"Fire states: {len(last_known_fire_states)} in memory, {last_known_fire_states.evictions} evicted, "
+          f"{last_known_fire_states.disk_loads} read back from disk.")
     print(f"Processing complete. Database saved to '{DB_NAME}'.")
 
+# --- Parallel Rebuild ---
+# The commit list is split into contiguous chunks. Worker processes read, parse and diff each chunk
+# starting from an empty state, so the first time a fire shows up in a chunk they can't tell whether
+# it is new, updated or unchanged: that appearance is reported as FIRST_SEEN. The writer (this
+# process) applies the chunks in order and resolves those appearances, plus the disappearances at the
+# chunk's first commit, against the global state left by the previous chunks. Every later event in a
+# chunk only depends on the chunk's own commits, so the result matches the serial rebuild.
+
+PARALLEL_CHUNK_SIZE = 1000 # Commits per worker task
+
+def diff_commit_chunk(task):
+    """
+    Worker: diffs a contiguous range of commits starting from an empty state.
+    Returns a dict with:
+      'first_commit_fire_ids': ids of the fires in the chunk's first commit,
+      'events': [(commit_hash, commit_timestamp, [(change_type, fire_id, fire_data), ...])] for
+                the first commit and every commit with changes, change_type being
+                'FIRST_SEEN', 'UPDATED' or 'DISAPPEARED',
+      'last_confirmed': {fire_id: last commit_hash where the fire was present or disappeared},
+      'fire_states': {fire_id: state at the end of the chunk} for the fires seen in it.
+    """
+    repo_path, commits, json_file_path_in_repo, json_parser = task
+    repo = git.Repo(repo_path)
+
+    fire_states = {}
+    fingerprints = {}
+    last_confirmed = {}
+    events = []
+    first_commit_fire_ids = set()
+    snapshot_cache = SnapshotCache(make_snapshot_parser(json_parser))
+    previous_blob_oid = None
+    current_commit_fires_map = {}
+
+    for i, (commit_hash, commit_timestamp, blob_oid, json_content) in enumerate(iter_file_blobs(repo, commits, json_file_path_in_repo)):
+        if i > 0 and blob_oid == previous_blob_oid:
+            for fire_id in current_commit_fires_map:
+                last_confirmed[fire_id] = commit_hash
+            continue
+        previous_blob_oid = blob_oid
+        current_commit_fires_map = snapshot_cache.get(blob_oid, json_content)
+        if i == 0:
+            first_commit_fire_ids = set(current_commit_fires_map)
+
+        commit_events = []
+        for fire_id, current_fire_data in current_commit_fires_map.items():
+            fingerprint = fire_fingerprint(current_fire_data)
+            if fire_id not in fire_states:
+                commit_events.append(('FIRST_SEEN', fire_id, current_fire_data))
+            elif fingerprints[fire_id] != fingerprint:
+                commit_events.append(('UPDATED', fire_id, current_fire_data))
+            fire_states[fire_id] = current_fire_data
+            fingerprints[fire_id] = fingerprint
+            last_confirmed[fire_id] = commit_hash
+
+        for fire_id in fire_states.keys() - current_commit_fires_map.keys():
+            last_data = fire_states[fire_id]
+            if last_data.get('active', False):
+                commit_events.append(('DISAPPEARED', fire_id, last_data))
+                fire_states[fire_id] = dict(last_data, active=False)
+                fingerprints[fire_id] = fire_fingerprint(fire_states[fire_id])
+                last_confirmed[fire_id] = commit_hash
+
+        if commit_events or i == 0:
+            events.append((commit_hash, commit_timestamp, commit_events))
+
+    return {
+        'first_commit_fire_ids': first_commit_fire_ids,
+        'events': events,
+        'last_confirmed': last_confirmed,
+        'fire_states': fire_states,
+    }
+
+def apply_commit_chunk(cursor, history, fire_states, chunk, seen_at):
+    """
+    Writer: applies a chunk diffed by `diff_commit_chunk` on top of `fire_states`, the FireStateStore
+    left by the previous chunks, which is updated in place. The fires seen in the chunk are recorded
+    as last seen at `seen_at`, the timestamp of its last commit.
+    """
+    for event_index, (commit_hash, commit_timestamp, commit_events) in enumerate(chunk['events']):
+        for change_type, fire_id, fire_data in commit_events:
+            if change_type == 'FIRST_SEEN':
+                previous_fire_state = fire_states.get(fire_id)
+                fingerprint = fire_fingerprint(fire_data)
+                if not previous_fire_state:
+                    insert_new_fire(cursor, history, fire_id, fire_data, commit_hash, commit_timestamp)
+                elif previous_fire_state.fingerprint != fingerprint:
+                    update_existing_fire(cursor, history, fire_id, fire_data, commit_hash, commit_timestamp)
+                fire_states.set(fire_id, fire_data, commit_timestamp, fingerprint)
+            elif change_type == 'UPDATED':
+                update_existing_fire(cursor, history, fire_id, fire_data, commit_hash, commit_timestamp)
+            else:
+                mark_fire_disappeared(cursor, history, fire_id, fire_data, commit_hash, commit_timestamp)
+
+        if event_index == 0:
+            # Fires known from previous chunks that are still active but missing from this chunk's
+            # first commit disappeared there. The workers can't see those, so they are resolved here.
+            for fire_id in fire_states.active_fire_ids - chunk['first_commit_fire_ids']:
+                last_data = fire_states.get(fire_id).data
+                mark_fire_disappeared(cursor, history, fire_id, last_data, commit_hash, commit_timestamp)
+                fire_states.set(fire_id, dict(last_data, active=False), commit_timestamp)
+
+    # Presence confirmations are only needed once per chunk: the latest one wins.
+    cursor.executemany('''
+        UPDATE fires SET last_updated_commit_hash = ? WHERE fire_id = ?
+    ''', [(commit_hash, fire_id) for fire_id, commit_hash in chunk['last_confirmed'].items()])
+
+    for fire_id, fire_data in chunk['fire_states'].items():
+        fire_states.set(fire_id, fire_data, seen_at)
+
+def process_commits_in_parallel(conn, repo_path, commits, json_file_path_in_repo, workers, json_parser=None,
+                                eviction_horizon=DEFAULT_EVICTION_HORIZON):
+    """Rebuilds the database from `commits` with a pool of `workers` diffing processes and this process as the single writer."""
+    cursor = conn.cursor()
+    chunks = [commits[start:start + PARALLEL_CHUNK_SIZE] for start in range(0, len(commits), PARALLEL_CHUNK_SIZE)]
+    tasks = [(repo_path, chunk, json_file_path_in_repo, json_parser) for chunk in chunks]
+    print(f"Diffing {len(chunks)} chunks of up to {PARALLEL_CHUNK_SIZE} commits with {workers} workers...")
+
+    fire_states = FireStateStore(conn.cursor(), eviction_horizon)
+    fire_states.reset()
+    history = FireHistoryEncoder()
+    processed_commits = 0
+    with multiprocessing.Pool(workers) as pool:
+        # imap keeps the chunks in commit order while the workers run ahead of the writer
+        for chunk_commits, chunk in zip(chunks, pool.imap(diff_commit_chunk, tasks)):
+            last_commit_hash, last_commit_timestamp = chunk_commits[-1]
+            apply_commit_chunk(cursor, history, fire_states, chunk, last_commit_timestamp)
+            fire_states.checkpoint(last_commit_hash)
+            update_last_processed_commit_hash(cursor, last_commit_hash)
+            increment_data_version(cursor)
+            conn.commit()
+            history.forget(fire_states.evict(last_commit_timestamp))
+            processed_commits += len(chunk_commits)
+            print(f"Processed and committed {processed_commits}/{len(commits)} commits.")
+
+    rebuild_daily_stats(cursor, commits[-1][0])
+    rebuild_fire_search(cursor, commits[-1][0])
+    rebuild_fire_geo(cursor, commits[-1][0], get_data_version(cursor))
+    rebuild_fire_intervals(cursor)
+    rebuild_resource_rollup(cursor, commits[-1][1])
+    conn.commit()
+
 if __name__ == "__main__":
-    process_repository("./", "fogos.json")
+    parser = argparse.ArgumentParser(description="Rebuilds the fires database from the full git history of the fire data file.")
+    parser.add_argument("repo_path", nargs="?", default="./", help="Path of the git repository (default: ./)")
+    parser.add_argument("json_file", nargs="?", default="fogos.json", help="Path of the JSON file inside the repository (default: fogos.json)")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes diffing the history in parallel (default: 1, serial)")
+    parser.add_argument("--json-parser", choices=('auto',) + SNAPSHOT_PARSERS,
+                        help="Snapshot JSON parser (default: FIRES_JSON_PARSER, else the fastest installed)")
+    parser.add_argument("--evict-after-days", type=float, default=DEFAULT_EVICTION_HORIZON / 86400,
+                        help="Days an inactive fire stays in memory after it was last seen, 0 to keep every fire "
+                             f"(default: {DEFAULT_EVICTION_HORIZON // 86400:.0f})")
+    args = parser.parse_args()
+    process_repository(args.repo_path, args.json_file, workers=args.workers, json_parser=args.json_parser,
+                       eviction_horizon=args.evict_after_days * 86400 or None)
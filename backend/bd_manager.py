@@ -2,16 +2,35 @@ import git
 import json
 import sqlite3
 import os
+import time
+import argparse
 from datetime import datetime, timezone
+from git_blobs import list_commits, iter_file_blobs
+from snapshot_cache import SnapshotCache
+from snapshot_parsers import make_snapshot_parser, SNAPSHOT_PARSERS
+from fire_state import create_fire_state_table, fire_fingerprint, FireStateStore, DEFAULT_EVICTION_HORIZON
+from fire_writer import FireWriter
+from daily_stats import create_daily_stats_table, get_daily_stats_commit_hash, refresh_daily_stats, rebuild_daily_stats
+from fire_search import create_fire_search_table, get_fire_search_commit_hash, refresh_fire_search, rebuild_fire_search
+from fire_intervals import create_fire_intervals_table, refresh_fire_intervals
+from resource_series import create_resource_rollup_table, refresh_resource_rollup
+from fire_geo import FIRES_GEO_SCHEMA, FIRE_GEO_COMMIT_KEY, create_fire_geo_table, get_fire_geo_commit_hash, refresh_fire_geo, rebuild_fire_geo
+from fire_history import create_fire_history_table, backfill_fire_deltas
+from db_metadata import get_metadata, set_metadata
 
 # --- Database Setup ---
 DB_NAME = "fires.sqlite" # Keep the same DB name
 
 # --- Helper Functions (mostly from original, with additions) ---
 
-def init_db():
-    """Initializes the SQLite database and creates/updates tables."""
-    conn = sqlite3.connect(DB_NAME)
+def init_db(db_path=DB_NAME):
+    """Initializes the SQLite database at `db_path` and creates/updates tables."""
+    conn = sqlite3.connect(db_path)
+    # WAL lets the API keep reading while the ingest writes; with WAL, NORMAL sync is still crash-safe.
+    # The journal mode is stored in the database file and WAL readers need write access to its
+    # directory (for the -shm file), so close_db() switches back to the rollback journal when done.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
     cursor = conn.cursor()
 
     # Table to store the latest known state and key historical points of each fire
@@ -61,19 +80,150 @@ def init_db():
         value TEXT
     )
     ''')
+
+    # Checkpoint of the last known JSON per fire, the baseline for incremental runs
+    create_fire_state_table(cursor)
+    # Per day and district aggregates served by the API
+    create_daily_stats_table(cursor)
+    # Full-text index of the place names, for the API search
+    create_fire_search_table(cursor)
+    # R*Tree of the fire positions, for the map queries
+    create_fire_geo_table(cursor)
+    # Activity intervals of the fires, for the time travel API
+    create_fire_intervals_table(cursor)
+    # Resources deployed over time, per district, at a few resolutions
+    create_resource_rollup_table(cursor)
+    create_fire_history_table(cursor)
+    conn.commit()
+
+    apply_migrations(conn)
+    backfilled_deltas = backfill_fire_deltas(conn) # Only does something for a database written before delta encoding
     conn.commit()
+    if backfilled_deltas:
+        print(f"Derived {backfilled_deltas} field deltas from the fire history written before delta encoding.")
     return conn
 
+# --- Schema Migrations ---
+# Changes to an existing fires.sqlite are applied in order, each in its own transaction, and the
+# version reached is stored in script_metadata. New migrations are appended to MIGRATIONS.
+
+SCHEMA_VERSION_KEY = 'schema_version'
+
+MIGRATIONS = [
+    (1, "Indexes for the API date filters, district group-bys and fire_updates lookups", [
+        # Date range filters also reading the grouped/aggregated columns without touching the table
+        "CREATE INDEX IF NOT EXISTS idx_fires_first_seen ON fires (first_seen_data_timestamp, district, last_updated_data_timestamp, fire_id)",
+        "CREATE INDEX IF NOT EXISTS idx_fires_district ON fires (district, first_seen_data_timestamp, fire_id)",
+        "CREATE INDEX IF NOT EXISTS idx_fire_updates_fire_commit ON fire_updates (fire_id, commit_timestamp)",
+    ]),
+    (2, "Generated day/month columns for the first seen timestamp", [
+        # VIRTUAL columns are computed on read, but their indexes store the value: grouping and
+        # filtering by day or month no longer runs strftime(datetime(...)) for every row.
+        "ALTER TABLE fires ADD COLUMN first_seen_day TEXT GENERATED ALWAYS AS "
+        "(strftime('%Y-%m-%d', first_seen_data_timestamp, 'unixepoch')) VIRTUAL",
+        "ALTER TABLE fires ADD COLUMN first_seen_month TEXT GENERATED ALWAYS AS "
+        "(strftime('%Y-%m', first_seen_data_timestamp, 'unixepoch')) VIRTUAL",
+        "CREATE INDEX IF NOT EXISTS idx_fires_first_seen_day ON fires (first_seen_day, district, fire_id)",
+        "CREATE INDEX IF NOT EXISTS idx_fires_first_seen_month ON fires (first_seen_data_timestamp, first_seen_month)",
+    ]),
+    (3, "Peak resources in the daily rollup", [
+        # Sum over the day's fires of each fire's highest man/terrain/aerial count. Dropping the
+        # rollup's checkpoint makes the next ingest run rebuild it with the new columns filled in.
+        "ALTER TABLE daily_district_stats ADD COLUMN peak_man INTEGER",
+        "ALTER TABLE daily_district_stats ADD COLUMN peak_terrain INTEGER",
+        "ALTER TABLE daily_district_stats ADD COLUMN peak_aerial INTEGER",
+        "DELETE FROM script_metadata WHERE key = 'daily_stats_commit_hash'",
+    ]),
+    (4, "Content-addressed, compressed store for the raw JSON of fire_updates", [
+        # See raw_payloads.py. Existing raw_data values are moved by migrate_raw_payloads.py.
+        '''CREATE TABLE IF NOT EXISTS raw_payload_dictionaries (
+            dictionary_id INTEGER PRIMARY KEY,
+            data BLOB                  -- zlib preset dictionary
+        )''',
+        '''CREATE TABLE IF NOT EXISTS raw_payloads (
+            payload_id INTEGER PRIMARY KEY,
+            digest BLOB UNIQUE,        -- SHA-256 of the canonical JSON
+            dictionary_id INTEGER REFERENCES raw_payload_dictionaries (dictionary_id),
+            data BLOB                  -- zlib-compressed canonical JSON
+        )''',
+        "ALTER TABLE fire_updates ADD COLUMN raw_payload_id INTEGER REFERENCES raw_payloads (payload_id)",
+    ]),
+    (5, "Commit lookup for the fire state API", [
+        # /api/fires/<fire_id>/state?commit= resolves the commit to its timestamp
+        "CREATE INDEX IF NOT EXISTS idx_fire_updates_commit_hash ON fire_updates (commit_hash)",
+    ]),
+    (6, "Last seen time of the checkpointed fire states", [
+        # Fires inactive for longer than the eviction horizon are not loaded by the ingest (see fire_state.py)
+        "ALTER TABLE fire_state ADD COLUMN last_seen INTEGER",
+    ]),
+    (7, "Data version of each fire in the geospatial index", [
+        # R*Trees can't gain columns: the index is recreated empty and rebuilt by the next ingest run
+        "DROP TABLE IF EXISTS fires_geo",
+        FIRES_GEO_SCHEMA,
+        f"DELETE FROM script_metadata WHERE key = '{FIRE_GEO_COMMIT_KEY}'",
+    ]),
+]
+
+def close_db(conn):
+    """
+    Closes an ingest connection, switching the database back to the rollback journal so the API
+    can open it read-only from a directory it can't write to (see init_db).
+    """
+    try:
+        journal_mode = conn.execute("PRAGMA journal_mode=DELETE").fetchone()[0]
+    except sqlite3.OperationalError as e:
+        journal_mode = str(e)
+    if journal_mode != 'delete':
+        # Another connection (e.g. the API reading during the ingest) still has the database open
+        print(f"Warning: the database stays in WAL mode ({journal_mode}); its directory must be writable by its readers.")
+    conn.close()
+
+def get_schema_version(cursor):
+    """Returns the schema version of the database (0 if no migration was ever applied)."""
+    return int(get_metadata(cursor, SCHEMA_VERSION_KEY, 0))
+
+def apply_migrations(conn):
+    """Applies the migrations newer than the database's schema version."""
+    cursor = conn.cursor()
+    current_version = get_schema_version(cursor)
+    for version, description, statements in MIGRATIONS:
+        if version <= current_version:
+            continue
+        print(f"Applying schema migration {version}: {description}...")
+        try:
+            cursor.execute("BEGIN")
+            for statement in statements:
+                cursor.execute(statement)
+            set_metadata(cursor, SCHEMA_VERSION_KEY, str(version))
+            conn.commit()
+        except sqlite3.Error:
+            conn.rollback()
+            raise
+
 def get_last_processed_commit_hash(cursor):
     """Retrieves the hash of the last successfully processed commit."""
-    cursor.execute("SELECT value FROM script_metadata WHERE key = 'last_processed_commit_hash'")
-    row = cursor.fetchone()
-    return row[0] if row else None
+    return get_metadata(cursor, 'last_processed_commit_hash')
 
 def update_last_processed_commit_hash(cursor, commit_hash):
     """Updates the hash of the last successfully processed commit."""
-    cursor.execute("INSERT OR REPLACE INTO script_metadata (key, value) VALUES (?, ?)",
-                   ('last_processed_commit_hash', commit_hash))
+    set_metadata(cursor, 'last_processed_commit_hash', commit_hash)
+
+# Counter incremented by every ingest transaction that changes the data, including the snapshots
+# applied by the live ingest daemon between two scraper commits. The API tags its responses with it.
+DATA_VERSION_KEY = 'data_version'
+# Snapshots applied by the daemon that don't come from a git commit are logged with this prefix
+# followed by the SHA-1 of their content in place of a commit hash
+LIVE_SNAPSHOT_PREFIX = 'snapshot:'
+
+def get_data_version(cursor):
+    """Returns the data version of the database (0 if nothing was ingested since it exists)."""
+    return int(get_metadata(cursor, DATA_VERSION_KEY, 0))
+
+def increment_data_version(cursor):
+    """Increments the data version, in the caller's transaction. Returns the new version."""
+    data_version = get_data_version(cursor) + 1
+    set_metadata(cursor, DATA_VERSION_KEY, str(data_version))
+    return data_version
 
 def get_file_content_at_commit(repo, commit_hexsha, file_path_in_repo):
     """Retrieves the content of a file from a specific commit."""
@@ -88,7 +238,10 @@ def get_file_content_at_commit(repo, commit_hexsha, file_path_in_repo):
         return None
 
 def parse_fire_data(json_content):
-    """Parses JSON content into a dictionary of fire data, keyed by fire ID."""
+    """
+    Parses JSON content into a dictionary of fire data, keyed by fire ID. This is the 'json'
+    backend of snapshot_parsers.py, which the faster backends must match.
+    """
     if not json_content:
         return {}
     try:
@@ -96,33 +249,15 @@ def parse_fire_data(json_content):
         if data.get("success") and isinstance(data.get("data"), list):
             return {item['id']: item for item in data['data'] if isinstance(item, dict) and 'id' in item}
         return {}
-    except (json.JSONDecodeError, TypeError):
+    except (json.JSONDecodeError, TypeError, AttributeError): # AttributeError: the JSON isn't an object
         return {}
 
-def compare_fire_data_are_different(old_data, new_data):
-    """Compares two fire data dictionaries for meaningful differences."""
-    if not old_data or not new_data:
-        return True
-    relevant_fields = [
-        'lat', 'lng', 'location', 'man', 'terrain', 'aerial', 'meios_aquaticos',
-        'status', 'statusCode', 'natureza', 'active', 'localidade', 'important',
-        'district', 'concelho', 'freguesia', 'naturezaCode', 'statusColor',
-    ]
-    for field in relevant_fields:
-        if old_data.get(field) != new_data.get(field):
-            return True
-    if old_data.get('updated', {}).get('sec') != new_data.get('updated', {}).get('sec'):
-        return True
-    if 'updated' not in old_data and 'updated' not in new_data:
-        if old_data.get('dateTime', {}).get('sec') != new_data.get('dateTime', {}).get('sec'):
-            return True
-    return False
-
 def load_current_fire_states_from_db(repo, conn, json_file_path_in_repo):
     """
     Loads the last known full state of all fires from the database.
     It does this by looking at the `fires` table for `last_updated_commit_hash`,
     then fetching the actual JSON from that commit to reconstruct the full fire data.
+    Only needed when there is no `fire_state` checkpoint yet (see `FireStateStore.load`).
     """
     cursor = conn.cursor()
     states = {}
@@ -133,41 +268,187 @@ def load_current_fire_states_from_db(repo, conn, json_file_path_in_repo):
         print("  No existing fire states in DB to load.")
         return states
 
-    print(f"  Loading initial states for {len(fires_in_db)} fires from their last known commits...")
+    # Many fires share the same last commit, so read and parse each snapshot only once
+    fire_ids_by_commit = {}
     for fire_id, last_commit_hash in fires_in_db:
         if not last_commit_hash: # Should not happen if data is consistent
             print(f"  Warning: Fire {fire_id} has no last_updated_commit_hash in DB. Skipping.")
             continue
+        if last_commit_hash.startswith(LIVE_SNAPSHOT_PREFIX):
+            # Last seen in a snapshot applied by the live ingest daemon, which is not in git
+            continue
+        fire_ids_by_commit.setdefault(last_commit_hash, []).append(fire_id)
 
-        json_content = get_file_content_at_commit(repo, last_commit_hash, json_file_path_in_repo)
+    print(f"  Loading initial states for {len(fires_in_db)} fires from {len(fire_ids_by_commit)} commits...")
+    commits = [(commit_hash, None) for commit_hash in fire_ids_by_commit]
+    for commit_hash, _, _, json_content in iter_file_blobs(repo, commits, json_file_path_in_repo):
         if json_content:
             fires_map_for_commit = parse_fire_data(json_content)
-            if fire_id in fires_map_for_commit:
-                states[fire_id] = fires_map_for_commit[fire_id]
-            # else:
-                # print(f"  Warning: Fire {fire_id} not found in its last_updated_commit_hash ({last_commit_hash[:7]}) content. Its state might be outdated if it disappeared.")
+            for fire_id in fire_ids_by_commit[commit_hash]:
+                if fire_id in fires_map_for_commit:
+                    states[fire_id] = fires_map_for_commit[fire_id]
+                # else:
+                    # print(f"  Warning: Fire {fire_id} not found in its last_updated_commit_hash ({commit_hash[:7]}) content. Its state might be outdated if it disappeared.")
         # else:
-            # print(f"  Warning: Could not retrieve content for fire {fire_id} from commit {last_commit_hash[:7]}.")
+            # print(f"  Warning: Could not retrieve content for commit {commit_hash[:7]}.")
     print(f"  Finished loading initial states. {len(states)} states loaded.")
     return states
 
+# --- Snapshot Diff ---
+# Shared by the incremental run and the live ingest daemon (ingest_daemon.py).
+
+def apply_snapshot(writer, fire_states, commit_hash, commit_timestamp, current_commit_fires_map):
+    """
+    Diffs the fires of one snapshot against `fire_states` (a FireStateStore, updated in place) and
+    queues the resulting NEW/UPDATED/DISAPPEARED rows and presence confirmations in `writer`.
+    Returns the number of fires per change type, plus 'UNCHANGED'.
+    """
+    change_counts = {'NEW': 0, 'UPDATED': 0, 'DISAPPEARED': 0, 'UNCHANGED': 0}
+
+    # 1. Process fires present in the current commit's JSON
+    for fire_id, current_fire_data in current_commit_fires_map.items():
+        # This is the state of the fire *before this specific commit*
+        # (either from DB load, or from a previous commit in this batch)
+        previous_fire_state = fire_states.get(fire_id) if writer.fire_exists(fire_id) else None
+        fingerprint = fire_fingerprint(current_fire_data)
+
+        update_log_entry = {
+            'fire_id': fire_id, 'commit_hash': commit_hash, 'commit_timestamp': commit_timestamp,
+            'data_timestamp': current_fire_data.get('updated', {}).get('sec') or \
+                              current_fire_data.get('dateTime', {}).get('sec'),
+            'status': current_fire_data.get('status'), 'status_code': current_fire_data.get('statusCode'),
+            'man': current_fire_data.get('man'), 'terrain': current_fire_data.get('terrain'),
+            'aerial': current_fire_data.get('aerial'), 'meios_aquaticos': current_fire_data.get('meios_aquaticos'),
+            'active_in_commit': current_fire_data.get('active', False),
+            'raw_data': current_fire_data
+        }
+        fire_columns = {
+            'lat': current_fire_data.get('lat'), 'lng': current_fire_data.get('lng'),
+            'location': current_fire_data.get('location'), 'district': current_fire_data.get('district'),
+            'concelho': current_fire_data.get('concelho'), 'freguesia': current_fire_data.get('freguesia'),
+            'natureza': current_fire_data.get('natureza'), 'last_updated_commit_hash': commit_hash,
+            'last_updated_data_timestamp': current_fire_data.get('updated', {}).get('sec') or \
+                                           current_fire_data.get('dateTime', {}).get('sec'),
+            'is_currently_active': current_fire_data.get('active', False),
+        }
+
+        if not writer.fire_exists(fire_id): # Truly new fire to the system
+            print(f"  NEW fire (to DB): {fire_id}")
+            writer.insert_fire(dict(fire_columns, fire_id=fire_id,
+                                    first_seen_commit_hash=commit_hash,
+                                    first_seen_data_timestamp=current_fire_data.get('dateTime', {}).get('sec')))
+            update_log_entry['change_type'] = 'NEW'
+        elif not previous_fire_state:
+            # Exists in DB, but not in our `fire_states` (e.g. disappeared then reappeared)
+            # Or, more likely, it's the first time we see it in this *batch* of new commits.
+            # We treat this as an update if its DB state was different.
+            # The fingerprint comparison needs a proper `previous_fire_state`.
+            # This case implies it appeared *within this batch* after not being in `load_current_fire_states_from_db`.
+            # This implies `fire_exists_in_db` should have been true, and `previous_fire_state`
+            # should have been loaded by `load_current_fire_states_from_db`.
+            # The only way `previous_fire_state` is None here, if `fire_exists_in_db` is True,
+            # is if `load_current_fire_states_from_db` failed to load it (e.g., file missing in its last_updated_commit).
+            # For safety, let's just treat it as if it's an update compared to a "null" previous state.
+            print(f"  REAPPEARED or new in batch: {fire_id}")
+            writer.update_fire(fire_id, **fire_columns)
+            update_log_entry['change_type'] = 'UPDATED' # Or 'REAPPEARED'
+        else: # Fire exists in DB and we have its previous state for comparison
+            if previous_fire_state.fingerprint != fingerprint:
+                print(f"  UPDATED fire: {fire_id}")
+                writer.update_fire(fire_id, **fire_columns)
+                update_log_entry['change_type'] = 'UPDATED'
+            else: # UNCHANGED but present in this commit
+                writer.confirm_fire(fire_id, commit_hash)
+                change_counts['UNCHANGED'] += 1
+                # No fire_updates entry for "UNCHANGED" as per original logic.
+                update_log_entry = None # Signal not to log this
+
+        if update_log_entry:
+            writer.log_update(update_log_entry)
+            change_counts[update_log_entry['change_type']] += 1
+
+        # Update the in-memory state for this fire to reflect this commit's data
+        fire_states.set(fire_id, current_fire_data, commit_timestamp, fingerprint)
+
+    # After processing all fires IN THIS COMMIT'S JSON:
+    # Check for fires that were active in our `fire_states` but are NOT in `current_commit_fires_map`.
+    # These have "disappeared" *in this specific commit*.
+    # The final `is_currently_active` status in `fires` table will be determined by the *last commit in the batch*.
+
+    # Disappearance within the batch (fire gone from one commit to the next *within this batch*)
+    disappeared_in_this_commit_ids = fire_states.active_fire_ids - current_commit_fires_map.keys()
+
+    for fire_id in disappeared_in_this_commit_ids:
+        # Its state from the *previous* commit (or DB load). It was active before this commit,
+        # and now it's gone from the JSON
+        last_data_for_fire = fire_states.get(fire_id).data
+        print(f"  DISAPPEARED (in this commit): {fire_id}")
+        # Update `fires` table. `is_currently_active` will be False.
+        # `last_updated_commit_hash` points to *this* commit where it was observed missing.
+        writer.update_fire(fire_id, is_currently_active=False, last_updated_commit_hash=commit_hash)
+
+        disappeared_log_entry = {
+            'fire_id': fire_id, 'commit_hash': commit_hash, 'commit_timestamp': commit_timestamp,
+            'data_timestamp': commit_timestamp, # Use commit time
+            'status': "Disappeared from source", 'status_code': None,
+            'man': last_data_for_fire.get('man'), 'terrain': last_data_for_fire.get('terrain'),
+            'aerial': last_data_for_fire.get('aerial'), 'meios_aquaticos': last_data_for_fire.get('meios_aquaticos'),
+            'active_in_commit': False, # Not in JSON, so not active in this commit
+            'change_type': 'DISAPPEARED',
+            'raw_data': last_data_for_fire # Log its last known state
+        }
+        writer.log_update(disappeared_log_entry)
+        change_counts['DISAPPEARED'] += 1
+
+        # Mark it as inactive in our live state tracker. Replaced rather than mutated,
+        # since the fire dict is shared with the parsed snapshot cache.
+        # We don't remove it from fire_states, as it might reappear in a later commit.
+        fire_states.set(fire_id, dict(last_data_for_fire, active=False), commit_timestamp)
+
+    return change_counts
+
+def commit_ingest_batch(conn, writer, fire_states, commit_hash, now):
+    """
+    Flushes the writer and commits its rows together with the derived tables, the fire state
+    checkpoint, `commit_hash` as the last processed commit and a new data version.
+    `now` is the timestamp of the newest snapshot, for the eviction of the fire states.
+    Returns the number of days of the daily rollup recomputed.
+    """
+    cursor = conn.cursor()
+    touched_fire_ids = writer.flush()
+    refreshed_rollup_days = refresh_daily_stats(cursor, touched_fire_ids, commit_hash)
+    refresh_fire_search(cursor, touched_fire_ids, commit_hash)
+    data_version = increment_data_version(cursor)
+    refresh_fire_geo(cursor, touched_fire_ids, commit_hash, data_version)
+    refresh_fire_intervals(cursor)
+    refresh_resource_rollup(cursor, now)
+    fire_states.checkpoint(commit_hash)
+    update_last_processed_commit_hash(cursor, commit_hash)
+    conn.commit()
+    # Long inactive fires are on disk now: drop them from memory, and from the history encoder
+    writer.history.forget(fire_states.evict(now))
+    return refreshed_rollup_days
+
 # --- Main Incremental Logic ---
-def process_repository_incrementally(repo_path, json_file_path_in_repo):
+def process_repository_incrementally(repo_path, json_file_path_in_repo, batch_size=20, json_parser=None,
+                                     eviction_horizon=DEFAULT_EVICTION_HORIZON, db_path=DB_NAME):
     """
-    Processes new Git commits since the last run, updating the fire data database.
+    Processes new Git commits since the last run, updating the fire data database at `db_path`.
+    Writes are buffered and committed every `batch_size` commits. Fires inactive for longer than
+    `eviction_horizon` seconds are not kept in memory (None keeps them all).
     """
-    conn = init_db()
+    conn = init_db(db_path)
     cursor = conn.cursor()
 
     try:
         repo = git.Repo(repo_path)
     except git.exc.InvalidGitRepositoryError:
         print(f"Error: Path '{repo_path}' is not a valid Git repository.")
-        conn.close()
+        close_db(conn)
         return
     except git.exc.NoSuchPathError:
         print(f"Error: Repository path '{repo_path}' does not exist.")
-        conn.close()
+        close_db(conn)
         return
 
     last_processed_hash = get_last_processed_commit_hash(cursor)
@@ -175,7 +456,7 @@ def process_repository_incrementally(repo_path, json_file_path_in_repo):
 
     if last_processed_hash == head_commit_hash:
         print(f"No new commits since last run (last processed: {last_processed_hash[:7]}). Database is up-to-date.")
-        conn.close()
+        close_db(conn)
         return
 
     commits_to_process = []
@@ -185,7 +466,7 @@ def process_repository_incrementally(repo_path, json_file_path_in_repo):
         # The range last_processed_hash..HEAD means "commits reachable from HEAD but not from last_processed_hash"
         # reverse=True gives oldest new commit first.
         try:
-            commits_to_process = list(repo.iter_commits(rev=f"{last_processed_hash}..{head_commit_hash}", reverse=True))
+            commits_to_process = list_commits(repo, f"{last_processed_hash}..{head_commit_hash}")
         except git.exc.GitCommandError as e:
             print(f"Error fetching commits: {e}. This might happen if last_processed_hash is no longer in main branch (e.g., due to a force push/rebase).")
             print("Consider resetting last_processed_commit_hash or running a full rebuild.")
@@ -204,11 +485,11 @@ def process_repository_incrementally(repo_path, json_file_path_in_repo):
                 print(f"Commit {last_processed_hash} not found. Repository history might have changed. Consider a full rebuild or resetting metadata.")
                 print("Attempting to process all commits instead (this will be slow if DB is large and not empty).")
                 last_processed_hash = None # Force full scan
-                commits_to_process = list(repo.iter_commits(reverse=True))
+                commits_to_process = list_commits(repo)
 
     if not last_processed_hash: # First run or forced full scan
         print("No last processed commit found or full scan forced. Processing all commits...")
-        commits_to_process = list(repo.iter_commits(reverse=True))
+        commits_to_process = list_commits(repo)
 
     if not commits_to_process:
         # This can happen if last_processed_hash was HEAD, or if the repo is empty
@@ -219,7 +500,7 @@ def process_repository_incrementally(repo_path, json_file_path_in_repo):
              print("No commits found in the repository.")
         else:
             print("No new commits to process.")
-        conn.close()
+        close_db(conn)
         return
 
     print(f"Found {len(commits_to_process)} new commits to process.")
@@ -229,176 +510,98 @@ def process_repository_incrementally(repo_path, json_file_path_in_repo):
     # This map will be updated *during* the processing of new commits.
     print("Loading current fire states from database (based on their last update)...")
     # This is our "snapshot" of the world *before* these new commits are applied.
-    # The values in this map are full fire data dicts.
-    in_memory_fire_states = load_current_fire_states_from_db(repo, conn, json_file_path_in_repo)
-    
+    # Compact states (see fire_state.py); the long inactive fires stay on disk until they show up again.
+    in_memory_fire_states = FireStateStore(conn.cursor(), eviction_horizon)
+    if in_memory_fire_states.load(last_processed_hash, commits_to_process[0][1]):
+        print(f"  Loaded {len(in_memory_fire_states)} fire states from the checkpoint.")
+    else:
+        # No checkpoint for the last processed commit (older database): rebuild it from git once
+        print("  No fire state checkpoint found, rebuilding it from the repository history.")
+        in_memory_fire_states.reset()
+        for fire_id, fire_data in load_current_fire_states_from_db(repo, conn, json_file_path_in_repo).items():
+            in_memory_fire_states.set(fire_id, fire_data, None)
+
+    if get_daily_stats_commit_hash(cursor) != last_processed_hash:
+        # The rollup doesn't match the fires table (older database, or an interrupted full rebuild)
+        print("  Daily rollup is not up to date, rebuilding it from the fires table.")
+        rebuild_daily_stats(cursor, last_processed_hash)
+    if get_fire_search_commit_hash(cursor) != last_processed_hash:
+        print("  Search index is not up to date, rebuilding it from the fires table.")
+        rebuild_fire_search(cursor, last_processed_hash)
+    if get_fire_geo_commit_hash(cursor) != last_processed_hash:
+        print("  Geospatial index is not up to date, rebuilding it from the fires table.")
+        rebuild_fire_geo(cursor, last_processed_hash, get_data_version(cursor))
+    indexed_update_rows = refresh_fire_intervals(cursor)
+    if indexed_update_rows:
+        print(f"  Activity interval index was behind, indexed {indexed_update_rows} fire_updates rows.")
+    refreshed_rollup_days = 0
+
     newest_commit_processed_in_this_run = None
 
-    for i, commit in enumerate(commits_to_process):
-        commit_hash = commit.hexsha
-        commit_dt_aware = commit.committed_datetime
-        if commit_dt_aware.tzinfo is None or commit_dt_aware.tzinfo.utcoffset(commit_dt_aware) is None:
-            commit_dt_aware = commit_dt_aware.replace(tzinfo=timezone.utc)
-        commit_timestamp = int(commit_dt_aware.timestamp())
-
-        print(f"\nProcessing new commit {i+1}/{len(commits_to_process)}: {commit_hash[:7]} ({commit.committed_datetime})")
-
-        json_content = get_file_content_at_commit(repo, commit_hash, json_file_path_in_repo)
-        current_commit_fires_map = parse_fire_data(json_content) # Fires present in THIS commit's JSON
-
-        if not json_content and not current_commit_fires_map:
-            print(f"  No valid fire data file '{json_file_path_in_repo}' in commit {commit_hash[:7]}.")
-            # Disappearance logic later will handle based on the final state of the batch.
-            pass
-
-        processed_fire_ids_in_this_commit = set()
-
-        # 1. Process fires present in the current commit's JSON
-        for fire_id, current_fire_data in current_commit_fires_map.items():
-            processed_fire_ids_in_this_commit.add(fire_id)
-            # This is the state of the fire *before this specific commit*
-            # (either from DB load, or from a previous commit in this batch)
-            previous_fire_data_for_comparison = in_memory_fire_states.get(fire_id)
-
-            update_log_entry = {
-                'fire_id': fire_id, 'commit_hash': commit_hash, 'commit_timestamp': commit_timestamp,
-                'data_timestamp': current_fire_data.get('updated', {}).get('sec') or \
-                                  current_fire_data.get('dateTime', {}).get('sec'),
-                'status': current_fire_data.get('status'), 'status_code': current_fire_data.get('statusCode'),
-                'man': current_fire_data.get('man'), 'terrain': current_fire_data.get('terrain'),
-                'aerial': current_fire_data.get('aerial'), 'meios_aquaticos': current_fire_data.get('meios_aquaticos'),
-                'active_in_commit': current_fire_data.get('active', False),
-                'raw_data': json.dumps(current_fire_data)
-            }
-
-            cursor.execute("SELECT 1 FROM fires WHERE fire_id = ?", (fire_id,))
-            fire_exists_in_db = cursor.fetchone()
-
-            if not fire_exists_in_db: # Truly new fire to the system
-                print(f"  NEW fire (to DB): {fire_id}")
-                cursor.execute('''
-                    INSERT INTO fires (fire_id, lat, lng, location, district, concelho, freguesia, natureza,
-                                     first_seen_commit_hash, first_seen_data_timestamp,
-                                     last_updated_commit_hash, last_updated_data_timestamp, is_currently_active)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (fire_id, current_fire_data.get('lat'), current_fire_data.get('lng'),
-                      current_fire_data.get('location'), current_fire_data.get('district'),
-                      current_fire_data.get('concelho'), current_fire_data.get('freguesia'),
-                      current_fire_data.get('natureza'), commit_hash,
-                      current_fire_data.get('dateTime', {}).get('sec'), commit_hash,
-                      current_fire_data.get('updated', {}).get('sec') or current_fire_data.get('dateTime', {}).get('sec'),
-                      current_fire_data.get('active', False)))
-                update_log_entry['change_type'] = 'NEW'
-            elif not previous_fire_data_for_comparison:
-                # Exists in DB, but not in our `in_memory_fire_states` (e.g. disappeared then reappeared)
-                # Or, more likely, it's the first time we see it in this *batch* of new commits.
-                # We treat this as an update if its DB state was different.
-                # The `compare_fire_data_are_different` needs a proper `previous_fire_data_for_comparison`.
-                # This case implies it appeared *within this batch* after not being in `load_current_fire_states_from_db`.
-                # This implies `fire_exists_in_db` should have been true, and `previous_fire_data_for_comparison`
-                # should have been loaded by `load_current_fire_states_from_db`.
-                # The only way `previous_fire_data_for_comparison` is None here, if `fire_exists_in_db` is True,
-                # is if `load_current_fire_states_from_db` failed to load it (e.g., file missing in its last_updated_commit).
-                # For safety, let's just treat it as if it's an update compared to a "null" previous state.
-                print(f"  REAPPEARED or new in batch: {fire_id}")
-                cursor.execute('''
-                    UPDATE fires SET lat=?, lng=?, location=?, district=?, concelho=?, freguesia=?, natureza=?,
-                                    last_updated_commit_hash=?, last_updated_data_timestamp=?, is_currently_active=?
-                    WHERE fire_id=?
-                ''', (current_fire_data.get('lat'), current_fire_data.get('lng'),
-                      current_fire_data.get('location'), current_fire_data.get('district'),
-                      current_fire_data.get('concelho'), current_fire_data.get('freguesia'),
-                      current_fire_data.get('natureza'), commit_hash,
-                      current_fire_data.get('updated', {}).get('sec') or current_fire_data.get('dateTime', {}).get('sec'),
-                      current_fire_data.get('active', False), fire_id))
-                update_log_entry['change_type'] = 'UPDATED' # Or 'REAPPEARED'
-            else: # Fire exists in DB and we have its previous state for comparison
-                if compare_fire_data_are_different(previous_fire_data_for_comparison, current_fire_data):
-                    print(f"  UPDATED fire: {fire_id}")
-                    cursor.execute('''
-                        UPDATE fires SET lat=?, lng=?, location=?, district=?, concelho=?, freguesia=?, natureza=?,
-                                        last_updated_commit_hash=?, last_updated_data_timestamp=?, is_currently_active=?
-                        WHERE fire_id=?
-                    ''', (current_fire_data.get('lat'), current_fire_data.get('lng'),
-                          current_fire_data.get('location'), current_fire_data.get('district'),
-                          current_fire_data.get('concelho'), current_fire_data.get('freguesia'),
-                          current_fire_data.get('natureza'), commit_hash,
-                          current_fire_data.get('updated', {}).get('sec') or current_fire_data.get('dateTime', {}).get('sec'),
-                          current_fire_data.get('active', False), fire_id))
-                    update_log_entry['change_type'] = 'UPDATED'
-                else: # UNCHANGED but present in this commit
-                    print(f"  UNCHANGED (still present) fire: {fire_id}")
-                    cursor.execute('''UPDATE fires SET last_updated_commit_hash=? WHERE fire_id=?''', (commit_hash, fire_id))
-                    # No fire_updates entry for "UNCHANGED" as per original logic.
-                    update_log_entry = None # Signal not to log this
-
-            if update_log_entry:
-                cursor.execute('''
-                    INSERT INTO fire_updates (fire_id, commit_hash, commit_timestamp, data_timestamp, status, status_code,
-                                            man, terrain, aerial, meios_aquaticos, active_in_commit, change_type, raw_data)
-                    VALUES (:fire_id, :commit_hash, :commit_timestamp, :data_timestamp, :status, :status_code,
-                            :man, :terrain, :aerial, :meios_aquaticos, :active_in_commit, :change_type, :raw_data)
-                ''', update_log_entry)
-
-            # Update the in-memory state for this fire to reflect this commit's data
-            in_memory_fire_states[fire_id] = current_fire_data
-        
-        # After processing all fires IN THIS COMMIT'S JSON:
-        # Check for fires that were in our `in_memory_fire_states` (active or not) but are NOT in `current_commit_fires_map`.
-        # These have "disappeared" *in this specific commit*.
-        # The final `is_currently_active` status in `fires` table will be determined by the *last commit in the batch*.
-        
-        # Disappearance within the batch (fire gone from one commit to the next *within this batch*)
-        fire_ids_in_memory_before_this_commit = set(in_memory_fire_states.keys())
-        disappeared_in_this_commit_ids = fire_ids_in_memory_before_this_commit - processed_fire_ids_in_this_commit
-
-        for fire_id in disappeared_in_this_commit_ids:
-            last_data_for_fire = in_memory_fire_states[fire_id] # This is its state from the *previous* commit (or DB load)
-            
-            # If it was considered active before this commit, and now it's gone from the JSON
-            if last_data_for_fire.get('active', False): # Check its 'active' status from *before* this commit
-                print(f"  DISAPPEARED (in this commit): {fire_id}")
-                # Update `fires` table. `is_currently_active` will be False.
-                # `last_updated_commit_hash` points to *this* commit where it was observed missing.
-                cursor.execute('''
-                    UPDATE fires SET is_currently_active = ?, last_updated_commit_hash = ?
-                    WHERE fire_id = ?
-                ''', (False, commit_hash, fire_id))
-
-                disappeared_log_entry = {
-                    'fire_id': fire_id, 'commit_hash': commit_hash, 'commit_timestamp': commit_timestamp,
-                    'data_timestamp': commit_timestamp, # Use commit time
-                    'status': "Disappeared from source", 'status_code': None,
-                    'man': last_data_for_fire.get('man'), 'terrain': last_data_for_fire.get('terrain'),
-                    'aerial': last_data_for_fire.get('aerial'), 'meios_aquaticos': last_data_for_fire.get('meios_aquaticos'),
-                    'active_in_commit': False, # Not in JSON, so not active in this commit
-                    'change_type': 'DISAPPEARED',
-                    'raw_data': json.dumps(last_data_for_fire) # Log its last known state
-                }
-                cursor.execute('''
-                    INSERT INTO fire_updates (fire_id, commit_hash, commit_timestamp, data_timestamp, status, status_code,
-                                            man, terrain, aerial, meios_aquaticos, active_in_commit, change_type, raw_data)
-                    VALUES (:fire_id, :commit_hash, :commit_timestamp, :data_timestamp, :status, :status_code,
-                            :man, :terrain, :aerial, :meios_aquaticos, :active_in_commit, :change_type, :raw_data)
-                ''', disappeared_log_entry)
-            
-            # Update in-memory state to reflect it's not active in this commit's view
-            if fire_id in in_memory_fire_states: # Should be true
-                in_memory_fire_states[fire_id]['active'] = False # Mark it as inactive in our live state tracker
-                # We don't remove it from in_memory_fire_states, as it might reappear in a later commit.
-
-        newest_commit_processed_in_this_run = commit # Keep track of the latest commit SHA from this batch
+    # All writes go through a buffered writer, flushed once per batch of commits
+    cursor.execute("SELECT fire_id FROM fires")
+    writer = FireWriter(cursor, {row[0] for row in cursor.fetchall()})
+    ingest_start = time.perf_counter()
+
+    # Parsed fire maps keyed by blob id, so snapshots that come back (e.g. reverts) aren't parsed again
+    snapshot_cache = SnapshotCache(make_snapshot_parser(json_parser))
+    unchanged_snapshot_commits = 0
+    previous_blob_oid = None
+    current_commit_fires_map = {}
+
+    # Every new commit's JSON is streamed through a single git process, oldest first
+    commit_blobs = iter_file_blobs(repo, commits_to_process, json_file_path_in_repo)
+    for i, (commit_hash, commit_timestamp, blob_oid, json_content) in enumerate(commit_blobs):
+        commit_datetime = datetime.fromtimestamp(commit_timestamp, timezone.utc)
+        print(f"\nProcessing new commit {i+1}/{len(commits_to_process)}: {commit_hash[:7]} ({commit_datetime})")
+
+        # The first commit of the run is always diffed: its baseline comes from the DB, not from a blob.
+        if i > 0 and blob_oid == previous_blob_oid:
+            # Same blob as the previous commit: every fire in it is unchanged and none can have
+            # disappeared, so skip the parse and diff and only confirm the fires still present.
+            print(f"  UNCHANGED snapshot ({blob_oid[:7] if blob_oid else 'missing'}), skipping diff.")
+            for fire_id in current_commit_fires_map:
+                writer.confirm_fire(fire_id, commit_hash)
+            unchanged_snapshot_commits += 1
+        else:
+            current_commit_fires_map = snapshot_cache.get(blob_oid, json_content) # Fires present in THIS commit's JSON
+
+            if not json_content and not current_commit_fires_map:
+                print(f"  No valid fire data file '{json_file_path_in_repo}' in commit {commit_hash[:7]}.")
+                # Disappearance logic later will handle based on the final state of the batch.
+                pass
+
+            change_counts = apply_snapshot(writer, in_memory_fire_states, commit_hash, commit_timestamp, current_commit_fires_map)
+            if change_counts['UNCHANGED']:
+                print(f"  UNCHANGED (still present): {change_counts['UNCHANGED']} fires")
+
+        newest_commit_processed_in_this_run = commit_hash # Keep track of the latest commit SHA from this batch
         
-        if (i + 1) % 20 == 0 or (i + 1) == len(commits_to_process): # Commit more frequently for smaller batches
-            conn.commit()
+        if (i + 1) % batch_size == 0 or (i + 1) == len(commits_to_process):
+            # Flush the batch and checkpoint the fire states touched so far in the same transaction as
+            # their events, so the next run (or a rerun after a crash) resumes from a consistent baseline.
+            refreshed_rollup_days += commit_ingest_batch(conn, writer, in_memory_fire_states, commit_hash, commit_timestamp)
             print(f"  -- Committed after processing commit {i+1}/{len(commits_to_process)} --")
 
+        previous_blob_oid = blob_oid
+
     # After processing all new commits in the batch:
     if newest_commit_processed_in_this_run:
-        update_last_processed_commit_hash(cursor, newest_commit_processed_in_this_run.hexsha)
+        update_last_processed_commit_hash(cursor, newest_commit_processed_in_this_run)
         conn.commit()
+        ingest_seconds = time.perf_counter() - ingest_start
         print(f"\nSuccessfully processed {len(commits_to_process)} commits.")
-        print(f"Database updated. Last processed commit is now: {newest_commit_processed_in_this_run.hexsha[:7]}")
+        print(f"Skipped the diff for {unchanged_snapshot_commits} commits with an unchanged snapshot "
+              f"(parsed snapshot cache: {snapshot_cache.hits} hits, {snapshot_cache.misses} misses).")
+        print(f"Wrote {writer.rows_written} rows in {ingest_seconds:.2f}s "
+              f"({writer.rows_written / max(ingest_seconds, 1e-9):.0f} rows/s, {writer.flush_seconds:.2f}s flushing).")
+        print(f"Presence of unchanged fires confirmed {writer.confirmations_requested} times "
+              f"with {writer.confirmations_written} row writes.")
+        print(f"Recomputed {refreshed_rollup_days} days of the daily rollup.")
+        print(f"Logged {writer.history.keyframes} keyframes and {writer.history.deltas} field deltas.")
+        print(f"Fire states: {len(in_memory_fire_states)} in memory, {in_memory_fire_states.evictions} evicted, "
+              f"{in_memory_fire_states.disk_loads} read back from disk.")
+        print(f"Database updated. Last processed commit is now: {newest_commit_processed_in_this_run[:7]}")
     else:
         # This case should ideally be caught earlier if commits_to_process was empty
         print("\nNo new commits were actually processed in this run.")
@@ -415,13 +618,24 @@ def process_repository_incrementally(repo_path, json_file_path_in_repo):
              print(f"Initial scan complete. Repository HEAD is {head_commit_hash[:7]}.")
 
 
-    conn.close()
-    print(f"Processing complete. Database '{DB_NAME}' is updated.")
+    close_db(conn)
+    print(f"Processing complete. Database '{db_path}' is updated.")
 
 if __name__ == "__main__":
     # Ensure the target JSON file exists, at least in the latest commit, for a meaningful run.
-    # Example: process_repository_incrementally("./path/to/your/git/repo", "data/fogos.json")
-    process_repository_incrementally("../", "fogos.json")
+    # Example: python bd_manager.py ./path/to/your/git/repo data/fogos.json
+    parser = argparse.ArgumentParser(description="Processes the git commits added since the last run into the fires database.")
+    parser.add_argument("repo_path", nargs="?", default="../", help="Path of the git repository (default: ../)")
+    parser.add_argument("json_file", nargs="?", default="fogos.json", help="Path of the JSON file inside the repository (default: fogos.json)")
+    parser.add_argument("--batch-size", type=int, default=20, help="Commits written per transaction (default: 20)")
+    parser.add_argument("--json-parser", choices=('auto',) + SNAPSHOT_PARSERS,
+                        help="Snapshot JSON parser (default: FIRES_JSON_PARSER, else the fastest installed)")
+    parser.add_argument("--evict-after-days", type=float, default=DEFAULT_EVICTION_HORIZON / 86400,
+                        help="Days an inactive fire stays in memory after it was last seen, 0 to keep every fire "
+                             f"(default: {DEFAULT_EVICTION_HORIZON // 86400:.0f})")
+    args = parser.parse_args()
+    process_repository_incrementally(args.repo_path, args.json_file, batch_size=args.batch_size, json_parser=args.json_parser,
+                                     eviction_horizon=args.evict_after_days * 86400 or None)
     # To test a full rebuild scenario (e.g., after a schema change or messy history):
     # 1. Delete fires.sqlite (or just the 'last_processed_commit_hash' from script_metadata)
     # 2. Run the script. It will process all commits.
\ No newline at end of file
@@ -0,0 +1,183 @@
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+from daily_stats import rebuild_daily_stats
+from fire_search import rebuild_fire_search
+from fire_geo import rebuild_fire_geo
+from fire_intervals import rebuild_fire_intervals
+from resource_series import rebuild_resource_rollup
+
+# --- API Latency Benchmark ---
+# Times every /api/fires/* endpoint through Flask's test client against a database of the
+# given size (a synthetic one by default), so changes to the query layer can be compared.
+# Usage: python benchmark_api.py [--db fires.sqlite] [--fires 50000] [--requests 50]
+
+DISTRICTS = ['Aveiro', 'Beja', 'Braga', 'Bragança', 'Castelo Branco', 'Coimbra', 'Évora', 'Faro', 'Guarda',
+             'Leiria', 'Lisboa', 'Portalegre', 'Porto', 'Santarém', 'Setúbal', 'Viana do Castelo', 'Vila Real', 'Viseu']
+NATUREZAS = ['Mato', 'Povoamento', 'Agrícola', 'Consolidação de Rescaldo', 'Queima']
+FREGUESIAS = ['São José', 'São João', 'Santa Maria', 'Sé', 'Nossa Senhora da Conceição', 'Santo António', 'Alvalade', 'Cedofeita']
+
+def create_synthetic_db(db_path, fire_count, updates_per_fire=4, seed=42):
+    """Creates a fires.sqlite-shaped database with `fire_count` random fires spread over two years."""
+    import bd_manager
+    conn = bd_manager.init_db(db_path)
+    rng = random.Random(seed)
+    start = int(time.mktime((2023, 1, 1, 0, 0, 0, 0, 0, -1)))
+    fires, updates = [], []
+    for n in range(fire_count):
+        fire_id = str(2023000000 + n)
+        first_seen = start + rng.randrange(2 * 365 * 86400)
+        duration = int(rng.expovariate(1 / 7200))
+        commit_hash = f"{n:040x}"
+        district = rng.choice(DISTRICTS)
+        fires.append((fire_id, 37 + rng.random() * 5, -9 + rng.random() * 3, f"Local {n}", district,
+                      f"Concelho {n % 300}", f"{rng.choice(FREGUESIAS)} {n % 100}", rng.choice(NATUREZAS),
+                      commit_hash, first_seen, commit_hash, first_seen + duration, 0))
+        for k in range(updates_per_fire):
+            change_type = 'NEW' if k == 0 else ('DISAPPEARED' if k == updates_per_fire - 1 else 'UPDATED')
+            timestamp = first_seen + duration * k // max(updates_per_fire - 1, 1)
+            updates.append((fire_id, commit_hash, timestamp, timestamp, 'Em Curso', 5, rng.randrange(80),
+                            rng.randrange(25), rng.randrange(4), 0, change_type != 'DISAPPEARED', change_type, '{}'))
+    conn.executemany('INSERT INTO fires VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', fires)
+    conn.executemany('''
+        INSERT INTO fire_updates (fire_id, commit_hash, commit_timestamp, data_timestamp, status, status_code,
+                                  man, terrain, aerial, meios_aquaticos, active_in_commit, change_type, raw_data)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', updates)
+    # The ingest keeps the derived tables up to date; here they are built once from the rows above
+    cursor = conn.cursor()
+    rebuild_daily_stats(cursor, None)
+    rebuild_fire_search(cursor, None)
+    rebuild_fire_geo(cursor, None, bd_manager.get_data_version(cursor))
+    rebuild_fire_intervals(cursor)
+    rebuild_resource_rollup(cursor, max(update[2] for update in updates))
+    conn.commit()
+    bd_manager.close_db(conn)
+
+def endpoint_urls(from_ms, to_ms, deep_cursor):
+    dates = f"fromDate={from_ms}&toDate={to_ms}"
+    return [
+        '/api/fires',
+        f'/api/fires?cursor={deep_cursor}',
+        '/api/fires?search_term=sao%20jose',
+        f'/api/fires/months?{dates}',
+        f'/api/fires/total?{dates}',
+        f'/api/fires/most-affected-district?{dates}',
+        f'/api/fires/count-per-district?{dates}',
+        f'/api/fires/duration-histogram?{dates}',
+        f'/api/fires/duration-stats?{dates}',
+        f'/api/fires/worst-day-stats?{dates}',
+        '/api/fires/available-date-range',
+    ]
+
+def time_endpoints(client, urls, requests):
+    """Returns {url: [latency in ms, ...]} after one warm-up request per url."""
+    latencies = {}
+    for url in urls:
+        client.get(url)
+        samples = []
+        for _ in range(requests):
+            start = time.perf_counter()
+            response = client.get(url)
+            samples.append((time.perf_counter() - start) * 1000)
+            assert response.status_code in (200, 304), f"{url} returned {response.status_code}"
+        latencies[url] = samples
+    return latencies
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+def per_request_engine_session():
+    # How server.getDBSession worked before the shared engine: a new engine for every request
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    import server
+    return sessionmaker(bind=create_engine(f'sqlite:///{server.DB_PATH}'))()
+
+def legacy_worst_day_stats(session, from_ts, to_ts):
+    # How /api/fires/worst-day-stats worked before the daily rollup: four queries over fires and
+    # fire_updates, three of them filtering on strftime() of every row
+    from sqlalchemy import func
+    from server import Fire, FireUpdate
+    day = func.strftime('%Y-%m-%d', func.datetime(Fire.first_seen_data_timestamp, 'unixepoch'))
+    worst_day = session.query(day.label('day'), func.count(Fire.fire_id).label('count')).filter(
+        Fire.first_seen_data_timestamp >= from_ts, Fire.first_seen_data_timestamp <= to_ts
+    ).group_by('day').order_by(func.count(Fire.fire_id).desc()).first()
+    session.query(func.sum(func.coalesce(FireUpdate.man, 0)), func.sum(func.coalesce(FireUpdate.terrain, 0)),
+                  func.sum(func.coalesce(FireUpdate.aerial, 0))).join(Fire, Fire.fire_id == FireUpdate.fire_id).filter(
+        day == worst_day.day).first()
+    session.query(Fire.fire_id, func.max(Fire.last_updated_data_timestamp - Fire.first_seen_data_timestamp)).filter(
+        day == worst_day.day).first()
+    session.query(Fire.district).filter(day == worst_day.day).distinct().all()
+
+def time_legacy_worst_day(from_ts, to_ts, requests):
+    import server
+    samples = []
+    for n in range(requests + 1):
+        session = server.getDBSession()
+        start = time.perf_counter()
+        legacy_worst_day_stats(session, from_ts, to_ts)
+        if n: # The first run is a warm-up
+            samples.append((time.perf_counter() - start) * 1000)
+        session.close()
+    return samples
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the latency of the fires API endpoints.")
+    parser.add_argument("--db", help="Existing database to benchmark (default: a synthetic one)")
+    parser.add_argument("--fires", type=int, default=50000, help="Fires in the synthetic database (default: 50000)")
+    parser.add_argument("--requests", type=int, default=50, help="Timed requests per endpoint (default: 50)")
+    parser.add_argument("--compare-per-request-engine", action="store_true",
+                        help="Also time the endpoints with a new SQLAlchemy engine per request (the old behaviour)")
+    parser.add_argument("--compare-response-cache", action="store_true",
+                        help="Also time the endpoints with the response cache enabled (disabled otherwise)")
+    parser.add_argument("--compare-worst-day", action="store_true",
+                        help="Also time the four-query worst-day-stats plan used before the daily rollup")
+    args = parser.parse_args()
+
+    db_path = args.db
+    if not db_path:
+        db_path = os.path.join(tempfile.mkdtemp(), 'fires.sqlite')
+        print(f"Creating a synthetic database with {args.fires} fires in {db_path}...")
+        create_synthetic_db(db_path, args.fires)
+    os.environ['FIRES_DB_PATH'] = db_path
+
+    import server
+    client = server.app.test_client()
+    with sqlite3.connect(db_path) as conn:
+        min_ts, max_ts = conn.execute("SELECT MIN(first_seen_data_timestamp), MAX(first_seen_data_timestamp) FROM fires").fetchone()
+        # Cursor of one of the last pages
+        deep_cursor = conn.execute("SELECT fire_id FROM fires ORDER BY fire_id DESC LIMIT 1 OFFSET 50").fetchone()[0]
+    urls = endpoint_urls(min_ts * 1000, max_ts * 1000, deep_cursor)
+
+    # (label, session factory, response cache size)
+    runs = [('shared engine', server.getDBSession, 0)]
+    if args.compare_per_request_engine:
+        runs.append(('engine per request', per_request_engine_session, 0))
+    if args.compare_response_cache:
+        runs.append(('response cache', server.getDBSession, server.RESPONSE_CACHE_SIZE or 256))
+
+    results = {}
+    for label, session_factory, response_cache_size in runs:
+        server.getDBSession = session_factory
+        server.RESPONSE_CACHE_SIZE = response_cache_size
+        results[label] = time_endpoints(client, urls, args.requests)
+
+    print(f"\n{'endpoint':<45}" + ''.join(f"{label + ' p50/p99 ms':>34}" for label, _, _ in runs))
+    for url in urls:
+        row = f"{url if url.startswith('/api/fires?') else url.split('?')[0]:<45}"
+        for label, _, _ in runs:
+            samples = results[label][url]
+            row += f"{percentile(samples, 0.5):>24.2f} / {percentile(samples, 0.99):>7.2f}"
+        print(row)
+
+    if args.compare_worst_day:
+        samples = time_legacy_worst_day(min_ts, max_ts, args.requests)
+        print(f"{'worst-day-stats, four-query plan':<45}{percentile(samples, 0.5):>24.2f} / {percentile(samples, 0.99):>7.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+from db_metadata import chunked, get_metadata, set_metadata
+
+# --- Daily Rollups ---
+# The dashboard endpoints (fires per month/district/day, worst day) used to aggregate the whole
+# `fires` table on every request. `daily_district_stats` keeps those aggregates per first seen day
+# (UTC, as `fires.first_seen_day`) and district, so the API reads a table sized in days instead.
+# The ingest recomputes the days touched by each batch in the same transaction as the fire events;
+# `daily_stats_commit_hash` records the commit the rollup is up to date with.
+
+DAILY_STATS_COMMIT_KEY = 'daily_stats_commit_hash'
+
+def create_daily_stats_table(cursor):
+    """Creates the daily rollup table, if it doesn't exist."""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS daily_district_stats (
+        day TEXT,                  -- First seen day of the fires, 'YYYY-MM-DD' (UTC)
+        district TEXT,
+        fire_count INTEGER,
+        total_man INTEGER,         -- Resources summed over every fire_updates row of these fires
+        total_terrain INTEGER,
+        total_aerial INTEGER,
+        max_duration INTEGER,      -- Longest last_updated - first_seen data timestamp, in seconds
+        longest_fire_id TEXT,      -- Fire with that duration
+        -- peak_man, peak_terrain and peak_aerial are added by bd_manager.MIGRATIONS
+        PRIMARY KEY (day, district)
+    )
+    ''')
+    # Covers the count queries, which only need these columns
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_daily_district_stats_count ON daily_district_stats (day, district, fire_count)")
+
+def get_daily_stats_commit_hash(cursor):
+    """Returns the commit the rollup was last brought up to date with, or None."""
+    return get_metadata(cursor, DAILY_STATS_COMMIT_KEY)
+
+def _insert_daily_stats(cursor, day_condition='', parameters=()):
+    """Aggregates `fires` (and their `fire_updates`) for the days matching `day_condition` into the rollup."""
+    cursor.execute(f'''
+        INSERT INTO daily_district_stats (day, district, fire_count, total_man, total_terrain, total_aerial,
+                                          max_duration, longest_fire_id, peak_man, peak_terrain, peak_aerial)
+        SELECT day, district, COUNT(*), SUM(man), SUM(terrain), SUM(aerial), MAX(duration), fire_id,
+               SUM(peak_man), SUM(peak_terrain), SUM(peak_aerial)
+        FROM (
+            SELECT f.fire_id, f.first_seen_day AS day, f.district,
+                   f.last_updated_data_timestamp - f.first_seen_data_timestamp AS duration,
+                   SUM(COALESCE(u.man, 0)) AS man, SUM(COALESCE(u.terrain, 0)) AS terrain,
+                   SUM(COALESCE(u.aerial, 0)) AS aerial,
+                   MAX(COALESCE(u.man, 0)) AS peak_man, MAX(COALESCE(u.terrain, 0)) AS peak_terrain,
+                   MAX(COALESCE(u.aerial, 0)) AS peak_aerial
+            FROM fires f LEFT JOIN fire_updates u ON u.fire_id = f.fire_id
+            {day_condition}
+            GROUP BY f.fire_id
+        )
+        GROUP BY day, district
+    ''', parameters)
+
+def refresh_daily_stats(cursor, fire_ids, commit_hash):
+    """
+    Recomputes the rollup of every day with a fire in `fire_ids` (the fires written since the last
+    refresh) and records `commit_hash`. Does not commit: it belongs to the transaction of those writes.
+    Returns the number of days recomputed.
+    """
+    days = set()
+    for chunk in chunked(fire_ids):
+        cursor.execute(f"SELECT DISTINCT first_seen_day FROM fires WHERE fire_id IN ({', '.join('?' * len(chunk))})", chunk)
+        days.update(row[0] for row in cursor.fetchall())
+
+    refreshed_days = len(days)
+    if None in days:
+        # Fires without a first seen timestamp are kept in their own row
+        days.discard(None)
+        cursor.execute("DELETE FROM daily_district_stats WHERE day IS NULL")
+        _insert_daily_stats(cursor, "WHERE f.first_seen_day IS NULL")
+    for chunk in chunked(sorted(days)):
+        placeholders = ', '.join('?' * len(chunk))
+        cursor.execute(f"DELETE FROM daily_district_stats WHERE day IN ({placeholders})", chunk)
+        _insert_daily_stats(cursor, f"WHERE f.first_seen_day IN ({placeholders})", chunk)
+
+    set_metadata(cursor, DAILY_STATS_COMMIT_KEY, commit_hash)
+    return refreshed_days
+
+def rebuild_daily_stats(cursor, commit_hash):
+    """Recomputes the whole rollup from `fires` and records `commit_hash`. Does not commit."""
+    cursor.execute("DELETE FROM daily_district_stats")
+    _insert_daily_stats(cursor)
+    set_metadata(cursor, DAILY_STATS_COMMIT_KEY, commit_hash)
@@ -0,0 +1,28 @@
+# --- Shared Database Helpers ---
+# `script_metadata` holds the position of the ingest and of every derived table (the commit or the
+# fire_updates row each was last brought up to date with), and `IN (...)` queries over the fires of
+# a batch have to stay under SQLite's bound parameter limit. The ingest, the derived tables and the
+# API all do both, through these helpers.
+
+# SQLite's default limit on bound parameters is 999
+MAX_VARIABLES = 500
+
+def chunked(values, size=MAX_VARIABLES):
+    """Yields `values` as lists of at most `size` items, e.g. for the parameters of an `IN (...)`."""
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def get_metadata(cursor, key, default=None):
+    """Returns the script_metadata value of `key`, or `default` if it isn't set."""
+    cursor.execute("SELECT value FROM script_metadata WHERE key = ?", (key,))
+    row = cursor.fetchone()
+    return row[0] if row else default
+
+def set_metadata(cursor, key, value):
+    """Sets the script_metadata value of `key`. Does not commit."""
+    cursor.execute("INSERT OR REPLACE INTO script_metadata (key, value) VALUES (?, ?)", (key, value))
+
+def delete_metadata(cursor, *keys):
+    """Removes `keys` from script_metadata. Does not commit."""
+    cursor.execute(f"DELETE FROM script_metadata WHERE key IN ({', '.join('?' * len(keys))})", keys)
@@ -0,0 +1,120 @@
+import math
+import numpy as np
+from db_metadata import chunked, get_metadata, set_metadata
+
+# --- Fire Geospatial Index ---
+# `fires_geo` is an R*Tree over the position of each fire, used by the map endpoints
+# (/api/fires/bbox, /api/fires/near) instead of reading every fire. Its rowids are the stable
+# integer keys of `fire_search_ids` (see fire_search.py) and it carries the fire_id as an auxiliary
+# column. Like the search index, it is kept up to date by the ingest with the fires written in each
+# batch, and `fire_geo_commit_hash` records the commit it matches. The R*Tree stores 32-bit floats
+# rounded outwards, so queries still test the exact lat/lng of the fires table.
+# Map clients ask for a viewport at a zoom level: the fires in it are clustered on a grid of
+# CLUSTER_RADIUS_PX pixels anchored at the Web Mercator origin, so clusters don't move while panning.
+
+FIRE_GEO_COMMIT_KEY = 'fire_geo_commit_hash'
+TILE_SIZE = 256 # Pixels per side of a Web Mercator tile
+CLUSTER_RADIUS_PX = 60
+EARTH_RADIUS_KM = 6371.0088
+MAX_MERCATOR_LAT = 85.05112878
+
+_VALID_POSITION = "f.lat BETWEEN -90 AND 90 AND f.lng BETWEEN -180 AND 180"
+
+# Each fire is a point: min and max are equal. `data_version` is the data version of the ingest
+# transaction that last (re-)indexed the fire: map tiles compare it to notice when their fires changed.
+FIRES_GEO_SCHEMA = '''
+    CREATE VIRTUAL TABLE IF NOT EXISTS fires_geo USING rtree(
+        geo_rowid,
+        min_lat, max_lat,
+        min_lng, max_lng,
+        +fire_id,
+        +data_version
+    )
+'''
+
+def create_fire_geo_table(cursor):
+    """Creates the R*Tree of the fire positions, if it doesn't exist. Needs `fire_search_ids`."""
+    cursor.execute(FIRES_GEO_SCHEMA)
+
+def get_fire_geo_commit_hash(cursor):
+    """Returns the commit the geospatial index was last brought up to date with, or None."""
+    return get_metadata(cursor, FIRE_GEO_COMMIT_KEY)
+
+def _index_fires(cursor, data_version, fire_condition='', parameters=()):
+    """(Re-)indexes the fires matching `fire_condition`; fires without a valid position are left out."""
+    cursor.execute(f"INSERT OR IGNORE INTO fire_search_ids (fire_id) SELECT fire_id FROM fires f {fire_condition}",
+                   parameters)
+    cursor.execute(f'''
+        DELETE FROM fires_geo WHERE geo_rowid IN (
+            SELECT ids.search_rowid FROM fires f JOIN fire_search_ids ids ON ids.fire_id = f.fire_id {fire_condition}
+        )
+    ''', parameters)
+    cursor.execute(f'''
+        INSERT INTO fires_geo (geo_rowid, min_lat, max_lat, min_lng, max_lng, fire_id, data_version)
+        SELECT ids.search_rowid, f.lat, f.lat, f.lng, f.lng, f.fire_id, ?
+        FROM fires f JOIN fire_search_ids ids ON ids.fire_id = f.fire_id
+        {fire_condition} {'AND' if fire_condition else 'WHERE'} {_VALID_POSITION}
+    ''', (data_version, *parameters))
+
+def refresh_fire_geo(cursor, fire_ids, commit_hash, data_version):
+    """
+    Re-indexes `fire_ids` (the fires written since the last refresh) at `data_version` and records
+    `commit_hash`. Does not commit: it belongs to the transaction of those writes.
+    """
+    for chunk in chunked(fire_ids):
+        _index_fires(cursor, data_version, f"WHERE f.fire_id IN ({', '.join('?' * len(chunk))})", chunk)
+    set_metadata(cursor, FIRE_GEO_COMMIT_KEY, commit_hash)
+
+def rebuild_fire_geo(cursor, commit_hash, data_version):
+    """Re-indexes every fire at `data_version` and records `commit_hash`. Does not commit."""
+    cursor.execute("DELETE FROM fires_geo")
+    _index_fires(cursor, data_version)
+    set_metadata(cursor, FIRE_GEO_COMMIT_KEY, commit_hash)
+
+# --- Distances and Clustering ---
+
+def bounding_box(lat, lng, radius_km):
+    """(west, south, east, north) of a box containing every point within `radius_km` of (lat, lng)."""
+    lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+    south, north = max(lat - lat_delta, -90.0), min(lat + lat_delta, 90.0)
+    if south <= -90.0 or north >= 90.0:
+        return -180.0, south, 180.0, north # Contains a pole: every longitude
+    lng_delta = math.degrees(math.asin(min(1.0, math.sin(radius_km / EARTH_RADIUS_KM) / math.cos(math.radians(lat)))))
+    return max(lng - lng_delta, -180.0), south, min(lng + lng_delta, 180.0), north
+
+def distances_km(lat, lng, lats, lngs):
+    """Great-circle (haversine) distances from (lat, lng) to each of the points, in km."""
+    lat1, lng1 = math.radians(lat), math.radians(lng)
+    lats, lngs = np.radians(np.asarray(lats, dtype=np.float64)), np.radians(np.asarray(lngs, dtype=np.float64))
+    a = np.sin((lats - lat1) / 2) ** 2 + math.cos(lat1) * np.cos(lats) * np.sin((lngs - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+def mercator_position(lats, lngs):
+    """Web Mercator position of each point as a fraction of the world map, (x, y) with y downwards."""
+    x = (np.asarray(lngs, dtype=np.float64) + 180) / 360
+    sin_lat = np.sin(np.radians(np.clip(np.asarray(lats, dtype=np.float64), -MAX_MERCATOR_LAT, MAX_MERCATOR_LAT)))
+    y = 0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * math.pi)
+    return x, y
+
+def cluster_points(lats, lngs, zoom, radius_px=CLUSTER_RADIUS_PX):
+    """
+    Groups the points by `radius_px` grid cell at `zoom`. Returns one (indices of the points,
+    mean lat, mean lng, (west, south, east, north)) tuple per non-empty cell.
+    """
+    lats, lngs = np.asarray(lats, dtype=np.float64), np.asarray(lngs, dtype=np.float64)
+    if not len(lats):
+        return []
+    cells_per_side = max(1, int(TILE_SIZE * 2 ** zoom / radius_px))
+    x, y = mercator_position(lats, lngs)
+    cell_x = np.clip(np.floor(x * cells_per_side), 0, cells_per_side - 1).astype(np.int64)
+    cell_y = np.clip(np.floor(y * cells_per_side), 0, cells_per_side - 1).astype(np.int64)
+    _, labels, counts = np.unique(cell_y * cells_per_side + cell_x, return_inverse=True, return_counts=True)
+    order = np.argsort(labels, kind='stable')
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    sorted_lats, sorted_lngs = lats[order], lngs[order]
+    mean_lats = np.add.reduceat(sorted_lats, starts) / counts
+    mean_lngs = np.add.reduceat(sorted_lngs, starts) / counts
+    bounds = np.stack([np.minimum.reduceat(sorted_lngs, starts), np.minimum.reduceat(sorted_lats, starts),
+                       np.maximum.reduceat(sorted_lngs, starts), np.maximum.reduceat(sorted_lats, starts)], axis=1)
+    return [(order[start:start + count], float(mean_lat), float(mean_lng), tuple(float(value) for value in cell_bounds))
+            for start, count, mean_lat, mean_lng, cell_bounds in zip(starts, counts, mean_lats, mean_lngs, bounds)]
@@ -0,0 +1,204 @@
+import json
+from raw_payloads import load_raw_payloads
+from db_metadata import get_metadata, set_metadata
+
+# --- Delta-Encoded Fire History ---
+# Every fire_updates row used to carry a full snapshot of the fire. Now each row records the fields
+# that changed since the fire's previous row in `fire_update_deltas` (field, old and new JSON value).
+# Only NEW rows and every KEYFRAME_INTERVAL-th row of a fire keep a full snapshot
+# (`raw_payload_id`). The state of a fire at any update is rebuilt from the nearest keyframe before
+# it plus the deltas in between, and "when did field X of fire Y change" reads only the deltas.
+# Rows written before this (full snapshot in raw_payload_id or raw_data) are keyframes;
+# `backfill_fire_deltas` derives their deltas once.
+
+KEYFRAME_INTERVAL = 16 # A fire's state is never more than this many deltas away from a keyframe
+FIRE_DELTAS_BACKFILL_KEY = 'fire_deltas_backfilled'
+
+def create_fire_history_table(cursor):
+    """Creates the field delta table, if it doesn't exist."""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS fire_update_deltas (
+        fire_id TEXT,
+        field TEXT,                -- Top-level key of the fire's JSON
+        update_id INTEGER,         -- fire_updates row that made the change
+        old_value TEXT,            -- JSON of the value before the update, NULL if the key was absent
+        new_value TEXT,            -- JSON of the value after the update, NULL if the key was removed
+        PRIMARY KEY (fire_id, field, update_id)
+    ) WITHOUT ROWID
+    ''')
+    # Reconstruction reads a fire's deltas by update_id, whatever the field
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_fire_update_deltas_update ON fire_update_deltas (fire_id, update_id)")
+
+_MISSING = object()
+
+def _encode_value(value):
+    return json.dumps(value, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+def diff_fire_data(old_data, new_data):
+    """Returns the (field, old JSON, new JSON) of every top-level key that differs; absent keys are None."""
+    deltas = []
+    for field in sorted(old_data.keys() | new_data.keys()):
+        old_value, new_value = old_data.get(field, _MISSING), new_data.get(field, _MISSING)
+        if old_value != new_value:
+            deltas.append((field,
+                           None if old_value is _MISSING else _encode_value(old_value),
+                           None if new_value is _MISSING else _encode_value(new_value)))
+    return deltas
+
+def _load_keyframe(cursor, fire_id, update_id=None):
+    """Returns (keyframe update_id, fire data) of the last keyframe at or before `update_id` (or the latest), or None."""
+    cursor.execute(f'''
+        SELECT update_id, raw_payload_id, raw_data FROM fire_updates
+        WHERE fire_id = ? AND (raw_payload_id IS NOT NULL OR raw_data IS NOT NULL)
+        {'AND update_id <= ?' if update_id is not None else ''}
+        ORDER BY update_id DESC LIMIT 1
+    ''', (fire_id,) if update_id is None else (fire_id, update_id))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    keyframe_update_id, raw_payload_id, raw_data = row
+    if raw_payload_id is None:
+        return keyframe_update_id, json.loads(raw_data) # Not moved to the payload store yet
+    return keyframe_update_id, load_raw_payloads(cursor, [raw_payload_id])[raw_payload_id]
+
+def reconstruct_fire_state(cursor, fire_id, update_id=None):
+    """
+    Returns (update_id, fire data, rows since the keyframe) for the fire as logged by its last update
+    at or before `update_id` (or its latest update), or None if it has none.
+    """
+    keyframe = _load_keyframe(cursor, fire_id, update_id)
+    if keyframe is None:
+        return None
+    keyframe_update_id, fire_data = keyframe
+    update_range = "fire_id = ? AND update_id > ?" + (" AND update_id <= ?" if update_id is not None else "")
+    parameters = (fire_id, keyframe_update_id) + ((update_id,) if update_id is not None else ())
+    cursor.execute(f"SELECT field, new_value FROM fire_update_deltas WHERE {update_range} ORDER BY update_id",
+                   parameters)
+    for field, new_value in cursor.fetchall():
+        if new_value is None:
+            fire_data.pop(field, None)
+        else:
+            fire_data[field] = json.loads(new_value)
+    # Updates that changed nothing still count towards the next keyframe
+    cursor.execute(f"SELECT COUNT(*), MAX(update_id) FROM fire_updates WHERE {update_range}", parameters)
+    updates_since_keyframe, last_row_update_id = cursor.fetchone()
+    return last_row_update_id or keyframe_update_id, fire_data, updates_since_keyframe
+
+def replay_fire_states(cursor, fire_id, update_ids):
+    """
+    Returns the fire data logged by each of `update_ids`, ascending rows of one fire, rebuilding
+    from a keyframe once and then applying the deltas in between (every row but NEW has its deltas).
+    """
+    reconstructed = reconstruct_fire_state(cursor, fire_id, update_ids[0])
+    if reconstructed is None:
+        return [None] * len(update_ids)
+    fire_data = reconstructed[1]
+    states = [dict(fire_data)]
+    if len(update_ids) == 1:
+        return states
+    cursor.execute('''
+        SELECT update_id, field, new_value FROM fire_update_deltas
+        WHERE fire_id = ? AND update_id > ? AND update_id <= ?
+        ORDER BY update_id
+    ''', (fire_id, update_ids[0], update_ids[-1]))
+    deltas = cursor.fetchall()
+    position = 0
+    for update_id in update_ids[1:]:
+        while position < len(deltas) and deltas[position][0] <= update_id:
+            _, field, new_value = deltas[position]
+            if new_value is None:
+                fire_data.pop(field, None)
+            else:
+                fire_data[field] = json.loads(new_value)
+            position += 1
+        states.append(dict(fire_data))
+    return states
+
+def get_field_changes(cursor, fire_id, field=None):
+    """Returns the changes of a fire's fields (or of one field), oldest first, with their update's commit."""
+    cursor.execute(f'''
+        SELECT d.update_id, u.commit_hash, u.commit_timestamp, u.change_type, d.field, d.old_value, d.new_value
+        FROM fire_update_deltas d JOIN fire_updates u ON u.update_id = d.update_id
+        WHERE d.fire_id = ? {'AND d.field = ?' if field is not None else ''}
+        ORDER BY d.update_id, d.field
+    ''', (fire_id,) if field is None else (fire_id, field))
+    return [{
+        'update_id': update_id, 'commit_hash': commit_hash, 'commit_timestamp': commit_timestamp,
+        'change_type': change_type, 'field': field_name,
+        'old_value': None if old_value is None else json.loads(old_value),
+        'new_value': None if new_value is None else json.loads(new_value),
+    } for update_id, commit_hash, commit_timestamp, change_type, field_name, old_value, new_value in cursor.fetchall()]
+
+class FireHistoryEncoder:
+    """
+    Decides, for each fire_updates row written by the ingest, whether it is a keyframe and which
+    field deltas it records. Keeps the last logged state of each fire; a fire logged before this
+    encoder was created is reconstructed from the database the first time it is logged again.
+    """
+
+    def __init__(self, keyframe_interval=KEYFRAME_INTERVAL):
+        self.keyframe_interval = keyframe_interval
+        self.last_logged = {} # fire_id -> (fire data of its last row, rows since its last keyframe)
+        self.keyframes = 0
+        self.deltas = 0
+
+    def encode(self, cursor, fire_id, fire_data, change_type):
+        """Returns (is_keyframe, deltas) for a new row logging `fire_data`. Must be called in row order."""
+        previous = self.last_logged.get(fire_id)
+        if previous is None and change_type != 'NEW':
+            reconstructed = reconstruct_fire_state(cursor, fire_id)
+            if reconstructed is not None:
+                _, previous_data, updates_since_keyframe = reconstructed
+                previous = (previous_data, updates_since_keyframe)
+
+        if previous is None:
+            is_keyframe, deltas, updates_since_keyframe = True, [], 0
+        else:
+            previous_data, updates_since_keyframe = previous
+            deltas = diff_fire_data(previous_data, fire_data)
+            is_keyframe = updates_since_keyframe + 1 >= self.keyframe_interval
+            updates_since_keyframe = 0 if is_keyframe else updates_since_keyframe + 1
+        self.last_logged[fire_id] = (fire_data, updates_since_keyframe)
+        self.keyframes += is_keyframe
+        self.deltas += len(deltas)
+        return is_keyframe, deltas
+
+    def forget(self, fire_ids):
+        """Drops the last logged state of `fire_ids` (e.g. evicted fires), reconstructed again if they are logged."""
+        for fire_id in fire_ids:
+            self.last_logged.pop(fire_id, None)
+
+def backfill_fire_deltas(conn):
+    """
+    Derives the field deltas of the rows logged before delta encoding, which all hold a full
+    snapshot, from consecutive snapshots of each fire. Runs once per database. Does not commit.
+    Returns the number of deltas written.
+    """
+    cursor = conn.cursor()
+    if get_metadata(cursor, FIRE_DELTAS_BACKFILL_KEY):
+        return 0
+    # Streamed fire by fire: the snapshots of the whole history don't fit in memory
+    rows = conn.execute("SELECT fire_id, update_id, raw_payload_id, raw_data FROM fire_updates ORDER BY fire_id, update_id")
+    deltas_written = 0
+    delta_rows = []
+    previous_fire_id, previous_data, previous_payload_id = None, None, None
+    for fire_id, update_id, raw_payload_id, raw_data in rows:
+        if raw_payload_id is not None:
+            if raw_payload_id != previous_payload_id or fire_id != previous_fire_id:
+                fire_data = load_raw_payloads(cursor, [raw_payload_id])[raw_payload_id]
+        elif raw_data is not None:
+            fire_data = json.loads(raw_data)
+        else:
+            continue # Already delta-encoded, its deltas were written with it
+        if fire_id == previous_fire_id:
+            delta_rows.extend((fire_id, field, update_id, old_value, new_value)
+                              for field, old_value, new_value in diff_fire_data(previous_data, fire_data))
+        previous_fire_id, previous_data, previous_payload_id = fire_id, fire_data, raw_payload_id
+        if len(delta_rows) >= 5000:
+            cursor.executemany("INSERT OR IGNORE INTO fire_update_deltas VALUES (?, ?, ?, ?, ?)", delta_rows)
+            deltas_written += len(delta_rows)
+            delta_rows = []
+    cursor.executemany("INSERT OR IGNORE INTO fire_update_deltas VALUES (?, ?, ?, ?, ?)", delta_rows)
+    deltas_written += len(delta_rows)
+    set_metadata(cursor, FIRE_DELTAS_BACKFILL_KEY, '1')
+    return deltas_written
@@ -0,0 +1,166 @@
+import numpy as np
+from db_metadata import get_metadata, set_metadata, delete_metadata
+
+# --- Fire Activity Intervals ---
+# "Which fires were active at time T" used to mean replaying fire_updates (or checking out the
+# commit). `fire_intervals` holds one [start, end) interval per fire_updates row that logged the
+# fire as active: it lasts from the row's commit until the fire's next row (an update, or its
+# disappearance), or is open (end NULL) while the row is the fire's last. Each interval carries the
+# status and resources logged by its row. The intervals are an R*Tree over (start, end), so both
+# "active at T" and "active during [from, to]" read only the matching intervals; the R*Tree stores
+# 32-bit floats rounded outwards, so the exact start_ts/end_ts auxiliary columns are tested too.
+# The index follows fire_updates by update_id (FIRE_INTERVALS_UPDATE_ID_KEY): the ingest extends it
+# with the rows of each batch, and a database without it catches up on the next ingest run.
+# Commit timestamps are not monotonic (a commit may be dated before its parent, a live snapshot
+# after the next commit): an interval ended by an earlier row is empty, [start, start), rather
+# than reversed, which the R*Tree rejects.
+
+FIRE_INTERVALS_UPDATE_ID_KEY = 'fire_intervals_update_id'
+OPEN_INTERVAL_END = 1e15 # R*Tree end of the open intervals
+_BATCH_SIZE = 5000
+
+def create_fire_intervals_table(cursor):
+    """Creates the activity interval index, if it doesn't exist."""
+    # Keyed by the update_id of the fire_updates row that started the interval
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS fire_intervals USING rtree(
+        update_id,
+        min_ts, max_ts,
+        +fire_id,
+        +start_ts,
+        +end_ts,
+        +status,
+        +status_code,
+        +man,
+        +terrain,
+        +aerial,
+        +meios_aquaticos
+    )
+    ''')
+
+def get_fire_intervals_update_id(cursor):
+    """Returns the last fire_updates row indexed, or None if the index was never built."""
+    update_id = get_metadata(cursor, FIRE_INTERVALS_UPDATE_ID_KEY)
+    return int(update_id) if update_id is not None else None
+
+def _insert_intervals(cursor, intervals):
+    cursor.executemany('''
+        INSERT INTO fire_intervals (update_id, min_ts, max_ts, fire_id, start_ts, end_ts, status, status_code,
+                                    man, terrain, aerial, meios_aquaticos)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', [(update_id, start_ts, OPEN_INTERVAL_END if end_ts is None else end_ts, fire_id, start_ts, end_ts, *logged)
+          for update_id, fire_id, start_ts, end_ts, logged in intervals])
+
+def refresh_fire_intervals(cursor):
+    """
+    Indexes the fire_updates rows written since the last refresh (all of them the first time),
+    closing the open interval of each fire they update. Does not commit: it belongs to the
+    transaction of those rows. Returns the number of rows indexed.
+    """
+    after_update_id = get_fire_intervals_update_id(cursor) or 0
+    # Streamed fire by fire, on a cursor of its own: a first build reads the whole of fire_updates
+    rows = cursor.connection.execute('''
+        SELECT update_id, fire_id, commit_timestamp, active_in_commit,
+               status, status_code, man, terrain, aerial, meios_aquaticos
+        FROM fire_updates WHERE update_id > ?
+        ORDER BY fire_id, update_id
+    ''', (after_update_id,))
+    indexed_rows = 0
+    last_update_id = after_update_id
+    intervals = []
+    previous = None # The previous row of the same fire, whose interval the current row ends
+    for update_id, fire_id, commit_timestamp, active_in_commit, *logged in rows:
+        if previous is not None and previous[1] == fire_id:
+            if previous[3]:
+                intervals.append((previous[0], fire_id, previous[2], max(previous[2], commit_timestamp), previous[4]))
+        elif after_update_id:
+            # First new row of the fire: it ends the fire's open interval, if its last row was active
+            cursor.execute('''
+                UPDATE fire_intervals SET max_ts = MAX(start_ts, ?), end_ts = MAX(start_ts, ?)
+                WHERE update_id = (SELECT MAX(update_id) FROM fire_updates WHERE fire_id = ? AND update_id <= ?)
+                  AND end_ts IS NULL
+            ''', (commit_timestamp, commit_timestamp, fire_id, after_update_id))
+        if previous is not None and previous[1] != fire_id and previous[3]:
+            intervals.append((previous[0], previous[1], previous[2], None, previous[4]))
+        previous = (update_id, fire_id, commit_timestamp, active_in_commit, logged)
+        indexed_rows += 1
+        last_update_id = max(last_update_id, update_id)
+        if len(intervals) >= _BATCH_SIZE:
+            _insert_intervals(cursor, intervals)
+            intervals = []
+    if previous is not None and previous[3]:
+        intervals.append((previous[0], previous[1], previous[2], None, previous[4]))
+    _insert_intervals(cursor, intervals)
+    set_metadata(cursor, FIRE_INTERVALS_UPDATE_ID_KEY, str(last_update_id))
+    return indexed_rows
+
+def rebuild_fire_intervals(cursor):
+    """Rebuilds the index from all of fire_updates. Does not commit. Returns the number of rows indexed."""
+    cursor.execute("DELETE FROM fire_intervals")
+    delete_metadata(cursor, FIRE_INTERVALS_UPDATE_ID_KEY)
+    return refresh_fire_intervals(cursor)
+
+# --- Queries ---
+
+INTERVAL_COLUMNS = ('update_id', 'fire_id', 'start_ts', 'end_ts', 'status', 'status_code',
+                    'man', 'terrain', 'aerial', 'meios_aquaticos')
+RESOURCES = ('man', 'terrain', 'aerial', 'meios_aquaticos')
+
+def get_active_intervals(cursor, timestamp):
+    """Returns the intervals of the fires active at `timestamp` (seconds), as dicts."""
+    cursor.execute(f'''
+        SELECT {', '.join(INTERVAL_COLUMNS)} FROM fire_intervals
+        WHERE min_ts <= ? AND max_ts >= ?
+          AND start_ts <= ? AND (end_ts IS NULL OR end_ts > ?)
+        ORDER BY fire_id
+    ''', (timestamp, timestamp, timestamp, timestamp))
+    return [dict(zip(INTERVAL_COLUMNS, row)) for row in cursor.fetchall()]
+
+def sum_intervals(starts, ends, values, from_ts, to_ts):
+    """
+    Sweep line over intervals [starts, ends) (ends may be inf) carrying `values` (one row of counts
+    each: 1 for the fire, then its RESOURCES): returns (times, totals), the moments in [from_ts, to_ts] where the sum of the values of
+    the intervals active changes, the first being `from_ts`, and the sums from each of them on.
+    """
+    starts = np.maximum(np.asarray(starts, dtype=np.float64), from_ts)
+    ends = np.asarray(ends, dtype=np.float64)
+    values = np.asarray(values, dtype=np.int64).reshape(len(starts), len(RESOURCES) + 1)
+    # +values at each start, -values at each end within the range
+    ending = ends <= to_ts
+    times = np.concatenate([[from_ts], starts, ends[ending]])
+    deltas = np.vstack([np.zeros((1, values.shape[1]), dtype=np.int64), values, -values[ending]])
+    order = np.argsort(times, kind='stable')
+    times, totals = times[order], np.cumsum(deltas[order], axis=0)
+    # The totals once every change at the same moment is applied
+    last_of_moment = np.append(times[1:] != times[:-1], True)
+    return times[last_of_moment], totals[last_of_moment]
+
+def read_overlapping_intervals(cursor, from_ts, to_ts, columns):
+    """Returns (start_ts, end_ts, *columns) of the intervals overlapping [from_ts, to_ts]; f.* columns are of the fire."""
+    cursor.execute(f'''
+        SELECT i.start_ts, i.end_ts{''.join(', ' + column for column in columns)}
+        FROM fire_intervals i {'LEFT JOIN fires f ON f.fire_id = i.fire_id' if any(column.startswith('f.') for column in columns) else ''}
+        WHERE i.min_ts <= ? AND i.max_ts >= ?
+          AND i.start_ts <= ? AND (i.end_ts IS NULL OR i.end_ts > ?)
+    ''', (to_ts, from_ts, to_ts, from_ts))
+    return cursor.fetchall()
+
+def get_active_series(cursor, from_ts, to_ts):
+    """
+    Returns the number of active fires and the sum of their resources over [from_ts, to_ts], as
+    one dict per moment they changed (the first at `from_ts`), in one sweep over the intervals
+    that overlap the range.
+    """
+    rows = read_overlapping_intervals(cursor, from_ts, to_ts, tuple(f'i.{name}' for name in RESOURCES))
+    # Missing counts are logged as NULL: they deploy nothing
+    times, totals = sum_intervals([row[0] for row in rows], [np.inf if row[1] is None else row[1] for row in rows],
+                                  [[1] + [value or 0 for value in row[2:]] for row in rows], from_ts, to_ts)
+    series = []
+    previous_totals = None
+    for timestamp, moment_totals in zip(times.tolist(), totals.tolist()):
+        if moment_totals == previous_totals:
+            continue # A fire ended as another started
+        series.append(dict({'timestamp': int(timestamp), 'active_fires': moment_totals[0]},
+                           **dict(zip(RESOURCES, moment_totals[1:]))))
+        previous_totals = moment_totals
+    return series
@@ -0,0 +1,57 @@
+from db_metadata import chunked, get_metadata, set_metadata
+
+# --- Fire Search Index ---
+# `fires_search` is an FTS5 index over the place names and nature of each fire, used by the
+# /api/fires search instead of a LIKE scan. The unicode61 tokenizer with remove_diacritics folds
+# case and accents, so "sao joao" finds "São João". Its rowids come from `fire_search_ids`, which
+# gives every fire a stable integer key (`fires` only has its TEXT primary key), so a search only
+# reads rowids from the index. Like the daily rollup, it is kept up to date by the ingest with the
+# fires written in each batch, and `fire_search_commit_hash` records the commit it matches.
+
+FIRE_SEARCH_COMMIT_KEY = 'fire_search_commit_hash'
+FIRE_SEARCH_COLUMNS = ('location', 'concelho', 'freguesia', 'natureza')
+
+def create_fire_search_table(cursor):
+    """Creates the full-text index of the fires and its rowid mapping, if they don't exist."""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS fire_search_ids (
+        search_rowid INTEGER PRIMARY KEY,  -- rowid of the fire in fires_search
+        fire_id TEXT UNIQUE
+    )
+    ''')
+    cursor.execute(f'''
+    CREATE VIRTUAL TABLE IF NOT EXISTS fires_search USING fts5(
+        {', '.join(FIRE_SEARCH_COLUMNS)},
+        tokenize = 'unicode61 remove_diacritics 2'
+    )
+    ''')
+
+def get_fire_search_commit_hash(cursor):
+    """Returns the commit the search index was last brought up to date with, or None."""
+    return get_metadata(cursor, FIRE_SEARCH_COMMIT_KEY)
+
+def _index_fires(cursor, fire_condition='', parameters=()):
+    """(Re-)indexes the fires matching `fire_condition`."""
+    cursor.execute(f"INSERT OR IGNORE INTO fire_search_ids (fire_id) SELECT fire_id FROM fires f {fire_condition}",
+                   parameters)
+    cursor.execute(f'''
+        INSERT OR REPLACE INTO fires_search (rowid, {', '.join(FIRE_SEARCH_COLUMNS)})
+        SELECT ids.search_rowid, {', '.join('f.' + column for column in FIRE_SEARCH_COLUMNS)}
+        FROM fires f JOIN fire_search_ids ids ON ids.fire_id = f.fire_id
+        {fire_condition}
+    ''', parameters)
+
+def refresh_fire_search(cursor, fire_ids, commit_hash):
+    """
+    Re-indexes `fire_ids` (the fires written since the last refresh) and records `commit_hash`.
+    Does not commit: it belongs to the transaction of those writes.
+    """
+    for chunk in chunked(fire_ids):
+        _index_fires(cursor, f"WHERE f.fire_id IN ({', '.join('?' * len(chunk))})", chunk)
+    set_metadata(cursor, FIRE_SEARCH_COMMIT_KEY, commit_hash)
+
+def rebuild_fire_search(cursor, commit_hash):
+    """Re-indexes every fire and records `commit_hash`. Does not commit."""
+    cursor.execute("DELETE FROM fires_search")
+    _index_fires(cursor)
+    set_metadata(cursor, FIRE_SEARCH_COMMIT_KEY, commit_hash)
@@ -0,0 +1,177 @@
+import hashlib
+import json
+from db_metadata import get_metadata, set_metadata
+
+# --- Fire State Checkpoint ---
+# The ingest compares every fire against its last known full JSON. Instead of rebuilding that
+# baseline from git on each run, it is persisted in `fire_state` together with the commit it
+# corresponds to, in the same transaction as the fire events and `script_metadata`.
+
+FIRE_STATE_COMMIT_KEY = 'fire_state_commit_hash'
+_NO_CHECKPOINT = object() # The commit of the daemon's checkpoint is None
+
+def create_fire_state_table(cursor):
+    """Creates the table holding the last known JSON of each fire, if it doesn't exist."""
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS fire_state (
+        fire_id TEXT PRIMARY KEY,
+        raw_data TEXT          -- Last known JSON of the fire, 'active' as tracked by the ingest
+    )
+    ''')
+    # `last_seen` (commit timestamp the fire was last present or disappeared at) is added by migration 6
+
+def load_fire_states(cursor, commit_hash, seen_since=None):
+    """
+    Loads the persisted fire states with a single query, as {fire_id: (fire data, last_seen)}.
+    With `seen_since`, only the active fires and those last seen at or after it are loaded.
+    Returns None if there is no checkpoint for `commit_hash` (e.g. a database created before
+    the checkpoint existed), in which case the caller must rebuild the states another way.
+    `commit_hash` is None for the states of a database only fed by the live ingest daemon.
+    """
+    if get_metadata(cursor, FIRE_STATE_COMMIT_KEY, _NO_CHECKPOINT) != commit_hash:
+        return None
+    if seen_since is None:
+        cursor.execute("SELECT fire_id, raw_data, last_seen FROM fire_state")
+    else:
+        cursor.execute('''
+            SELECT fire_id, raw_data, last_seen FROM fire_state
+            WHERE last_seen IS NULL OR last_seen >= ? OR json_extract(raw_data, '$.active')
+        ''', (seen_since,))
+    return {fire_id: (json.loads(raw_data), last_seen) for fire_id, raw_data, last_seen in cursor.fetchall()}
+
+def save_fire_states(cursor, fire_states, commit_hash):
+    """
+    Writes `fire_states`, {fire_id: (fire data, last_seen)} for the fires touched since the last
+    checkpoint, and records `commit_hash` as the commit the checkpoint corresponds to. Does not
+    commit: it must be part of the same transaction as the fire events up to and including `commit_hash`.
+    """
+    cursor.executemany("INSERT OR REPLACE INTO fire_state (fire_id, raw_data, last_seen) VALUES (?, ?, ?)",
+                       [(fire_id, json.dumps(fire_data), last_seen)
+                        for fire_id, (fire_data, last_seen) in fire_states.items()])
+    set_metadata(cursor, FIRE_STATE_COMMIT_KEY, commit_hash)
+
+# --- Compact In-Memory Fire States ---
+# The ingest used to hold the full JSON of every fire it had ever seen, for the whole run. Now each
+# fire is a small `FireState`: a digest of the fields the change detection looks at, its active flag
+# and when it was last seen. The full JSON is only kept while the fire is active (a disappearance
+# logs its last known state) and until it is written to `fire_state` at the next checkpoint. Fires
+# inactive for longer than the eviction horizon are dropped from memory after a checkpoint, and
+# read back from `fire_state` if they ever show up again.
+
+# Fields whose change is logged as an update (besides the data timestamp, see `fire_fingerprint`)
+RELEVANT_FIELDS = (
+    'lat', 'lng', 'location', 'man', 'terrain', 'aerial', 'meios_aquaticos',
+    'status', 'statusCode', 'natureza', 'active', 'localidade', 'important',
+    'district', 'concelho', 'freguesia', 'naturezaCode', 'statusColor',
+)
+DEFAULT_EVICTION_HORIZON = 30 * 24 * 3600 # Seconds a fire stays in memory after it was last seen inactive
+
+def fire_fingerprint(fire_data):
+    """
+    Digest of the fields whose change is logged as an update: RELEVANT_FIELDS, the update time,
+    and the creation time when there is no update time. Two states of a fire with the same
+    fingerprint are not logged as an update. A 128-bit digest of the values' canonical JSON rather
+    than hash(): hash() collides on simple values (hash(-1) == hash(-2)), which would drop updates.
+    """
+    values = [fire_data.get(field) for field in RELEVANT_FIELDS] + [
+        fire_data.get('updated', {}).get('sec'),
+        fire_data.get('dateTime', {}).get('sec') if 'updated' not in fire_data else None,
+    ]
+    canonical = json.dumps(values, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.blake2b(canonical.encode('utf-8'), digest_size=16).digest()
+
+class FireState:
+    """What the ingest remembers of a fire between two snapshots."""
+    __slots__ = ('fingerprint', 'active', 'last_seen', 'data')
+
+    def __init__(self, fingerprint, active, last_seen, data):
+        self.fingerprint = fingerprint
+        self.active = active
+        self.last_seen = last_seen # Commit timestamp, None if unknown (states rebuilt from git)
+        self.data = data           # Full JSON, only while active
+
+class FireStateStore:
+    """
+    The fire states of an ingest run, backed by the `fire_state` table: states changed since the
+    last checkpoint are written by `checkpoint`, and `evict` drops the long inactive ones from memory.
+    """
+
+    def __init__(self, cursor, eviction_horizon=DEFAULT_EVICTION_HORIZON):
+        self.cursor = cursor
+        self.eviction_horizon = eviction_horizon # None keeps every state in memory
+        self.states = {}
+        self.active_fire_ids = set()
+        self.dirty = {} # fire_id -> fire data, written at the next checkpoint
+        self.disk_loads = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.states)
+
+    def _add(self, fire_id, fire_data, last_seen, fingerprint=None):
+        active = bool(fire_data.get('active', False))
+        self.states[fire_id] = state = FireState(
+            fire_fingerprint(fire_data) if fingerprint is None else fingerprint,
+            active, last_seen, fire_data if active else None)
+        if active:
+            self.active_fire_ids.add(fire_id)
+        else:
+            self.active_fire_ids.discard(fire_id)
+        return state
+
+    def load(self, commit_hash, now=None):
+        """
+        Loads the checkpoint of `commit_hash`, skipping the fires evicted as of `now` (a timestamp).
+        Returns False if there is none, see `load_fire_states`.
+        """
+        seen_since = None if now is None or self.eviction_horizon is None else now - self.eviction_horizon
+        fire_states = load_fire_states(self.cursor, commit_hash, seen_since)
+        if fire_states is None:
+            return False
+        for fire_id, (fire_data, last_seen) in fire_states.items():
+            self._add(fire_id, fire_data, last_seen)
+        return True
+
+    def reset(self):
+        """Forgets every state, in memory and in `fire_state`, before states are rebuilt from scratch."""
+        self.cursor.execute("DELETE FROM fire_state")
+        self.states.clear()
+        self.active_fire_ids.clear()
+        self.dirty.clear()
+
+    def get(self, fire_id):
+        """Returns the FireState of a fire, reading an evicted one back from `fire_state`, or None."""
+        state = self.states.get(fire_id)
+        if state is None:
+            self.cursor.execute("SELECT raw_data, last_seen FROM fire_state WHERE fire_id = ?", (fire_id,))
+            row = self.cursor.fetchone()
+            if row is not None:
+                state = self._add(fire_id, json.loads(row[0]), row[1])
+                self.disk_loads += 1
+        return state
+
+    def set(self, fire_id, fire_data, last_seen, fingerprint=None):
+        """Records `fire_data` as the last known state of a fire, seen at `last_seen`."""
+        self._add(fire_id, fire_data, last_seen, fingerprint)
+        self.dirty[fire_id] = fire_data
+
+    def checkpoint(self, commit_hash):
+        """Writes the states changed since the last checkpoint, see `save_fire_states`. Does not commit."""
+        save_fire_states(self.cursor, {fire_id: (fire_data, self.states[fire_id].last_seen)
+                                       for fire_id, fire_data in self.dirty.items()}, commit_hash)
+        self.dirty.clear()
+
+    def evict(self, now):
+        """
+        Drops from memory the fires inactive and not seen since the eviction horizon before `now`
+        (or never seen by this run). Only call it right after `checkpoint`. Returns their ids.
+        """
+        if self.eviction_horizon is None:
+            return []
+        cutoff = now - self.eviction_horizon
+        evicted_fire_ids = [fire_id for fire_id, state in self.states.items()
+                            if not state.active and (state.last_seen is None or state.last_seen < cutoff)]
+        for fire_id in evicted_fire_ids:
+            del self.states[fire_id]
+        self.evictions += len(evicted_fire_ids)
+        return evicted_fire_ids
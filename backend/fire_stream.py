@@ -0,0 +1,167 @@
+import bisect
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# --- Fire Update Stream ---
+# Dashboards used to poll every stats endpoint to notice new data. /api/fires/stream pushes the
+# fire_updates rows (NEW/UPDATED/DISAPPEARED) as Server-Sent Events instead. One background thread
+# per server process tails fire_updates by update_id and formats each new row once. Every
+# connected client then reads from that shared buffer, with its own district/natureza filter. A
+# client that reconnects with Last-Event-ID gets the rows it missed: from the buffer if they are
+# still in it, else from the database, one page at a time.
+
+EVENT_COLUMNS = (
+    'update_id', 'fire_id', 'change_type', 'commit_hash', 'commit_timestamp', 'data_timestamp', 'status',
+    'status_code', 'man', 'terrain', 'aerial', 'meios_aquaticos', 'active_in_commit',
+    'district', 'concelho', 'natureza', 'location',
+)
+PAGE_SIZE = 1000
+
+def read_fire_events(dbapi_connection, after_update_id, limit=PAGE_SIZE):
+    """
+    Returns up to `limit` events for the fire_updates rows after `after_update_id`, oldest first, as
+    (update_id, district, natureza, SSE message bytes) tuples.
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute('''
+            SELECT u.update_id, u.fire_id, u.change_type, u.commit_hash, u.commit_timestamp, u.data_timestamp,
+                   u.status, u.status_code, u.man, u.terrain, u.aerial, u.meios_aquaticos, u.active_in_commit,
+                   f.district, f.concelho, f.natureza, f.location
+            FROM fire_updates u LEFT JOIN fires f ON f.fire_id = u.fire_id
+            WHERE u.update_id > ?
+            ORDER BY u.update_id LIMIT ?
+        ''', (after_update_id, limit))
+        rows = cursor.fetchall()
+    finally:
+        cursor.close()
+    events = []
+    for row in rows:
+        event = dict(zip(EVENT_COLUMNS, row))
+        event['active_in_commit'] = bool(event['active_in_commit'])
+        message = f"id: {event['update_id']}\nevent: {event['change_type']}\ndata: {json.dumps(event)}\n\n"
+        events.append((event['update_id'], event['district'], event['natureza'], message.encode('utf-8')))
+    return events
+
+class FireUpdateStream:
+    """
+    Tails fire_updates for all the clients of the process. `dbapi_connection_factory` returns a
+    read-only DB-API connection, closed after each read (e.g. a pooled SQLAlchemy raw connection).
+    """
+
+    def __init__(self, dbapi_connection_factory, poll_interval=1.0, buffer_size=10000):
+        self.dbapi_connection_factory = dbapi_connection_factory
+        self.poll_interval = poll_interval
+        self.buffer_size = buffer_size
+        self.condition = threading.Condition()
+        self.event_ids = [] # update_id of each buffered event, ascending
+        self.events = []
+        self.covered_after = 0 # The buffer holds every event after this update_id
+        self.last_update_id = 0
+        self.thread = None
+        self.thread_pid = None
+        self.clients = 0
+        self.polls = 0
+        self.database_reads = 0
+
+    def _read(self, after_update_id, limit=PAGE_SIZE):
+        dbapi_connection = self.dbapi_connection_factory()
+        try:
+            return read_fire_events(dbapi_connection, after_update_id, limit)
+        finally:
+            dbapi_connection.close()
+
+    def start(self):
+        """Starts the tail, from the current end of fire_updates, unless this process already runs it."""
+        with self.condition:
+            # Checked by pid: a forked server worker doesn't inherit the parent's thread
+            if self.thread is not None and self.thread_pid == os.getpid():
+                return
+            dbapi_connection = self.dbapi_connection_factory()
+            try:
+                cursor = dbapi_connection.cursor()
+                cursor.execute("SELECT COALESCE(MAX(update_id), 0) FROM fire_updates")
+                self.last_update_id = self.covered_after = cursor.fetchone()[0]
+                cursor.close()
+            finally:
+                dbapi_connection.close()
+            self.event_ids, self.events = [], []
+            self.thread = threading.Thread(target=self._tail, name='fire-update-stream', daemon=True)
+            self.thread_pid = os.getpid()
+            self.thread.start()
+
+    def _tail(self):
+        while True:
+            try:
+                events = self._read(self.last_update_id)
+            except sqlite3.Error as e:
+                print(f"Fire update stream: could not read fire_updates ({e}).")
+                events = []
+            self.polls += 1
+            if events:
+                with self.condition:
+                    self.event_ids.extend(event[0] for event in events)
+                    self.events.extend(events)
+                    self.last_update_id = events[-1][0]
+                    if len(self.events) > 2 * self.buffer_size:
+                        # Trimmed in chunks rather than on every event
+                        dropped = len(self.events) - self.buffer_size
+                        self.covered_after = self.event_ids[dropped - 1]
+                        del self.event_ids[:dropped], self.events[:dropped]
+                    self.condition.notify_all()
+            if len(events) < PAGE_SIZE: # Else more rows are waiting
+                time.sleep(self.poll_interval)
+
+    def read(self, after_update_id, timeout):
+        """
+        Returns the events after `after_update_id`, waiting up to `timeout` seconds for some (an empty
+        list if none came), reading them from the database if they are no longer buffered.
+        """
+        with self.condition:
+            if after_update_id >= self.covered_after:
+                if self.last_update_id <= after_update_id:
+                    self.condition.wait(timeout)
+                return self.events[bisect.bisect_right(self.event_ids, after_update_id):]
+        self.database_reads += 1
+        return self._read(after_update_id)
+
+    def subscribe(self, last_event_id=None, districts=(), naturezas=(), heartbeat_interval=15.0, retry_ms=5000):
+        """
+        Yields the SSE messages of a client: the events after `last_event_id` (or from now on),
+        only for fires of `districts` and `naturezas` when given, plus a comment every
+        `heartbeat_interval` seconds without events so proxies keep the connection open.
+        """
+        self.start()
+        # An id past the end (e.g. from before a rebuild of the database) resumes from the end
+        after_update_id = self.last_update_id if last_event_id is None else min(last_event_id, self.last_update_id)
+        with self.condition:
+            self.clients += 1
+        try:
+            yield f"retry: {retry_ms}\n\n".encode('utf-8')
+            last_sent = time.monotonic()
+            while True:
+                events = self.read(after_update_id, heartbeat_interval)
+                for update_id, district, natureza, message in events:
+                    if (not districts or district in districts) and (not naturezas or natureza in naturezas):
+                        yield message
+                        last_sent = time.monotonic()
+                if events:
+                    after_update_id = events[-1][0]
+                if time.monotonic() - last_sent >= heartbeat_interval:
+                    yield b": keep-alive\n\n"
+                    last_sent = time.monotonic()
+        finally:
+            with self.condition:
+                self.clients -= 1
+
+    def stats(self):
+        return {
+            'clients': self.clients,
+            'buffered_events': len(self.events),
+            'last_update_id': self.last_update_id,
+            'polls': self.polls,
+            'database_reads': self.database_reads,
+        }
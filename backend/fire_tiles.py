@@ -0,0 +1,291 @@
+import concurrent.futures
+import gzip
+import hashlib
+import json
+import math
+import os
+import struct
+import threading
+from fire_geo import mercator_position
+
+# --- Fire Map Tiles ---
+# /api/tiles/{z}/{x}/{y} serves the fires of a Web Mercator tile for the public map, as Mapbox
+# Vector Tiles (points in a 'fires' layer, encoded here: the format is a small protobuf) or as
+# gzipped GeoJSON, optionally filtered by first seen date and natureza.
+# Built tiles are kept on disk with the fingerprint of the fires they were built from: the number
+# of fires_geo entries in the tile and the highest data version among them (see fire_geo.py, the
+# ingest re-indexes the fires it writes at the new data version). A tile is only rebuilt when a
+# newly ingested fire lands in it (or leaves it), whatever else the ingest changed.
+# Builds run on a bounded thread pool, one build per tile however many requests ask for it. While
+# a changed tile is rebuilt, its previous version is served, so only tiles never built before wait.
+
+TILE_FORMATS = {
+    'mvt': 'application/vnd.mapbox-vector-tile',
+    'pbf': 'application/vnd.mapbox-vector-tile',
+    'geojson': 'application/geo+json',
+}
+TILE_EXTENT = 4096 # MVT coordinates per tile side
+TILE_BUFFER = 64 # Fires this close to the tile (in MVT coordinates) are included, so edge symbols aren't cut
+TILE_LAYER = 'fires'
+TILE_CACHE_FORMAT = 'v1' # Changing the encoding changes it, orphaning the tiles built before
+
+FIRE_PROPERTIES = ('fire_id', 'natureza', 'district', 'concelho', 'location', 'active', 'first_seen', 'last_updated')
+
+def tile_bounds(z, x, y, buffer=0.0):
+    """(west, south, east, north) in degrees of tile z/x/y, grown by `buffer` tile sides."""
+    tiles = 2 ** z
+    def lng(tile_x):
+        return tile_x / tiles * 360 - 180
+    def lat(tile_y):
+        tile_y = min(max(tile_y, 0), tiles)
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / tiles))))
+    return (max(lng(x - buffer), -180.0), lat(y + 1 + buffer), min(lng(x + 1 + buffer), 180.0), lat(y - buffer))
+
+def _filter_conditions(filters):
+    """SQL conditions and parameters of the tile filters: (from_ts, to_ts, naturezas)."""
+    from_ts, to_ts, naturezas = filters
+    conditions, parameters = [], []
+    if from_ts is not None:
+        conditions.append("f.first_seen_data_timestamp >= ?")
+        parameters.append(from_ts)
+    if to_ts is not None:
+        conditions.append("f.first_seen_data_timestamp <= ?")
+        parameters.append(to_ts)
+    if naturezas:
+        conditions.append(f"f.natureza IN ({', '.join('?' * len(naturezas))})")
+        parameters.extend(sorted(naturezas))
+    return ''.join(f" AND {condition}" for condition in conditions), parameters
+
+def read_tile_fires(cursor, bounds, filters):
+    """Returns (geo_rowid, lat, lng, properties) of the fires within `bounds` matching `filters`."""
+    west, south, east, north = bounds
+    conditions, parameters = _filter_conditions(filters)
+    cursor.execute(f'''
+        SELECT g.geo_rowid, f.lat, f.lng, f.fire_id, f.natureza, f.district, f.concelho, f.location,
+               f.is_currently_active, f.first_seen_data_timestamp, f.last_updated_data_timestamp
+        FROM fires_geo g JOIN fires f ON f.fire_id = g.fire_id
+        WHERE g.max_lat >= ? AND g.min_lat <= ? AND g.max_lng >= ? AND g.min_lng <= ?
+          AND f.lat BETWEEN ? AND ? AND f.lng BETWEEN ? AND ? {conditions}
+        ORDER BY g.geo_rowid
+    ''', (south, north, west, east, south, north, west, east, *parameters))
+    fires = []
+    for geo_rowid, lat, lng, *values in cursor.fetchall():
+        properties = dict(zip(FIRE_PROPERTIES, values))
+        properties['active'] = bool(properties['active'])
+        fires.append((geo_rowid, lat, lng, properties))
+    return fires
+
+def read_tile_fingerprint(cursor, bounds):
+    """'<fires>:<highest data version>' of the fires_geo entries in `bounds`, whatever the filters."""
+    west, south, east, north = bounds
+    cursor.execute('''
+        SELECT COUNT(*), MAX(data_version) FROM fires_geo
+        WHERE max_lat >= ? AND min_lat <= ? AND max_lng >= ? AND min_lng <= ?
+    ''', (south, north, west, east))
+    count, data_version = cursor.fetchone()
+    return f'{count}:{data_version or 0}'
+
+# --- Encoding ---
+
+def _varint(value):
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append((value & 0x7f) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+def _field(number, wire_type, payload):
+    """A protobuf field: varint (wire type 0) and length-delimited (2) payloads are given encoded."""
+    key = _varint((number << 3) | wire_type)
+    return key + (payload if wire_type != 2 else _varint(len(payload)) + payload)
+
+def _encode_value(value):
+    # Tile Value message: string_value = 1, double_value = 3, sint_value = 6, bool_value = 7
+    if isinstance(value, bool):
+        return _field(7, 0, _varint(int(value)))
+    if isinstance(value, int):
+        return _field(6, 0, _varint(_zigzag(value)))
+    if isinstance(value, float):
+        return _field(3, 1, struct.pack('<d', value))
+    return _field(1, 2, str(value).encode('utf-8'))
+
+def encode_mvt(fires, z, x, y, extent=TILE_EXTENT):
+    """Encodes the fires of tile z/x/y as a Mapbox Vector Tile with one layer of points."""
+    if not fires:
+        return b''
+    # Position of each fire in the tile's coordinates, y downwards
+    world_x, world_y = mercator_position([fire[1] for fire in fires], [fire[2] for fire in fires])
+    tile_xs = ((world_x * 2 ** z - x) * extent).round().astype(int).tolist()
+    tile_ys = ((world_y * 2 ** z - y) * extent).round().astype(int).tolist()
+    keys, values = {}, {}
+    features = bytearray()
+    for (geo_rowid, _, _, properties), tile_x, tile_y in zip(fires, tile_xs, tile_ys):
+        tags = bytearray()
+        for key, value in properties.items():
+            if value is None:
+                continue
+            value_key = (type(value).__name__, value)
+            tags += _varint(keys.setdefault(key, len(keys)))
+            tags += _varint(values.setdefault(value_key, len(values)))
+        # One MoveTo command (id 1, count 1) to the point
+        geometry = _varint(9) + _varint(_zigzag(tile_x)) + _varint(_zigzag(tile_y))
+        # Feature message: id = 1, tags = 2, type = 3 (1 is POINT), geometry = 4
+        feature = _field(1, 0, _varint(geo_rowid)) + _field(2, 2, bytes(tags)) + _field(3, 0, _varint(1)) + _field(4, 2, geometry)
+        features += _field(2, 2, feature)
+    # Layer message: name = 1, features = 2, keys = 3, values = 4, extent = 5, version = 15
+    layer = bytearray(_field(15, 0, _varint(2)) + _field(1, 2, TILE_LAYER.encode('utf-8')))
+    layer += features
+    for key in keys:
+        layer += _field(3, 2, key.encode('utf-8'))
+    for _, value in values:
+        layer += _field(4, 2, _encode_value(value))
+    layer += _field(5, 0, _varint(extent))
+    return _field(3, 2, bytes(layer))
+
+def encode_geojson(fires):
+    """Encodes the fires as a gzipped GeoJSON FeatureCollection of points."""
+    collection = {
+        'type': 'FeatureCollection',
+        'features': [{
+            'type': 'Feature',
+            'id': geo_rowid,
+            'geometry': {'type': 'Point', 'coordinates': [lng, lat]},
+            'properties': properties,
+        } for geo_rowid, lat, lng, properties in fires],
+    }
+    # mtime=0: the same fires always give the same bytes
+    return gzip.compress(json.dumps(collection, separators=(',', ':')).encode('utf-8'), compresslevel=6, mtime=0)
+
+def build_tile(cursor, z, x, y, tile_format, filters):
+    fires = read_tile_fires(cursor, tile_bounds(z, x, y, TILE_BUFFER / TILE_EXTENT), filters)
+    return encode_geojson(fires) if tile_format == 'geojson' else encode_mvt(fires, z, x, y)
+
+# --- Disk Cache ---
+
+def is_unfiltered(filters):
+    from_ts, to_ts, naturezas = filters
+    return from_ts is None and to_ts is None and not naturezas
+
+class TileCache:
+    """
+    Serves the tiles from `cache_dir`, (re)building them on a pool of `workers` threads.
+    `dbapi_connection_factory` returns a read-only DB-API connection, closed after use. Tiles of
+    zoom levels above `max_cached_zoom` hold few fires: they are built for each request, not stored.
+    Nor are filtered tiles: nothing evicts stored tiles, and the filters take any value a client sends.
+    """
+
+    def __init__(self, dbapi_connection_factory, cache_dir, workers=4, max_cached_zoom=12):
+        self.dbapi_connection_factory = dbapi_connection_factory
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.max_cached_zoom = max_cached_zoom
+        self.lock = threading.Lock()
+        self.executor = None
+        self.executor_pid = None
+        self.pending = {} # Tile path -> Future of the build in progress
+        self.hits = 0
+        self.builds = 0
+        self.stale_served = 0
+        self.store_errors = 0
+
+    def _get_executor(self):
+        # Checked by pid: a forked server worker doesn't inherit the parent's threads
+        if self.executor is None or self.executor_pid != os.getpid():
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix='fire-tiles')
+            self.executor_pid = os.getpid()
+            self.pending = {}
+        return self.executor
+
+    def tile_path(self, z, x, y, tile_format, filters):
+        # Also the key of the builds in progress, which filtered tiles share too
+        filters_key = 'all'
+        if not is_unfiltered(filters):
+            from_ts, to_ts, naturezas = filters
+            filters_key = hashlib.sha1(json.dumps([from_ts, to_ts, sorted(naturezas)]).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, TILE_CACHE_FORMAT, filters_key, str(z), str(x), f'{y}.{tile_format}')
+
+    def _read_cached(self, path):
+        """(fingerprint, tile) stored at `path`, or None."""
+        try:
+            with open(path, 'rb') as tile_file:
+                fingerprint = tile_file.readline().rstrip(b'\n').decode('ascii')
+                return fingerprint, tile_file.read()
+        except OSError:
+            return None
+
+    def _store(self, path, fingerprint, tile):
+        # Written next to the tile then renamed: other server processes never read a partial tile
+        temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temporary_path, 'wb') as tile_file:
+                tile_file.write(fingerprint.encode('ascii') + b'\n' + tile)
+            os.replace(temporary_path, path)
+        except OSError as e:
+            # The tile is served all the same, only built again for the next request
+            self.store_errors += 1
+            print(f"Could not store tile {path}: {e}")
+            try:
+                os.remove(temporary_path)
+            except OSError:
+                pass
+
+    def _build(self, path, z, x, y, tile_format, filters, fingerprint, store):
+        try:
+            dbapi_connection = self.dbapi_connection_factory()
+            try:
+                tile = build_tile(dbapi_connection.cursor(), z, x, y, tile_format, filters)
+            finally:
+                dbapi_connection.close()
+            if store:
+                self._store(path, fingerprint, tile)
+            self.builds += 1
+            return fingerprint, tile
+        finally:
+            with self.lock:
+                self.pending.pop(path, None)
+
+    def _submit(self, path, z, x, y, tile_format, filters, fingerprint, store):
+        with self.lock:
+            future = self.pending.get(path)
+            if future is None:
+                future = self._get_executor().submit(self._build, path, z, x, y, tile_format, filters, fingerprint, store)
+                self.pending[path] = future
+            return future
+
+    def get(self, z, x, y, tile_format, filters):
+        """
+        Returns (fingerprint, tile) of tile z/x/y in `tile_format` ('mvt' or 'geojson') for
+        `filters` (from_ts, to_ts, naturezas): the stored one if its fires didn't change, else the
+        stored one while a rebuild runs, else a new build.
+        """
+        dbapi_connection = self.dbapi_connection_factory()
+        try:
+            fingerprint = read_tile_fingerprint(dbapi_connection.cursor(), tile_bounds(z, x, y, TILE_BUFFER / TILE_EXTENT))
+        finally:
+            dbapi_connection.close()
+        store = z <= self.max_cached_zoom and is_unfiltered(filters)
+        path = self.tile_path(z, x, y, tile_format, filters)
+        cached = self._read_cached(path) if store else None
+        if cached is not None and cached[0] == fingerprint:
+            self.hits += 1
+            return cached
+        future = self._submit(path, z, x, y, tile_format, filters, fingerprint, store)
+        if cached is not None:
+            self.stale_served += 1
+            return cached
+        return future.result()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'builds': self.builds,
+            'stale_served': self.stale_served,
+            'store_errors': self.store_errors,
+            'pending_builds': len(self.pending),
+            'workers': self.workers,
+        }
@@ -0,0 +1,138 @@
+import time
+from raw_payloads import get_compression_dictionary, store_raw_payload
+from fire_history import FireHistoryEncoder
+
+# --- Buffered Fire Writer ---
+# The incremental ingest used to issue one statement per fire per commit (plus an existence probe).
+# FireWriter keeps those writes in memory for a batch of commits and flushes them with executemany,
+# merging the changes made to the same `fires` row so each touched row is written once per flush.
+# Presence confirmations of unchanged fires (`last_updated_commit_hash`) are only kept for the latest
+# commit of the batch, so a fire seen unchanged in N commits costs one row write instead of N.
+# The update log is delta-encoded (see fire_history.py): only keyframe rows store the fire's JSON.
+
+FIRE_COLUMNS = (
+    'fire_id', 'lat', 'lng', 'location', 'district', 'concelho', 'freguesia', 'natureza',
+    'first_seen_commit_hash', 'first_seen_data_timestamp',
+    'last_updated_commit_hash', 'last_updated_data_timestamp', 'is_currently_active',
+)
+
+FIRE_UPDATE_COLUMNS = (
+    'update_id', 'fire_id', 'commit_hash', 'commit_timestamp', 'data_timestamp', 'status', 'status_code',
+    'man', 'terrain', 'aerial', 'meios_aquaticos', 'active_in_commit', 'change_type', 'raw_payload_id',
+)
+
+class FireWriter:
+    """
+    Buffers the rows written by the ingest until `flush` is called.
+    `known_fire_ids` is the set of fire ids already in the `fires` table; it replaces the
+    per-fire `SELECT 1 FROM fires` probe and is kept up to date as new fires are inserted.
+    """
+
+    def __init__(self, cursor, known_fire_ids):
+        self.cursor = cursor
+        self.known_fire_ids = known_fire_ids
+        self.new_fires = {}      # fire_id -> full row for fires inserted in this batch
+        self.fire_changes = {}   # fire_id -> {column: value} for existing fires
+        self.confirmations = {}  # fire_id -> last commit_hash where an unchanged fire was present
+        self.update_log = []     # fire_updates rows, in order
+        self.touched_fire_ids = set() # Fires with a row or update log written, other than confirmations
+        self.compression_dictionary = get_compression_dictionary(cursor)
+        self.history = FireHistoryEncoder()
+        self.rows_written = 0
+        self.confirmations_requested = 0
+        self.confirmations_written = 0
+        self.flush_seconds = 0.0
+
+    def fire_exists(self, fire_id):
+        """Returns True if the fire is in the `fires` table (or pending insertion)."""
+        return fire_id in self.known_fire_ids
+
+    def insert_fire(self, row):
+        """Queues a new row for the `fires` table; `row` maps every column in FIRE_COLUMNS."""
+        self.known_fire_ids.add(row['fire_id'])
+        self.touched_fire_ids.add(row['fire_id'])
+        self.new_fires[row['fire_id']] = row
+
+    def update_fire(self, fire_id, **columns):
+        """Queues new values for some columns of a fire, merged with its pending changes."""
+        self.touched_fire_ids.add(fire_id)
+        pending_row = self.new_fires.get(fire_id)
+        if pending_row is not None:
+            pending_row.update(columns)
+            return
+        pending_changes = self.fire_changes.setdefault(fire_id, {})
+        confirmed_commit_hash = self.confirmations.pop(fire_id, None)
+        if confirmed_commit_hash is not None:
+            pending_changes['last_updated_commit_hash'] = confirmed_commit_hash
+        pending_changes.update(columns)
+
+    def confirm_fire(self, fire_id, commit_hash):
+        """Records that an unchanged fire is still present in `commit_hash`; only the latest one is written."""
+        self.confirmations_requested += 1
+        if fire_id in self.new_fires or fire_id in self.fire_changes:
+            self.update_fire(fire_id, last_updated_commit_hash=commit_hash)
+        else:
+            self.confirmations[fire_id] = commit_hash
+
+    def log_update(self, entry):
+        """
+        Queues a `fire_updates` row; `entry` maps every column in FIRE_UPDATE_COLUMNS except
+        `update_id` and `raw_payload_id`, and `raw_data` to the fire's data, delta-encoded at flush.
+        """
+        self.touched_fire_ids.add(entry['fire_id'])
+        self.update_log.append(entry)
+
+    def flush(self):
+        """
+        Writes every buffered row. Does not commit: callers decide the transaction boundaries.
+        Returns the ids of the fires written other than by a presence confirmation.
+        """
+        start = time.perf_counter()
+
+        if self.new_fires:
+            self.cursor.executemany(f'''
+                INSERT INTO fires ({', '.join(FIRE_COLUMNS)})
+                VALUES ({', '.join(':' + column for column in FIRE_COLUMNS)})
+            ''', list(self.new_fires.values()))
+
+        # One executemany per distinct set of changed columns (confirmations, updates, disappearances)
+        changes_by_columns = {}
+        for fire_id, columns in self.fire_changes.items():
+            changes_by_columns.setdefault(tuple(sorted(columns)), []).append(dict(columns, fire_id=fire_id))
+        for column_names, rows in changes_by_columns.items():
+            set_clause = ', '.join(f"{column} = :{column}" for column in column_names)
+            self.cursor.executemany(f"UPDATE fires SET {set_clause} WHERE fire_id = :fire_id", rows)
+
+        if self.confirmations:
+            self.cursor.executemany("UPDATE fires SET last_updated_commit_hash = ? WHERE fire_id = ?",
+                                    [(commit_hash, fire_id) for fire_id, commit_hash in self.confirmations.items()])
+
+        if self.update_log:
+            # The ids are assigned here (the ingest is the only writer) so the deltas can reference them
+            self.cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'fire_updates'")
+            row = self.cursor.fetchone()
+            update_id = row[0] if row else 0
+            delta_rows = []
+            for entry in self.update_log:
+                update_id += 1
+                entry['update_id'] = update_id
+                is_keyframe, deltas = self.history.encode(self.cursor, entry['fire_id'], entry['raw_data'], entry['change_type'])
+                entry['raw_payload_id'] = (store_raw_payload(self.cursor, entry['raw_data'], self.compression_dictionary)
+                                           if is_keyframe else None)
+                delta_rows.extend((entry['fire_id'], field, update_id, old_value, new_value)
+                                  for field, old_value, new_value in deltas)
+            self.cursor.executemany(f'''
+                INSERT INTO fire_updates ({', '.join(FIRE_UPDATE_COLUMNS)})
+                VALUES ({', '.join(':' + column for column in FIRE_UPDATE_COLUMNS)})
+            ''', self.update_log)
+            self.cursor.executemany("INSERT INTO fire_update_deltas VALUES (?, ?, ?, ?, ?)", delta_rows)
+
+        self.rows_written += len(self.new_fires) + len(self.fire_changes) + len(self.confirmations) + len(self.update_log)
+        self.confirmations_written += len(self.confirmations)
+        self.new_fires = {}
+        self.fire_changes = {}
+        self.confirmations = {}
+        self.update_log = []
+        touched_fire_ids, self.touched_fire_ids = self.touched_fire_ids, set()
+        self.flush_seconds += time.perf_counter() - start
+        return touched_fire_ids
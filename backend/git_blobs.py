@@ -0,0 +1,75 @@
+import subprocess
+import threading
+
+# --- Streaming Git Access ---
+# Reading a file through GitPython (`repo.commit(sha).tree[path].data_stream`) costs several
+# object lookups per commit. For the full history we instead let git resolve `<commit>:<path>`
+# itself and stream every blob back through one long-lived `git cat-file --batch` process.
+
+def list_commits(repo, rev="HEAD"):
+    """
+    Returns the commits of `rev` (e.g. 'HEAD' or 'abc123..HEAD') oldest first,
+    as a list of (commit_hexsha, commit_timestamp) tuples.
+    Raises git.exc.GitCommandError if the revision cannot be resolved.
+    """
+    output = repo.git.rev_list('--reverse', '--timestamp', rev)
+    commits = []
+    for line in output.splitlines():
+        timestamp, commit_hexsha = line.split(' ', 1)
+        commits.append((commit_hexsha, int(timestamp)))
+    return commits
+
+def _feed_object_names(stdin, object_names):
+    """Writes one object name per line to the cat-file process, then closes its input."""
+    try:
+        for object_name in object_names:
+            stdin.write(object_name.encode('utf-8') + b'\n')
+        stdin.close()
+    except (BrokenPipeError, ValueError):
+        # The reader went away (generator closed early); nothing left to feed.
+        pass
+
+def iter_file_blobs(repo, commits, file_path_in_repo):
+    """
+    Streams the content of `file_path_in_repo` for every commit in `commits`
+    (a list of (commit_hexsha, commit_timestamp) tuples, as returned by `list_commits`).
+    Yields (commit_hexsha, commit_timestamp, blob_oid, blob_bytes) in the same order;
+    blob_oid and blob_bytes are None when the file does not exist in that commit.
+    Commits with byte-identical files share the same blob_oid.
+    """
+    path = file_path_in_repo.strip('/')
+    process = subprocess.Popen(
+        ['git', '--git-dir', repo.git_dir, 'cat-file', '--batch', '--buffer'],
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+    )
+    # Requests are written from a separate thread so that git can keep its output
+    # buffered without either side blocking on a full pipe.
+    writer = threading.Thread(
+        target=_feed_object_names,
+        args=(process.stdin, (f"{commit_hexsha}:{path}" for commit_hexsha, _ in commits)),
+        daemon=True,
+    )
+    writer.start()
+    try:
+        for commit_hexsha, commit_timestamp in commits:
+            header = process.stdout.readline()
+            if not header:
+                raise RuntimeError(f"git cat-file exited early while reading {commit_hexsha[:7]}:{path}")
+            parts = header.split()
+            if len(parts) != 3:
+                # '<name> missing' or '<name> ambiguous': the file isn't in this commit
+                yield commit_hexsha, commit_timestamp, None, None
+                continue
+            blob_oid, object_type, size = parts
+            content = process.stdout.read(int(size))
+            process.stdout.read(1) # Trailing newline after each object
+            if object_type != b'blob':
+                yield commit_hexsha, commit_timestamp, None, None
+                continue
+            yield commit_hexsha, commit_timestamp, blob_oid.decode('ascii'), content
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        writer.join()
@@ -0,0 +1,29 @@
+import multiprocessing
+import os
+
+# --- Production Server (gunicorn) ---
+# gunicorn -c gunicorn.conf.py wsgi:app
+# The app is imported once (numpy, SQLAlchemy, the models) and the workers forked from it; the
+# engine gives each worker its own connection pool (see server.py). Workers are threaded: SQLite
+# reads release the GIL, and each /api/fires/stream client holds a thread for as long as it is
+# connected, so FIRES_WEB_THREADS bounds the stream clients per worker too (or serve the stream
+# through asgi.py). Keep FIRES_WEB_THREADS at or below FIRES_DB_POOL_SIZE + FIRES_DB_MAX_OVERFLOW
+# (15 by default) so no request waits for a database connection.
+# Benchmark: python load_test.py --workers 1,4,16
+
+bind = os.environ.get('FIRES_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('FIRES_WEB_WORKERS', min(multiprocessing.cpu_count() * 2 + 1, 16)))
+worker_class = 'gthread'
+threads = int(os.environ.get('FIRES_WEB_THREADS', 8))
+preload_app = True
+
+# gthread workers heartbeat from their main thread, so long stream responses don't trip the timeout
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+# Workers are replaced now and then, which bounds the memory held by their response caches
+max_requests = 10000
+max_requests_jitter = 1000
+
+accesslog = '-' if os.environ.get('FIRES_ACCESS_LOG') else None
+errorlog = '-'
@@ -0,0 +1,426 @@
+import argparse
+import json
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime, timezone
+import numpy as np
+from fire_history import replay_fire_states
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+# --- Columnar History Export ---
+# Offline analysis used to read `fires` and `fire_updates` row by row through the API or ad-hoc SQL.
+# This exports them as columnar files partitioned by month (Hive-style year=/month= directories):
+# one Parquet file per part, which pandas, DuckDB or Arrow read directly, e.g.
+#   duckdb -c "SELECT district, SUM(man) FROM 'export/fire_updates/**/*.parquet' GROUP BY 1"
+# Parquet needs pyarrow (pip install pyarrow); without it each part is a directory with one NumPy
+# .npy file per typed column (plus `<column>.mask.npy` where a column has NULLs) instead, only
+# readable through `HistoryExport`. `fire_updates` is exported incrementally from the last exported
+# update_id, in chunks of bounded size, with the fields of the raw JSON flattened into columns.
+# `fires` rows change in place, so they are re-exported every run. manifest.json lists the parts
+# (and the format of each) and the export watermark; it is replaced atomically after the parts are
+# written, so an interrupted export is simply redone.
+# Usage: python history_export.py [fires.sqlite] [export_dir] [--full] [--format parquet|npy]
+
+MANIFEST_NAME = 'manifest.json'
+CHUNK_ROWS = 50000      # fire_updates rows read (and held in memory) at a time
+MAX_PART_ROWS = 500000  # A small last part of a month is merged with new rows up to this size
+PART_FORMATS = ('parquet', 'npy')
+DEFAULT_PART_FORMAT = 'parquet' if pq is not None else 'npy'
+
+FIRE_COLUMN_TYPES = {
+    'fire_id': 'str', 'lat': 'float', 'lng': 'float', 'location': 'str', 'district': 'str',
+    'concelho': 'str', 'freguesia': 'str', 'natureza': 'str',
+    'first_seen_commit_hash': 'str', 'first_seen_data_timestamp': 'int',
+    'last_updated_commit_hash': 'str', 'last_updated_data_timestamp': 'int', 'is_currently_active': 'bool',
+}
+
+FIRE_UPDATE_COLUMN_TYPES = {
+    'update_id': 'int', 'fire_id': 'str', 'commit_hash': 'str', 'commit_timestamp': 'int', 'data_timestamp': 'int',
+    'status': 'str', 'status_code': 'int', 'man': 'int', 'terrain': 'int', 'aerial': 'int',
+    'meios_aquaticos': 'int', 'active_in_commit': 'bool', 'change_type': 'str',
+}
+
+# Fields of the raw JSON exported with each update: column -> (path in the JSON, type)
+RAW_DATA_COLUMN_TYPES = {
+    'lat': (('lat',), 'float'), 'lng': (('lng',), 'float'), 'location': (('location',), 'str'),
+    'district': (('district',), 'str'), 'concelho': (('concelho',), 'str'), 'freguesia': (('freguesia',), 'str'),
+    'localidade': (('localidade',), 'str'), 'natureza': (('natureza',), 'str'),
+    'natureza_code': (('naturezaCode',), 'str'), 'status_color': (('statusColor',), 'str'),
+    'important': (('important',), 'bool'), 'date_time_sec': (('dateTime', 'sec'), 'int'),
+    'updated_sec': (('updated', 'sec'), 'int'),
+}
+
+def _normalize(values, column_type):
+    """The values as `column_type`, None for NULLs and for values that aren't of the type."""
+    normalized = []
+    for value in values:
+        if value is None:
+            normalized.append(None)
+        elif column_type == 'int':
+            try:
+                normalized.append(int(value))
+            except (TypeError, ValueError):
+                normalized.append(None)
+        elif column_type == 'float':
+            try:
+                normalized.append(float(value))
+            except (TypeError, ValueError):
+                normalized.append(None)
+        elif column_type == 'bool':
+            normalized.append(bool(value))
+        else:
+            normalized.append(str(value))
+    return normalized
+
+def _to_column(values, column_type):
+    """Returns (array, NULL mask or None) for a list of Python values (the .npy format)."""
+    mask = np.array([value is None for value in values], dtype=bool)
+    if column_type == 'float':
+        # NaN already marks the missing values
+        return np.array([np.nan if value is None else value for value in values], dtype=np.float64), None
+    if column_type == 'int':
+        converted = []
+        for position, value in enumerate(values):
+            try:
+                converted.append(int(value) if value is not None else 0)
+            except (TypeError, ValueError):
+                converted.append(0)
+                mask[position] = True
+        array = np.array(converted, dtype=np.int64)
+    elif column_type == 'bool':
+        array = np.array([bool(value) for value in values], dtype=bool)
+    else:
+        array = np.array(['' if value is None else str(value) for value in values], dtype=str)
+        if array.dtype.itemsize == 0: # All empty: numpy would give a zero-width dtype
+            array = array.astype('<U1')
+    return array, (mask if mask.any() else None)
+
+def _get_path(data, path):
+    for key in path:
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key)
+    return data
+
+def _month_of(timestamp):
+    if timestamp is None:
+        return None, None
+    moment = datetime.fromtimestamp(timestamp, timezone.utc)
+    return moment.year, moment.month
+
+def _partition_path(table, year, month):
+    if year is None:
+        return os.path.join(table, 'year=unknown')
+    return os.path.join(table, f'year={year}', f'month={month:02d}')
+
+def _arrow_table(values, column_types):
+    arrow_types = {'str': pa.string(), 'int': pa.int64(), 'float': pa.float64(), 'bool': pa.bool_()}
+    return pa.table({column: pa.array(_normalize(values[column], column_type), type=arrow_types[column_type])
+                     for column, column_type in column_types.items()})
+
+def _remove_path(path):
+    # Left behind by an interrupted export: not in the manifest
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+def _write_part(export_dir, relative_path, values, column_types, part_format, previous=None):
+    """
+    Writes a part atomically from {column: list of values}, after the rows of the part `previous`
+    if given. Returns the path of the part, relative to `export_dir`.
+    """
+    if part_format == 'parquet':
+        relative_path += '.parquet'
+        table = _arrow_table(values, column_types)
+        if previous is not None:
+            table = pa.concat_tables([pq.read_table(os.path.join(export_dir, previous['path']), partitioning=None), table])
+    else:
+        columns = {column: _to_column(values[column], column_type) for column, column_type in column_types.items()}
+        if previous is not None:
+            # Loaded in memory, at most MAX_PART_ROWS rows
+            previous_columns = _read_npy_part(export_dir, previous['path'], mmap_mode=None)
+            columns = {column: _concatenate_columns(previous_columns[column], array, mask)
+                       for column, (array, mask) in columns.items()}
+    final_path = os.path.join(export_dir, relative_path)
+    temporary_path = final_path + '.tmp'
+    for path in (temporary_path, final_path):
+        _remove_path(path)
+    os.makedirs(os.path.dirname(final_path), exist_ok=True)
+    if part_format == 'parquet':
+        pq.write_table(table, temporary_path)
+    else:
+        os.makedirs(temporary_path)
+        for name, (array, mask) in columns.items():
+            np.save(os.path.join(temporary_path, f'{name}.npy'), array)
+            if mask is not None:
+                np.save(os.path.join(temporary_path, f'{name}.mask.npy'), mask)
+    os.rename(temporary_path, final_path)
+    return relative_path
+
+def _read_npy_part(export_dir, relative_path, columns=None, mmap_mode='r'):
+    """Returns {column: array} of a .npy part; columns with NULLs are masked arrays."""
+    path = os.path.join(export_dir, relative_path)
+    names = columns or sorted(file_name[:-len('.npy')] for file_name in os.listdir(path)
+                              if file_name.endswith('.npy') and not file_name.endswith('.mask.npy'))
+    part = {}
+    for name in names:
+        array = np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode)
+        mask_path = os.path.join(path, f'{name}.mask.npy')
+        part[name] = np.ma.masked_array(array, np.load(mask_path, mmap_mode=mmap_mode)) if os.path.exists(mask_path) else array
+    return part
+
+def _read_parquet_part(export_dir, relative_path, columns=None):
+    """Returns {column: array} of a Parquet part, like _read_npy_part (strings as object arrays)."""
+    # partitioning=None: the year=/month= directories of the path are not columns of the part
+    table = pq.read_table(os.path.join(export_dir, relative_path), columns=columns, memory_map=True, partitioning=None)
+    part = {}
+    for name, column in zip(table.column_names, table.columns):
+        column = column.combine_chunks()
+        if pa.types.is_floating(column.type):
+            # NaN marks the missing values, as in the .npy parts
+            part[name] = column.fill_null(np.nan).to_numpy(zero_copy_only=False)
+            continue
+        mask = column.is_null().to_numpy(zero_copy_only=False)
+        default = '' if pa.types.is_string(column.type) else (False if pa.types.is_boolean(column.type) else 0)
+        array = column.fill_null(default).to_numpy(zero_copy_only=False)
+        part[name] = np.ma.masked_array(array, mask) if mask.any() else array
+    return part
+
+def _read_part(export_dir, part, columns=None):
+    if part.get('format', 'npy') == 'parquet':
+        if pq is None:
+            raise RuntimeError("The export has Parquet parts: reading them needs pyarrow (pip install pyarrow).")
+        return _read_parquet_part(export_dir, part['path'], columns)
+    return _read_npy_part(export_dir, part['path'], columns)
+
+def _load_manifest(export_dir):
+    path = os.path.join(export_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {'fires': {'parts': []}, 'fire_updates': {'last_update_id': 0, 'parts': []}}
+    with open(path) as manifest_file:
+        return json.load(manifest_file)
+
+def _save_manifest(export_dir, manifest):
+    path = os.path.join(export_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1)
+    os.replace(path + '.tmp', path)
+
+# --- Export ---
+
+def _flatten_update_rows(cursor, rows):
+    """Builds the column lists of a chunk of fire_updates rows, with the fields of their JSON."""
+    # The JSON of each row is replayed per fire from its nearest keyframe (see fire_history.py)
+    update_ids_by_fire = {}
+    for row in rows:
+        update_ids_by_fire.setdefault(row['fire_id'], []).append(row['update_id'])
+    states = {}
+    for fire_id, update_ids in update_ids_by_fire.items():
+        states.update(zip(update_ids, replay_fire_states(cursor, fire_id, update_ids)))
+
+    values = {column: [row[column] for row in rows] for column in FIRE_UPDATE_COLUMN_TYPES}
+    for column, (path, _) in RAW_DATA_COLUMN_TYPES.items():
+        values['raw_' + column] = [_get_path(states[row['update_id']], path) for row in rows]
+    return values
+
+def _column_types():
+    types = dict(FIRE_UPDATE_COLUMN_TYPES)
+    types.update({'raw_' + column: column_type for column, (_, column_type) in RAW_DATA_COLUMN_TYPES.items()})
+    return types
+
+def _append_update_parts(export_dir, manifest, values, column_types, part_format):
+    """Writes the rows of a chunk into their month partitions, merging each month's small last part."""
+    parts = manifest['fire_updates']['parts']
+    rows_by_partition = {}
+    for position, commit_timestamp in enumerate(values['commit_timestamp']):
+        rows_by_partition.setdefault(_month_of(commit_timestamp), []).append(position)
+
+    for (year, month), positions in sorted(rows_by_partition.items(), key=lambda item: item[1][0]):
+        partition = _partition_path('fire_updates', year, month)
+        new_values = {column: [values[column][position] for position in positions] for column in column_types}
+        previous_part = next((part for part in reversed(parts) if part['partition'] == partition), None)
+        if (previous_part and previous_part.get('format', 'npy') == part_format
+                and previous_part['rows'] + len(positions) <= MAX_PART_ROWS):
+            # Merged rather than adding a part per incremental run
+            first_update_id = previous_part['first_update_id']
+            rows = previous_part['rows'] + len(positions)
+        else:
+            previous_part = None
+            first_update_id = values['update_id'][positions[0]]
+            rows = len(positions)
+        last_update_id = values['update_id'][positions[-1]]
+        path = _write_part(export_dir, os.path.join(partition, f'part-{first_update_id:012d}-{last_update_id:012d}'),
+                           new_values, column_types, part_format, previous_part)
+        part = {'partition': partition, 'path': path, 'format': part_format, 'rows': rows,
+                'first_update_id': first_update_id, 'last_update_id': last_update_id}
+        if previous_part:
+            parts[parts.index(previous_part)] = part
+            manifest.setdefault('obsolete_paths', []).append(previous_part['path'])
+        else:
+            parts.append(part)
+
+def _concatenate_columns(previous, array, mask):
+    previous_mask = np.ma.getmaskarray(previous) if isinstance(previous, np.ma.MaskedArray) else np.zeros(len(previous), dtype=bool)
+    merged = np.concatenate([np.ma.getdata(previous), array])
+    merged_mask = np.concatenate([previous_mask, mask if mask is not None else np.zeros(len(array), dtype=bool)])
+    return merged, (merged_mask if merged_mask.any() else None)
+
+def _remove_obsolete_parts(export_dir, manifest):
+    for path in manifest.pop('obsolete_paths', []):
+        try:
+            _remove_path(os.path.join(export_dir, path))
+        except OSError:
+            pass
+
+def export_fire_updates(conn, export_dir, manifest, chunk_rows=CHUNK_ROWS, part_format=DEFAULT_PART_FORMAT):
+    """Exports the fire_updates rows after the manifest's watermark. Returns the number of rows exported."""
+    conn.row_factory = sqlite3.Row
+    cursor = conn.cursor()
+    column_types = _column_types()
+    last_update_id = manifest['fire_updates']['last_update_id']
+    exported_rows = 0
+    while True:
+        cursor.execute(f'''
+            SELECT {', '.join(FIRE_UPDATE_COLUMN_TYPES)} FROM fire_updates
+            WHERE update_id > ? ORDER BY update_id LIMIT ?
+        ''', (last_update_id, chunk_rows))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        values = _flatten_update_rows(conn.cursor(), rows)
+        _append_update_parts(export_dir, manifest, values, column_types, part_format)
+        last_update_id = rows[-1]['update_id']
+        manifest['fire_updates']['last_update_id'] = last_update_id
+        manifest['columns'] = {'fire_updates': column_types, 'fires': FIRE_COLUMN_TYPES}
+        # The manifest moves forward once the chunk's parts are on disk
+        _save_manifest(export_dir, manifest)
+        _remove_obsolete_parts(export_dir, manifest)
+        exported_rows += len(rows)
+        print(f"  Exported {exported_rows} fire updates (up to update {last_update_id})...")
+    conn.row_factory = None
+    return exported_rows
+
+def export_fires(conn, export_dir, manifest, part_format=DEFAULT_PART_FORMAT):
+    """Re-exports the whole fires table, partitioned by first seen month. Returns the number of fires."""
+    rows = conn.execute(f"SELECT {', '.join(FIRE_COLUMN_TYPES)} FROM fires ORDER BY first_seen_data_timestamp, fire_id").fetchall()
+    first_seen_position = list(FIRE_COLUMN_TYPES).index('first_seen_data_timestamp')
+    rows_by_partition = {}
+    for row in rows:
+        rows_by_partition.setdefault(_month_of(row[first_seen_position]), []).append(row)
+
+    export_version = int(time.time() * 1000)
+    parts = []
+    for (year, month), partition_rows in rows_by_partition.items():
+        partition = _partition_path('fires', year, month)
+        values = {column: [row[position] for row in partition_rows] for position, column in enumerate(FIRE_COLUMN_TYPES)}
+        path = _write_part(export_dir, os.path.join(partition, f'part-{export_version}'), values, FIRE_COLUMN_TYPES, part_format)
+        parts.append({'partition': partition, 'path': path, 'format': part_format, 'rows': len(partition_rows)})
+    manifest['obsolete_paths'] = [part['path'] for part in manifest['fires']['parts']]
+    manifest['fires'] = {'parts': parts, 'exported_at': export_version // 1000}
+    _save_manifest(export_dir, manifest)
+    _remove_obsolete_parts(export_dir, manifest)
+    return len(rows)
+
+def export_history(db_path, export_dir, full=False, chunk_rows=CHUNK_ROWS, part_format=DEFAULT_PART_FORMAT):
+    """
+    Brings the export in `export_dir` up to date with the database (from scratch with `full`),
+    writing new parts in `part_format` ('parquet' or 'npy').
+    """
+    if part_format == 'parquet' and pq is None:
+        raise RuntimeError("Writing Parquet needs pyarrow (pip install pyarrow), or use the npy format.")
+    if full and os.path.exists(export_dir):
+        shutil.rmtree(export_dir)
+    os.makedirs(export_dir, exist_ok=True)
+    manifest = _load_manifest(export_dir)
+    _remove_obsolete_parts(export_dir, manifest) # Left by an interrupted run
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        start = time.perf_counter()
+        fire_count = export_fires(conn, export_dir, manifest, part_format)
+        update_count = export_fire_updates(conn, export_dir, manifest, chunk_rows, part_format)
+    finally:
+        conn.close()
+    print(f"Exported {fire_count} fires and {update_count} new fire updates to '{export_dir}' "
+          f"in {time.perf_counter() - start:.2f}s ({len(manifest['fire_updates']['parts'])} update parts).")
+
+# --- Reader ---
+
+class HistoryExport:
+    """
+    Reads an export written by `export_history` as NumPy arrays (strings of Parquet parts as object
+    arrays). Files are memory-mapped: only the pages of the columns that are used are read.
+    """
+
+    def __init__(self, export_dir):
+        self.export_dir = export_dir
+        self.manifest = _load_manifest(export_dir)
+
+    @property
+    def last_update_id(self):
+        return self.manifest['fire_updates']['last_update_id']
+
+    def parts(self, table, from_month=None, to_month=None):
+        """
+        Parts of `table` ('fires' or 'fire_updates'), optionally only those of months 'YYYY-MM' in a
+        range. The year=unknown part (rows without a timestamp) belongs to no month: it is only
+        selected without a range.
+        """
+        selected = []
+        for part in self.manifest[table]['parts']:
+            month = part['partition'].replace(os.sep, '/').split('/year=')[1].replace('/month=', '-')
+            if month == 'unknown':
+                if from_month or to_month:
+                    continue
+            elif (from_month and month < from_month) or (to_month and month > to_month):
+                continue
+            selected.append(part)
+        return selected
+
+    def iter_parts(self, table, columns=None, from_month=None, to_month=None):
+        """Yields {column: array} for each part, oldest first for fire_updates."""
+        for part in self.parts(table, from_month, to_month):
+            yield _read_part(self.export_dir, part, columns)
+
+    def read(self, table, columns=None, from_month=None, to_month=None):
+        """Returns {column: array} over the selected parts (concatenated, so copied into memory)."""
+        parts = list(self.iter_parts(table, columns, from_month, to_month))
+        if not parts:
+            return {}
+        result = {}
+        for column in parts[0]:
+            arrays = [part[column] for part in parts]
+            if any(isinstance(array, np.ma.MaskedArray) for array in arrays):
+                result[column] = np.ma.concatenate(arrays)
+            else:
+                result[column] = np.concatenate(arrays)
+        return result
+
+    def read_arrow(self, table, columns=None, from_month=None, to_month=None):
+        """Returns the selected parts as one pyarrow Table. Needs pyarrow, and an export in Parquet."""
+        if pq is None:
+            raise RuntimeError("read_arrow needs pyarrow (pip install pyarrow).")
+        parts = self.parts(table, from_month, to_month)
+        if any(part.get('format', 'npy') != 'parquet' for part in parts):
+            raise ValueError("The export has .npy parts: export it again with --full --format parquet.")
+        return pa.concat_tables([pq.read_table(os.path.join(self.export_dir, part['path']), columns=columns, memory_map=True, partitioning=None)
+                                 for part in parts])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exports fires and fire_updates to partitioned columnar files.")
+    parser.add_argument("db_path", nargs="?", default="fires.sqlite", help="Path of the database (default: fires.sqlite)")
+    parser.add_argument("export_dir", nargs="?", default="export", help="Directory of the export (default: export)")
+    parser.add_argument("--full", action="store_true", help="Discard the existing export and export everything again")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS,
+                        help=f"fire_updates rows read per chunk (default: {CHUNK_ROWS})")
+    parser.add_argument("--format", choices=PART_FORMATS, default=DEFAULT_PART_FORMAT,
+                        help=f"Format of the new parts (default: parquet if pyarrow is installed, else npy; now {DEFAULT_PART_FORMAT})")
+    args = parser.parse_args()
+    export_history(args.db_path, args.export_dir, args.full, args.chunk_rows, args.format)
@@ -0,0 +1,352 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import signal
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+import git
+import bd_manager
+from bd_manager import (apply_snapshot, commit_ingest_batch, get_data_version, get_last_processed_commit_hash,
+                        load_current_fire_states_from_db, LIVE_SNAPSHOT_PREFIX)
+from fire_state import FireStateStore, DEFAULT_EVICTION_HORIZON
+from fire_writer import FireWriter
+from git_blobs import list_commits, iter_file_blobs
+from snapshot_cache import SnapshotCache
+from snapshot_parsers import make_snapshot_parser, SNAPSHOT_PARSERS
+
+# --- Live Ingest Daemon ---
+# bd_manager.py walks the git commits added since its last run, so the API is only as fresh as the
+# scraper's commits plus the schedule of the ingest. This daemon keeps the ingest state warm (fire
+# states, writer, parsed snapshots) and applies new data within seconds, with the same
+# NEW/UPDATED/DISAPPEARED semantics (bd_manager.apply_snapshot), from any of:
+#  - the repository: the ref is polled (optionally after a `git fetch`) and new commits are applied
+#    as soon as it moves,
+#  - a local file, applied whenever it changes,
+#  - HTTP: POST /snapshot with the fogos.json body (GET /version returns the data version).
+# Snapshots that don't come from git are logged as commit `snapshot:<git blob id of the content>`,
+# so a scraper commit of the same bytes afterwards is recognized as the same snapshot.
+# Everything is driven by one asyncio loop; all database work runs, in arrival order, on a single
+# writer thread. Each applied batch increments the `data_version` counter in script_metadata, which
+# the API exposes at /api/data-version and uses to invalidate its response cache.
+# Usage: python ingest_daemon.py [repo_path] [json_file] [--watch-file PATH] [--listen 127.0.0.1:8081]
+# Do not run bd_manager.py against the same database while the daemon is running.
+# While it runs the database is in WAL mode, so the API's directory of the database must be writable
+# (it goes back to the rollback journal when the daemon stops, see bd_manager.close_db).
+
+POLL_INTERVAL = 5.0 # Seconds between two checks of the ref and of the watched file
+MAX_SNAPSHOT_BYTES = 16 * 1024 * 1024
+# Live snapshots dated further in the future than this are rejected: a later scraper commit would
+# be dated before them (their activity intervals then end up empty, see fire_intervals.py)
+MAX_SNAPSHOT_CLOCK_SKEW = 60
+INGEST_TOKEN = os.environ.get('FIRES_INGEST_TOKEN') # If set, POST /snapshot requires "Authorization: Bearer <token>"
+
+def git_blob_id(content):
+    """The object id git gives a blob with this content."""
+    return hashlib.sha1(b'blob %d\0' % len(content) + content).hexdigest()
+
+class LiveIngest:
+    """
+    The ingest state kept between snapshots. Not thread-safe: the daemon only uses it from its
+    writer thread (the SQLite connection is bound to the thread that opened it).
+    """
+
+    def __init__(self, db_path, repo_path=None, json_file_path_in_repo='fogos.json', json_parser=None,
+                 batch_size=20, eviction_horizon=DEFAULT_EVICTION_HORIZON):
+        self.repo = git.Repo(repo_path) if repo_path else None
+        self.json_file_path_in_repo = json_file_path_in_repo
+        self.batch_size = batch_size
+        if self.repo is not None:
+            # Catch up with the commits made while the daemon wasn't running
+            bd_manager.process_repository_incrementally(repo_path, json_file_path_in_repo, batch_size=batch_size,
+                                                        json_parser=json_parser, eviction_horizon=eviction_horizon,
+                                                        db_path=db_path)
+        self.conn = bd_manager.init_db(db_path)
+        cursor = self.conn.cursor()
+        self.last_commit_hash = get_last_processed_commit_hash(cursor)
+        self.data_version = get_data_version(cursor)
+
+        self.fire_states = FireStateStore(self.conn.cursor(), eviction_horizon)
+        if self.fire_states.load(self.last_commit_hash, int(time.time())):
+            print(f"Loaded {len(self.fire_states)} fire states from the checkpoint.")
+        else:
+            cursor.execute("SELECT 1 FROM fires LIMIT 1")
+            if cursor.fetchone() and self.repo is None:
+                raise RuntimeError("The database has no fire state checkpoint: run bd_manager.py on it once first.")
+            self.fire_states.reset()
+            if self.repo is not None:
+                for fire_id, fire_data in load_current_fire_states_from_db(self.repo, self.conn, json_file_path_in_repo).items():
+                    self.fire_states.set(fire_id, fire_data, None)
+
+        cursor.execute("SELECT fire_id FROM fires")
+        self.writer = FireWriter(cursor, {row[0] for row in cursor.fetchall()})
+        self.snapshot_cache = SnapshotCache(make_snapshot_parser(json_parser))
+        self.previous_snapshot_id = None # Blob id of the snapshot the fire states reflect
+        self.current_fires_map = {}
+
+    def _apply(self, commit_hash, commit_timestamp, blob_oid, json_content):
+        """Diffs one snapshot into the writer. Returns the change counts."""
+        if blob_oid is not None and blob_oid == self.previous_snapshot_id:
+            # Same snapshot as the previous one: only the presence of its fires is confirmed
+            for fire_id in self.current_fires_map:
+                self.writer.confirm_fire(fire_id, commit_hash)
+            change_counts = {'NEW': 0, 'UPDATED': 0, 'DISAPPEARED': 0, 'UNCHANGED': len(self.current_fires_map)}
+        else:
+            self.current_fires_map = self.snapshot_cache.get(blob_oid, json_content)
+            change_counts = apply_snapshot(self.writer, self.fire_states, commit_hash, commit_timestamp, self.current_fires_map)
+        self.previous_snapshot_id = blob_oid
+        return change_counts
+
+    def _commit(self, commit_hash, now):
+        commit_ingest_batch(self.conn, self.writer, self.fire_states, commit_hash, now)
+        self.last_commit_hash = commit_hash
+        self.data_version = get_data_version(self.conn.cursor())
+
+    def apply_commits(self, ref):
+        """Applies the commits from the last processed one up to `ref`. Returns the number of commits applied."""
+        head_commit_hash = self.repo.commit(ref).hexsha
+        if head_commit_hash == self.last_commit_hash:
+            return 0
+        try:
+            commits = list_commits(self.repo, f"{self.last_commit_hash}..{head_commit_hash}" if self.last_commit_hash else head_commit_hash)
+        except git.exc.GitCommandError as e:
+            # The history was rewritten: the database no longer matches it
+            print(f"Cannot list the commits after {self.last_commit_hash[:7]} ({e}). A full rebuild (bd_creator.py) is needed.")
+            return 0
+        commit_blobs = iter_file_blobs(self.repo, commits, self.json_file_path_in_repo)
+        for i, (commit_hash, commit_timestamp, blob_oid, json_content) in enumerate(commit_blobs):
+            change_counts = self._apply(commit_hash, commit_timestamp, blob_oid, json_content)
+            print(f"Commit {commit_hash[:7]}: {change_counts['NEW']} new, {change_counts['UPDATED']} updated, "
+                  f"{change_counts['DISAPPEARED']} disappeared.")
+            if (i + 1) % self.batch_size == 0 or (i + 1) == len(commits):
+                self._commit(commit_hash, commit_timestamp)
+        return len(commits)
+
+    def apply_live_snapshot(self, content, timestamp):
+        """
+        Applies a fogos.json snapshot received outside git, seen at `timestamp`. Returns the change
+        counts, or None if it is the snapshot the database already reflects. Raises ValueError for
+        content that isn't a successful fogos.json response, rather than taking it as "every fire
+        disappeared", and for a `timestamp` in the future.
+        """
+        if timestamp > time.time() + MAX_SNAPSHOT_CLOCK_SKEW:
+            raise ValueError("The snapshot timestamp is in the future.")
+        blob_oid = git_blob_id(content)
+        if blob_oid == self.previous_snapshot_id:
+            return None
+        if not self.snapshot_cache.get(blob_oid, content):
+            try:
+                data = json.loads(content)
+            except ValueError:
+                raise ValueError("The snapshot is not valid JSON.")
+            if not (isinstance(data, dict) and data.get('success') and data.get('data') == []):
+                raise ValueError("The snapshot is not a successful response with a list of fires.")
+        change_counts = self._apply(LIVE_SNAPSHOT_PREFIX + blob_oid, timestamp, blob_oid, content)
+        # The states still correspond to the last processed commit plus this snapshot, which is
+        # what the next commits will be diffed against
+        self._commit(self.last_commit_hash, timestamp)
+        print(f"Snapshot {blob_oid[:7]}: {change_counts['NEW']} new, {change_counts['UPDATED']} updated, "
+              f"{change_counts['DISAPPEARED']} disappeared (data version {self.data_version}).")
+        return change_counts
+
+    def close(self):
+        bd_manager.close_db(self.conn)
+
+class IngestDaemon:
+    """Runs the snapshot sources and the single writer on an asyncio loop."""
+
+    def __init__(self, ingest_args, repo_path=None, ref='HEAD', fetch_remote=None, watch_file=None, listen=None,
+                 poll_interval=POLL_INTERVAL):
+        self.ingest_args = ingest_args
+        self.repo_path = repo_path
+        self.ref = ref
+        self.fetch_remote = fetch_remote
+        self.watch_file = watch_file
+        self.listen = listen
+        self.poll_interval = poll_interval
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ingest-writer')
+        self.ingest = None
+        self.queue = None
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.ingest = await loop.run_in_executor(self.executor, lambda: LiveIngest(repo_path=self.repo_path, **self.ingest_args))
+        print(f"Live ingest ready at data version {self.ingest.data_version}.")
+        tasks = [asyncio.ensure_future(self.write_snapshots())]
+        if self.repo_path:
+            tasks.append(asyncio.ensure_future(self.watch_ref()))
+        if self.watch_file:
+            tasks.append(asyncio.ensure_future(self.watch_snapshot_file()))
+        server = None
+        if self.listen:
+            host, _, port = self.listen.rpartition(':')
+            server = await asyncio.start_server(self.handle_http, host or '127.0.0.1', int(port))
+            print(f"Accepting snapshots at http://{self.listen}/snapshot")
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            if server is not None:
+                server.close()
+            # Lets the writer thread finish the batch it is on before closing the database
+            self.executor.submit(self.ingest.close).result()
+            self.executor.shutdown(wait=True)
+
+    async def write_snapshots(self):
+        """The single writer: applies the queued work in order on the writer thread."""
+        loop = asyncio.get_running_loop()
+        while True:
+            function, arguments, future = await self.queue.get()
+            try:
+                result = await loop.run_in_executor(self.executor, function, *arguments)
+            except Exception as e:
+                if future is None:
+                    print(f"Ingest failed: {e!r}")
+                elif not future.done():
+                    future.set_exception(e)
+            else:
+                if future is not None and not future.done():
+                    future.set_result(result)
+
+    async def watch_ref(self):
+        """Queues the new commits whenever the ref moves."""
+        loop = asyncio.get_running_loop()
+        repo = git.Repo(self.repo_path) # Its own Repo: the writer thread uses the other one
+        queued_commit_hash = None
+        while True:
+            try:
+                if self.fetch_remote:
+                    await loop.run_in_executor(None, repo.git.fetch, '--quiet', self.fetch_remote)
+                commit_hash = await loop.run_in_executor(None, repo.git.rev_parse, self.ref)
+            except git.exc.GitCommandError as e:
+                print(f"Could not read {self.ref}: {e}")
+            else:
+                if commit_hash != queued_commit_hash:
+                    queued_commit_hash = commit_hash
+                    await self.queue.put((self.ingest.apply_commits, (commit_hash,), None))
+            await asyncio.sleep(self.poll_interval)
+
+    async def watch_snapshot_file(self):
+        """Queues the watched file whenever its modification time or size changes."""
+        file_signature = None
+        while True:
+            try:
+                stat = os.stat(self.watch_file)
+            except FileNotFoundError:
+                stat = None
+            if stat is not None and (stat.st_mtime_ns, stat.st_size) != file_signature:
+                file_signature = (stat.st_mtime_ns, stat.st_size)
+                with open(self.watch_file, 'rb') as snapshot_file:
+                    content = snapshot_file.read()
+                future = asyncio.get_running_loop().create_future()
+                # A copied file may keep a modification time in the future: it was seen now at the latest
+                timestamp = min(int(stat.st_mtime), int(time.time()))
+                await self.queue.put((self.ingest.apply_live_snapshot, (content, timestamp), future))
+                try:
+                    await future
+                except ValueError as e:
+                    print(f"Ignored {self.watch_file}: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    def version_info(self):
+        return {
+            'data_version': self.ingest.data_version,
+            'last_processed_commit_hash': self.ingest.last_commit_hash,
+            'snapshot': self.ingest.previous_snapshot_id,
+            'queued': self.queue.qsize(),
+        }
+
+    async def handle_http(self, reader, writer):
+        """A minimal HTTP/1.1 endpoint, one request per connection."""
+        status, body = 400, {'message': 'Bad request.'}
+        try:
+            method, target, _ = (await reader.readline()).decode('latin-1').split(' ', 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+            url = urlsplit(target)
+            if method == 'GET' and url.path == '/version':
+                status, body = 200, self.version_info()
+            elif method == 'POST' and url.path == '/snapshot':
+                content_length = int(headers.get('content-length', 0))
+                if INGEST_TOKEN and headers.get('authorization') != f'Bearer {INGEST_TOKEN}':
+                    status, body = 401, {'message': 'Missing or wrong token.'}
+                elif content_length > MAX_SNAPSHOT_BYTES:
+                    status, body = 413, {'message': 'Snapshot too large.'}
+                else:
+                    content = await reader.readexactly(content_length)
+                    timestamp = int(parse_qs(url.query).get('ts', [time.time()])[0]) # Seconds
+                    future = asyncio.get_running_loop().create_future()
+                    await self.queue.put((self.ingest.apply_live_snapshot, (content, timestamp), future))
+                    try:
+                        change_counts = await future
+                        status, body = 200, dict(self.version_info(), changes=change_counts)
+                    except ValueError as e:
+                        status, body = 400, {'message': str(e)}
+                    except Exception as e:
+                        status, body = 500, {'message': f'Ingest failed: {e!r}'}
+            else:
+                status, body = 404, {'message': 'Not found.'}
+        except (ValueError, asyncio.IncompleteReadError):
+            pass
+        payload = json.dumps(body).encode('utf-8')
+        reason = {200: 'OK', 400: 'Bad Request', 401: 'Unauthorized', 404: 'Not Found', 413: 'Payload Too Large',
+                  500: 'Internal Server Error'}[status]
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n"
+                     f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode('latin-1') + payload)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+def main():
+    parser = argparse.ArgumentParser(description="Applies new fire snapshots to the database as soon as they arrive.")
+    parser.add_argument("repo_path", nargs="?", help="Git repository to follow (omit to only take file/HTTP snapshots)")
+    parser.add_argument("json_file", nargs="?", default="fogos.json", help="Path of the JSON file inside the repository (default: fogos.json)")
+    parser.add_argument("--db", default=os.environ.get('FIRES_DB_PATH', bd_manager.DB_NAME),
+                        help="Path of the database (default: FIRES_DB_PATH, else fires.sqlite)")
+    parser.add_argument("--ref", default="HEAD", help="Ref to follow, e.g. origin/main with --fetch (default: HEAD)")
+    parser.add_argument("--fetch", metavar="REMOTE", help="git fetch REMOTE before each check of the ref")
+    parser.add_argument("--watch-file", help="Apply this fogos.json whenever it changes")
+    parser.add_argument("--listen", help="host:port to accept POST /snapshot on, e.g. 127.0.0.1:8081")
+    parser.add_argument("--poll-interval", type=float, default=POLL_INTERVAL,
+                        help=f"Seconds between checks of the ref and the file (default: {POLL_INTERVAL:g})")
+    parser.add_argument("--batch-size", type=int, default=20, help="Commits written per transaction when catching up (default: 20)")
+    parser.add_argument("--json-parser", choices=('auto',) + SNAPSHOT_PARSERS,
+                        help="Snapshot JSON parser (default: FIRES_JSON_PARSER, else the fastest installed)")
+    parser.add_argument("--evict-after-days", type=float, default=DEFAULT_EVICTION_HORIZON / 86400,
+                        help="Days an inactive fire stays in memory after it was last seen, 0 to keep every fire "
+                             f"(default: {DEFAULT_EVICTION_HORIZON // 86400:.0f})")
+    args = parser.parse_args()
+    if not (args.repo_path or args.watch_file or args.listen):
+        parser.error("nothing to ingest: give a repository, --watch-file or --listen")
+
+    daemon = IngestDaemon(
+        {'db_path': args.db, 'json_file_path_in_repo': args.json_file, 'json_parser': args.json_parser,
+         'batch_size': args.batch_size, 'eviction_horizon': args.evict_after_days * 86400 or None},
+        repo_path=args.repo_path, ref=args.ref, fetch_remote=args.fetch, watch_file=args.watch_file,
+        listen=args.listen, poll_interval=args.poll_interval)
+
+    async def run_until_stopped():
+        main_task = asyncio.ensure_future(daemon.run())
+        for signal_number in (signal.SIGINT, signal.SIGTERM):
+            asyncio.get_running_loop().add_signal_handler(signal_number, main_task.cancel)
+        try:
+            await main_task
+        except asyncio.CancelledError:
+            print("Stopped.")
+        except RuntimeError as e:
+            raise SystemExit(str(e))
+
+    asyncio.run(run_until_stopped())
+
+if __name__ == "__main__":
+    main()
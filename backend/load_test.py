@@ -0,0 +1,196 @@
+import argparse
+import concurrent.futures
+import http.client
+import multiprocessing
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from benchmark_api import create_synthetic_db, percentile
+
+# --- API Load Test ---
+# Starts the production server (gunicorn with gunicorn.conf.py, or uvicorn with asgi.py) with 1, 4
+# and 16 workers in turn and drives every /api/fires/* route with concurrent keep-alive clients,
+# reporting the p50/p99 latency and the requests per second of each. Where benchmark_api.py times
+# the query layer one request at a time, this measures how the server scales across processes.
+# The clients run in processes of their own on the same machine, so on small machines they compete
+# with the workers for the CPU: compare runs made on the same host. The response cache is disabled
+# unless --response-cache is given, so every request reads the database.
+# Usage: python load_test.py [--db fires.sqlite] [--workers 1,4,16] [--server gunicorn|uvicorn]
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+# The stream route holds its connection open: it is not a request/response route to load
+SKIPPED_ROUTES = ('/api/fires/stream',)
+
+def route_queries(db_path):
+    """Returns {route: query string} for the parameters of the routes that need some, and the default one."""
+    with sqlite3.connect(db_path) as conn:
+        min_ts, max_ts = conn.execute("SELECT MIN(first_seen_data_timestamp), MAX(first_seen_data_timestamp) FROM fires").fetchone()
+        # A fire with a few updates, for the per-fire routes
+        fire_id = conn.execute("SELECT fire_id FROM fire_updates GROUP BY fire_id ORDER BY COUNT(*) DESC, fire_id LIMIT 1").fetchone()[0]
+    dates = f"fromDate={min_ts * 1000}&toDate={max_ts * 1000}"
+    return fire_id, {
+        '/api/fires': '',
+        '/api/fires/available-date-range': '',
+        '/api/fires/bbox': f'bbox=-9.6,36.9,-6.1,42.2&zoom=7&{dates}',
+        '/api/fires/near': 'lat=39.5&lng=-8.0&radius_km=25',
+        '/api/fires/at': f'ts={(min_ts + max_ts) // 2 * 1000}',
+        '/api/fires/<fire_id>/resources': 'resolution=hour',
+        '/api/fires/<fire_id>/changes': '',
+        '/api/fires/<fire_id>/state': '',
+    }, dates
+
+def route_urls(db_path):
+    """The url to load for every /api/fires/* route of the app, with realistic parameters."""
+    os.environ['FIRES_DB_PATH'] = db_path
+    import server
+    fire_id, queries, default_query = route_queries(db_path)
+    routes = sorted({rule.rule for rule in server.app.url_map.iter_rules()
+                     if rule.rule.startswith('/api/fires') and rule.rule not in SKIPPED_ROUTES})
+    urls = []
+    for route in routes:
+        query = queries.get(route, default_query)
+        path = route.replace('<fire_id>', fire_id)
+        urls.append((route, f'{path}?{query}' if query else path))
+    return urls
+
+def start_server(server_name, workers, port, env):
+    if server_name == 'gunicorn':
+        command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--workers', str(workers),
+                   '--bind', f'127.0.0.1:{port}', 'wsgi:app']
+    else:
+        command = [sys.executable, '-m', 'uvicorn', 'asgi:app', '--workers', str(workers), '--port', str(port),
+                   '--log-level', 'warning', '--no-access-log']
+    process = subprocess.Popen(command, cwd=BACKEND_DIR, env=env)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{server_name} exited with code {process.returncode}")
+        try:
+            conn = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            conn.request('GET', '/health')
+            if conn.getresponse().status == 200:
+                conn.close()
+                return process
+        except OSError:
+            pass
+        time.sleep(0.2)
+    stop_server(process)
+    raise RuntimeError(f"{server_name} did not answer /health within 60 s")
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+def run_clients(port, url, connections, duration):
+    """
+    Sends requests for `url` on `connections` keep-alive connections, each from a thread of its
+    own, for `duration` seconds. Returns (latencies in ms, errors). Runs in a client process.
+    """
+    deadline = time.monotonic() + duration
+    latencies, errors = [], []
+    def client():
+        conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        samples, failures = [], 0
+        while time.monotonic() < deadline:
+            start = time.perf_counter()
+            try:
+                conn.request('GET', url)
+                response = conn.getresponse()
+                response.read()
+                if response.status != 200:
+                    failures += 1
+            except (OSError, http.client.HTTPException):
+                failures += 1
+                conn.close()
+                conn = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+                continue
+            samples.append((time.perf_counter() - start) * 1000)
+        conn.close()
+        latencies.extend(samples)
+        errors.append(failures)
+    threads = [threading.Thread(target=client) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, sum(errors)
+
+def load_url(client_pool, client_processes, port, url, concurrency, duration):
+    """Loads `url` with `concurrency` connections spread over the client processes. Returns (latencies, errors)."""
+    shares = [concurrency // client_processes + (n < concurrency % client_processes) for n in range(client_processes)]
+    futures = [client_pool.submit(run_clients, port, url, share, duration) for share in shares if share]
+    latencies, errors = [], 0
+    for future in futures:
+        process_latencies, process_errors = future.result()
+        latencies.extend(process_latencies)
+        errors += process_errors
+    return latencies, errors
+
+def main():
+    parser = argparse.ArgumentParser(description="Load tests the fires API server with several worker counts.")
+    parser.add_argument("--db", help="Existing database to serve (default: a synthetic one)")
+    parser.add_argument("--fires", type=int, default=50000, help="Fires in the synthetic database (default: 50000)")
+    parser.add_argument("--server", choices=('gunicorn', 'uvicorn'), default='gunicorn',
+                        help="Server to load: gunicorn (wsgi.py) or uvicorn (asgi.py) (default: gunicorn)")
+    parser.add_argument("--workers", default='1,4,16', help="Comma-separated worker counts to test (default: 1,4,16)")
+    parser.add_argument("--concurrency", type=int, default=32, help="Concurrent connections per route (default: 32)")
+    parser.add_argument("--duration", type=float, default=5, help="Seconds of load per route (default: 5)")
+    parser.add_argument("--port", type=int, default=5099, help="Port to start the server on (default: 5099)")
+    parser.add_argument("--response-cache", action="store_true", help="Leave the response cache enabled")
+    args = parser.parse_args()
+
+    db_path = args.db
+    if not db_path:
+        db_path = os.path.join(tempfile.mkdtemp(), 'fires.sqlite')
+        print(f"Creating a synthetic database with {args.fires} fires in {db_path}...")
+        create_synthetic_db(db_path, args.fires)
+    db_path = os.path.abspath(db_path)
+    urls = route_urls(db_path)
+
+    env = dict(os.environ, FIRES_DB_PATH=db_path)
+    if not args.response_cache:
+        env['FIRES_RESPONSE_CACHE_SIZE'] = '0'
+        env.pop('FIRES_RESPONSE_CACHE_PATH', None)
+    worker_counts = [int(count) for count in args.workers.split(',')]
+    client_processes = max(1, min(args.concurrency, multiprocessing.cpu_count()))
+    # Spawned, so the client processes don't inherit the server module imported by route_urls
+    client_pool = concurrent.futures.ProcessPoolExecutor(client_processes, mp_context=multiprocessing.get_context('spawn'))
+
+    results = {}
+    try:
+        for workers in worker_counts:
+            print(f"Loading {args.server} with {workers} workers, {args.concurrency} connections, {args.duration} s per route...")
+            process = start_server(args.server, workers, args.port, env)
+            try:
+                for route, url in urls:
+                    # Warm-up: the first request of each worker process opens its connections
+                    load_url(client_pool, client_processes, args.port, url, args.concurrency, 0.2)
+                    latencies, errors = load_url(client_pool, client_processes, args.port, url, args.concurrency, args.duration)
+                    results[route, workers] = (latencies, errors)
+            finally:
+                stop_server(process)
+    finally:
+        client_pool.shutdown()
+
+    print(f"\n{'route':<40}" + ''.join(f"{f'{workers} workers: p50/p99 ms, req/s':>38}" for workers in worker_counts))
+    for route, _ in urls:
+        row = f"{route:<40}"
+        for workers in worker_counts:
+            latencies, errors = results[route, workers]
+            if not latencies:
+                row += f"{'no responses':>38}"
+                continue
+            row += f"{percentile(latencies, 0.5):>15.1f} / {percentile(latencies, 0.99):>7.1f}, {len(latencies) / args.duration:>8.0f}"
+            row += f" ({errors} errors)" if errors else ''
+        print(row)
+
+if __name__ == "__main__":
+    main()
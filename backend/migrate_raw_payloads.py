@@ -0,0 +1,129 @@
+import argparse
+import json
+import os
+import bd_manager
+from raw_payloads import (build_compression_dictionary, canonical_json, get_compression_dictionary,
+                          load_raw_payloads, store_raw_payload)
+
+# --- Raw Payload Migration ---
+# Moves the `fire_updates.raw_data` JSON of a database written before the raw payload store into
+# `raw_payloads` (see raw_payloads.py), in batches that each commit, so it can be interrupted and
+# run again. Optionally trains a compression dictionary first and VACUUMs afterwards, which is what
+# actually gives the freed pages back, then reports how much the file shrank.
+# Usage: python migrate_raw_payloads.py [fires.sqlite] [--train-dictionary] [--vacuum]
+
+DICTIONARY_SAMPLE_SIZE = 2000
+
+def get_file_size(db_path):
+    """Size of the database including its WAL, which holds pages not checkpointed yet."""
+    return sum(os.path.getsize(path) for path in (db_path, db_path + '-wal') if os.path.exists(path))
+
+def get_payload_sizes(cursor):
+    cursor.execute("SELECT COALESCE(SUM(LENGTH(CAST(raw_data AS BLOB))), 0), COUNT(raw_data) FROM fire_updates")
+    raw_data_bytes, raw_data_rows = cursor.fetchone()
+    cursor.execute("SELECT COALESCE(SUM(LENGTH(data)), 0), COUNT(*) FROM raw_payloads")
+    payload_bytes, payload_count = cursor.fetchone()
+    return raw_data_bytes, raw_data_rows, payload_bytes, payload_count
+
+def sample_payloads(cursor, sample_size):
+    """Returns up to `sample_size` canonical payloads, from the unmigrated rows or else from the store."""
+    cursor.execute("SELECT raw_data FROM fire_updates WHERE raw_data IS NOT NULL ORDER BY RANDOM() LIMIT ?", (sample_size,))
+    samples = [canonical_json(json.loads(row[0])) for row in cursor.fetchall()]
+    if not samples:
+        cursor.execute("SELECT payload_id FROM raw_payloads ORDER BY RANDOM() LIMIT ?", (sample_size,))
+        payload_ids = [row[0] for row in cursor.fetchall()]
+        samples = [canonical_json(data) for data in load_raw_payloads(cursor, payload_ids).values()]
+    return samples
+
+def train_dictionary(conn, sample_size):
+    """Stores a dictionary built from a sample of the payloads and recompresses the stored payloads with it."""
+    cursor = conn.cursor()
+    samples = sample_payloads(cursor, sample_size)
+    if not samples:
+        print("No payloads to train a compression dictionary on.")
+        return
+    dictionary_data = build_compression_dictionary(samples)
+    cursor.execute("INSERT INTO raw_payload_dictionaries (data) VALUES (?)", (dictionary_data,))
+    dictionary = (cursor.lastrowid, dictionary_data)
+    print(f"Trained a {len(dictionary_data)} byte compression dictionary on {len(samples)} payloads.")
+
+    # Payloads are only looked up by digest, so recompressing one is replacing its row in place
+    cursor.execute("SELECT payload_id FROM raw_payloads WHERE dictionary_id IS NOT ?", (dictionary[0],))
+    payload_ids = [row[0] for row in cursor.fetchall()]
+    for payload_id, data in load_raw_payloads(cursor, payload_ids).items():
+        cursor.execute("DELETE FROM raw_payloads WHERE payload_id = ?", (payload_id,))
+        new_payload_id = store_raw_payload(cursor, data, dictionary)
+        cursor.execute("UPDATE raw_payloads SET payload_id = ? WHERE payload_id = ?", (payload_id, new_payload_id))
+    conn.commit()
+    if payload_ids:
+        print(f"Recompressed {len(payload_ids)} stored payloads with it.")
+
+def migrate_raw_data(conn, batch_size):
+    """Moves every non-NULL `raw_data` into the payload store. Returns the number of rows moved."""
+    cursor = conn.cursor()
+    dictionary = get_compression_dictionary(cursor)
+    migrated_rows = 0
+    last_update_id = -1
+    while True:
+        cursor.execute('''
+            SELECT update_id, raw_data FROM fire_updates
+            WHERE raw_data IS NOT NULL AND update_id > ?
+            ORDER BY update_id LIMIT ?
+        ''', (last_update_id, batch_size))
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        for update_id, raw_data in rows:
+            payload_id = store_raw_payload(cursor, json.loads(raw_data), dictionary)
+            cursor.execute("UPDATE fire_updates SET raw_payload_id = ?, raw_data = NULL WHERE update_id = ?",
+                           (payload_id, update_id))
+        conn.commit()
+        migrated_rows += len(rows)
+        last_update_id = rows[-1][0]
+        print(f"  Moved the raw data of {migrated_rows} updates...")
+    return migrated_rows
+
+def migrate(db_path, batch_size=5000, train=False, sample_size=DICTIONARY_SAMPLE_SIZE, vacuum=False):
+    conn = bd_manager.init_db(db_path) # Applies the migration creating the payload store
+    cursor = conn.cursor()
+    size_before = get_file_size(db_path)
+    raw_data_bytes, raw_data_rows, payload_bytes_before, _ = get_payload_sizes(cursor)
+
+    if train:
+        train_dictionary(conn, sample_size)
+    migrated_rows = migrate_raw_data(conn, batch_size)
+    conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    if vacuum:
+        print("Vacuuming the database...")
+        conn.execute("VACUUM")
+
+    _, _, payload_bytes, payload_count = get_payload_sizes(cursor)
+    cursor.execute("SELECT COUNT(*) FROM fire_updates WHERE raw_payload_id IS NOT NULL")
+    referencing_rows = cursor.fetchone()[0]
+    bd_manager.close_db(conn)
+    size_after = get_file_size(db_path)
+
+    print("\n--- Raw Payload Migration Report ---")
+    print(f"Updates migrated: {migrated_rows} (raw_data of {raw_data_rows} rows, {raw_data_bytes / 1e6:.2f} MB)")
+    print(f"Distinct payloads: {payload_count} for {referencing_rows} updates, "
+          f"{payload_bytes / 1e6:.2f} MB compressed ({payload_bytes_before / 1e6:.2f} MB before)")
+    if raw_data_bytes:
+        print(f"Payload bytes: {(payload_bytes - payload_bytes_before) / raw_data_bytes:.1%} of the raw_data they replace")
+    print(f"File size: {size_before / 1e6:.2f} MB -> {size_after / 1e6:.2f} MB"
+          + (f" ({size_after / size_before:.1%})" if size_before else ""))
+    if not vacuum:
+        print("The freed pages are reused by new writes; run with --vacuum to shrink the file.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Moves fire_updates.raw_data into the compressed raw payload store.")
+    parser.add_argument("db_path", nargs="?", default="fires.sqlite", help="Path of the database (default: fires.sqlite)")
+    parser.add_argument("--batch-size", type=int, default=5000, help="Updates migrated per transaction (default: 5000)")
+    parser.add_argument("--train-dictionary", action="store_true",
+                        help="Train a compression dictionary on a sample of the payloads first")
+    parser.add_argument("--sample-size", type=int, default=DICTIONARY_SAMPLE_SIZE,
+                        help=f"Payloads sampled to train the dictionary (default: {DICTIONARY_SAMPLE_SIZE})")
+    parser.add_argument("--vacuum", action="store_true", help="VACUUM the database afterwards to shrink the file")
+    args = parser.parse_args()
+    if not os.path.exists(args.db_path):
+        raise SystemExit(f"Database not found: {args.db_path}")
+    migrate(args.db_path, args.batch_size, args.train_dictionary, args.sample_size, args.vacuum)
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import zlib
+from db_metadata import chunked
+
+# --- Raw Payload Store ---
+# Every fire_updates row used to carry the full JSON of the fire in `raw_data`, which made up most of
+# fires.sqlite. Payloads are now stored once per distinct content in `raw_payloads`, addressed by the
+# SHA-256 of their canonical JSON and zlib-compressed, and fire_updates rows point to them through
+# `raw_payload_id` (see bd_manager.MIGRATIONS). A preset dictionary built from typical payloads
+# (see migrate_raw_payloads.py) makes the compression of these small documents much better.
+
+COMPRESSION_LEVEL = 9
+MAX_DICTIONARY_SIZE = 32 * 1024 # zlib only uses the last 32 KiB of a preset dictionary
+
+def canonical_json(fire_data):
+    """Serializes a fire the same way whatever the key order, so equal payloads share one digest."""
+    return json.dumps(fire_data, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+def get_compression_dictionary(cursor):
+    """Returns (dictionary_id, dictionary bytes) of the newest dictionary, or (None, None) if there is none."""
+    cursor.execute("SELECT dictionary_id, data FROM raw_payload_dictionaries ORDER BY dictionary_id DESC LIMIT 1")
+    row = cursor.fetchone()
+    return (row[0], bytes(row[1])) if row else (None, None)
+
+def _compress(payload, dictionary):
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zdict=dictionary) if dictionary else zlib.compressobj(COMPRESSION_LEVEL)
+    return compressor.compress(payload) + compressor.flush()
+
+def store_raw_payload(cursor, fire_data, dictionary=(None, None)):
+    """
+    Returns the payload_id of `fire_data`, storing it if no equal payload is stored yet.
+    `dictionary` is a (dictionary_id, bytes) pair from `get_compression_dictionary`.
+    """
+    payload = canonical_json(fire_data)
+    digest = hashlib.sha256(payload).digest()
+    cursor.execute("SELECT payload_id FROM raw_payloads WHERE digest = ?", (digest,))
+    row = cursor.fetchone()
+    if row:
+        return row[0]
+    dictionary_id, dictionary_data = dictionary
+    cursor.execute("INSERT INTO raw_payloads (digest, dictionary_id, data) VALUES (?, ?, ?)",
+                   (digest, dictionary_id, _compress(payload, dictionary_data)))
+    return cursor.lastrowid
+
+def load_raw_payloads(cursor, payload_ids):
+    """Returns {payload_id: fire data dict} for `payload_ids`."""
+    dictionaries = {}
+    payloads = {}
+    for chunk in chunked(payload_ids):
+        cursor.execute(f'''
+            SELECT payload_id, dictionary_id, data FROM raw_payloads
+            WHERE payload_id IN ({', '.join('?' * len(chunk))})
+        ''', chunk)
+        for payload_id, dictionary_id, data in cursor.fetchall():
+            if dictionary_id is None:
+                decompressor = zlib.decompressobj()
+            else:
+                if dictionary_id not in dictionaries:
+                    dictionary_cursor = cursor.connection.cursor()
+                    dictionary_cursor.execute("SELECT data FROM raw_payload_dictionaries WHERE dictionary_id = ?", (dictionary_id,))
+                    dictionaries[dictionary_id] = bytes(dictionary_cursor.fetchone()[0])
+                decompressor = zlib.decompressobj(zdict=dictionaries[dictionary_id])
+            payloads[payload_id] = json.loads(decompressor.decompress(data) + decompressor.flush())
+    return payloads
+
+def build_compression_dictionary(sample_payloads):
+    """
+    Builds a zlib preset dictionary from sample payloads (canonical JSON bytes): the most common
+    payload fragments (keys, repeated blocks such as `icnf`) last, where zlib finds them cheapest.
+    """
+    fragment_counts = {}
+    for payload in sample_payloads:
+        for fragment in set(payload.split(b',')):
+            if len(fragment) > 3:
+                fragment_counts[fragment] = fragment_counts.get(fragment, 0) + 1
+    common_fragments = sorted((count, fragment) for fragment, count in fragment_counts.items() if count > 1)
+    dictionary = b''
+    for count, fragment in reversed(common_fragments):
+        if len(dictionary) + len(fragment) + 1 > MAX_DICTIONARY_SIZE:
+            break
+        dictionary = fragment + b',' + dictionary
+    return dictionary
@@ -0,0 +1,213 @@
+import numpy as np
+from fire_intervals import RESOURCES, read_overlapping_intervals, sum_intervals
+from db_metadata import get_metadata, set_metadata, delete_metadata
+
+# --- Resource Deployment Time Series ---
+# The resources of a fire (man, terrain, aerial, meios_aquaticos) are a step function: the counts
+# logged by each of its rows hold while it stays active (see fire_intervals.py). Summed per
+# district, or over the whole country, they give the resources deployed at every moment.
+# `resource_rollup` stores those sums downsampled to buckets of each RESOLUTIONS width (UTC
+# aligned): the min, max and time-weighted average of each series (active fires and the four
+# resources) within the bucket. Buckets where nothing was deployed are not stored.
+# The rollup is refreshed by the ingest: new fire_updates rows only change the step functions from
+# their commit on, so only the buckets from the earliest of them (or from the previous end of the
+# data, as open intervals grew since) are recomputed, from the intervals that overlap them.
+
+RESOLUTIONS = {'5min': 300, 'hour': 3600, 'day': 86400}
+SERIES = ('fires',) + RESOURCES
+NATIONAL = '' # District of the buckets of the whole country
+UNKNOWN_DISTRICT = 'Unknown'
+
+RESOURCE_ROLLUP_UPDATE_ID_KEY = 'resource_rollup_update_id'
+RESOURCE_ROLLUP_HORIZON_KEY = 'resource_rollup_horizon' # The end of the data of the rollup
+
+_STAT_COLUMNS = tuple(f'{series}_{stat}' for series in SERIES for stat in ('min', 'max', 'avg'))
+
+def create_resource_rollup_table(cursor):
+    """Creates the resource rollup table, if it doesn't exist."""
+    cursor.execute(f'''
+    CREATE TABLE IF NOT EXISTS resource_rollup (
+        resolution INTEGER,        -- Bucket width in seconds
+        district TEXT,             -- '' for the whole country
+        bucket INTEGER,            -- Start of the bucket, a multiple of the resolution
+        {', '.join(f'{column} {"REAL" if column.endswith("_avg") else "INTEGER"}' for column in _STAT_COLUMNS)},
+        PRIMARY KEY (resolution, district, bucket)
+    ) WITHOUT ROWID
+    ''')
+
+def _get_int_metadata(cursor, key):
+    value = get_metadata(cursor, key)
+    return int(value) if value is not None else None
+
+def get_resource_rollup_horizon(cursor):
+    """Returns the end of the data of the rollup (seconds), or None if it was never built."""
+    return _get_int_metadata(cursor, RESOURCE_ROLLUP_HORIZON_KEY)
+
+def bucket_stats(times, totals, bucket_starts, resolution, horizon):
+    """
+    Min, max and time-weighted average of a step function (`totals` from each of `times`, the first
+    time being at or before the first bucket) in each bucket, up to `horizon`. Returns three
+    (buckets x series) arrays.
+    """
+    bucket_ends = np.minimum(bucket_starts + resolution, horizon)
+    totals = totals.astype(np.float64)
+    # Area under the step function from times[0] to each of the times, then to any t
+    area = np.vstack([np.zeros((1, totals.shape[1])), np.cumsum(totals[:-1] * np.diff(times)[:, None], axis=0)])
+    def area_at(moments):
+        step = np.searchsorted(times, moments, side='right') - 1
+        return area[step] + totals[step] * (moments - times[step])[:, None]
+    avg = (area_at(bucket_ends) - area_at(bucket_starts)) / np.maximum(bucket_ends - bucket_starts, 1)[:, None]
+
+    # Min and max over the value at the start of each bucket and the values set within it
+    start_values = totals[np.searchsorted(times, bucket_starts, side='right') - 1]
+    event_buckets = np.searchsorted(bucket_starts, times, side='right') - 1
+    within = (event_buckets >= 0) & (times > bucket_starts[np.maximum(event_buckets, 0)]) & (times < horizon)
+    keys = np.concatenate([np.arange(len(bucket_starts)), event_buckets[within]])
+    values = np.vstack([start_values, totals[within]])
+    order = np.argsort(keys, kind='stable')
+    first_of_bucket = np.searchsorted(keys[order], np.arange(len(bucket_starts)))
+    minimum = np.minimum.reduceat(values[order], first_of_bucket, axis=0)
+    maximum = np.maximum.reduceat(values[order], first_of_bucket, axis=0)
+    return minimum, maximum, avg
+
+def _compute_rollup_rows(cursor, from_ts, horizon):
+    """The resource_rollup rows of every resolution from the bucket containing `from_ts` up to `horizon`."""
+    # From the start of the widest bucket: every resolution recomputes its whole first bucket
+    widest = max(RESOLUTIONS.values())
+    rows = read_overlapping_intervals(cursor, from_ts // widest * widest, horizon,
+                                      ('f.district',) + tuple(f'i.{name}' for name in RESOURCES))
+    if not rows:
+        return []
+    starts = np.array([row[0] for row in rows], dtype=np.float64)
+    ends = np.array([np.inf if row[1] is None else row[1] for row in rows], dtype=np.float64)
+    # Missing counts are logged as NULL: they deploy nothing
+    values = np.array([[1] + [value or 0 for value in row[3:]] for row in rows], dtype=np.int64)
+    districts = np.array([row[2] or UNKNOWN_DISTRICT for row in rows], dtype=object)
+
+    rollup_rows = []
+    for resolution in RESOLUTIONS.values():
+        first_bucket = from_ts // resolution * resolution
+        bucket_starts = np.arange(first_bucket, horizon, resolution, dtype=np.float64)
+        if not len(bucket_starts):
+            bucket_starts = np.array([first_bucket], dtype=np.float64)
+        for district in [NATIONAL] + sorted(set(districts)):
+            selected = slice(None) if district == NATIONAL else districts == district
+            times, totals = sum_intervals(starts[selected], ends[selected], values[selected], first_bucket, horizon)
+            minimum, maximum, avg = bucket_stats(times, totals, bucket_starts, resolution, horizon)
+            for bucket, bucket_min, bucket_max, bucket_avg in zip(bucket_starts.tolist(), minimum.tolist(), maximum.tolist(), avg.tolist()):
+                if not any(bucket_max):
+                    continue
+                stats = [value for series_min, series_max, series_avg in zip(bucket_min, bucket_max, bucket_avg)
+                         for value in (int(series_min), int(series_max), series_avg)]
+                rollup_rows.append((resolution, district, int(bucket), *stats))
+    return rollup_rows
+
+def refresh_resource_rollup(cursor, horizon):
+    """
+    Recomputes the buckets changed by the fire_updates rows written since the last refresh (every
+    bucket the first time), with the data ending at `horizon` (the newest snapshot's timestamp).
+    Needs fire_intervals up to date. Does not commit. Returns the number of rows written.
+    """
+    after_update_id = _get_int_metadata(cursor, RESOURCE_ROLLUP_UPDATE_ID_KEY)
+    previous_horizon = get_resource_rollup_horizon(cursor)
+    cursor.execute("SELECT MIN(commit_timestamp), MAX(update_id) FROM fire_updates WHERE update_id > ?",
+                   (after_update_id or 0,))
+    first_change, last_update_id = cursor.fetchone()
+    if after_update_id is None or previous_horizon is None:
+        # First build: from the earliest row (commit timestamps are not monotonic, see fire_intervals.py)
+        cursor.execute("DELETE FROM resource_rollup")
+        cursor.execute("SELECT MIN(commit_timestamp) FROM fire_updates")
+        from_ts = cursor.fetchone()[0]
+        if from_ts is None:
+            from_ts = horizon
+    else:
+        from_ts = min(previous_horizon, first_change if first_change is not None else previous_horizon)
+    horizon = max(horizon, previous_horizon or horizon)
+
+    # Deleted district by district, to go through the primary key (the day buckets are the fewest)
+    cursor.execute("SELECT DISTINCT district FROM resource_rollup WHERE resolution = ?", (RESOLUTIONS['day'],))
+    districts = [row[0] for row in cursor.fetchall()]
+    for resolution in RESOLUTIONS.values():
+        cursor.executemany("DELETE FROM resource_rollup WHERE resolution = ? AND district = ? AND bucket >= ?",
+                           [(resolution, district, from_ts // resolution * resolution) for district in districts])
+    rollup_rows = _compute_rollup_rows(cursor, from_ts, horizon)
+    cursor.executemany(f'''
+        INSERT INTO resource_rollup (resolution, district, bucket, {', '.join(_STAT_COLUMNS)})
+        VALUES ({', '.join('?' * (3 + len(_STAT_COLUMNS)))})
+    ''', rollup_rows)
+    set_metadata(cursor, RESOURCE_ROLLUP_UPDATE_ID_KEY, str(last_update_id or after_update_id or 0))
+    set_metadata(cursor, RESOURCE_ROLLUP_HORIZON_KEY, str(int(horizon)))
+    return len(rollup_rows)
+
+def rebuild_resource_rollup(cursor, horizon):
+    """Recomputes every bucket. Does not commit."""
+    delete_metadata(cursor, RESOURCE_ROLLUP_UPDATE_ID_KEY, RESOURCE_ROLLUP_HORIZON_KEY)
+    return refresh_resource_rollup(cursor, horizon)
+
+# --- Reading ---
+
+def read_rollup(cursor, resolution, district, from_ts=None, to_ts=None):
+    """
+    Returns (bucket starts, {series: {'min', 'max', 'avg'}}) of the buckets of `district` (NATIONAL
+    for the whole country) at `resolution` seconds, every bucket from `from_ts` (default: the first
+    stored) to `to_ts` (default: the end of the data), those not stored being zeros.
+    """
+    horizon = get_resource_rollup_horizon(cursor)
+    if horizon is None:
+        return np.array([], dtype=np.int64), {series: {stat: [] for stat in ('min', 'max', 'avg')} for series in SERIES}
+    if from_ts is None:
+        cursor.execute("SELECT MIN(bucket) FROM resource_rollup WHERE resolution = ? AND district = ?", (resolution, district))
+        from_ts = cursor.fetchone()[0] or horizon
+    to_ts = horizon if to_ts is None else min(to_ts, horizon)
+    first_bucket = int(from_ts) // resolution * resolution
+    bucket_starts = np.arange(first_bucket, max(to_ts, first_bucket) + 1, resolution, dtype=np.int64)
+    cursor.execute(f'''
+        SELECT bucket, {', '.join(_STAT_COLUMNS)} FROM resource_rollup
+        WHERE resolution = ? AND district = ? AND bucket >= ? AND bucket <= ?
+        ORDER BY bucket
+    ''', (resolution, district, first_bucket, to_ts))
+    rows = np.array(cursor.fetchall(), dtype=np.float64).reshape(-1, 1 + len(_STAT_COLUMNS))
+    stats = np.zeros((len(bucket_starts), len(_STAT_COLUMNS)))
+    stats[((rows[:, 0] - first_bucket) // resolution).astype(np.int64)] = rows[:, 1:]
+    columns = dict(zip(_STAT_COLUMNS, stats.T))
+    return bucket_starts, {series: {stat: columns[f'{series}_{stat}'] for stat in ('min', 'max', 'avg')} for series in SERIES}
+
+def fire_resource_steps(cursor, fire_id):
+    """Returns (times, totals) of the step function of one fire's resources, from its fire_updates rows."""
+    cursor.execute(f'''
+        SELECT commit_timestamp, active_in_commit, {', '.join(RESOURCES)} FROM fire_updates
+        WHERE fire_id = ? ORDER BY update_id
+    ''', (fire_id,))
+    rows = cursor.fetchall()
+    times = np.array([row[0] for row in rows], dtype=np.float64)
+    # Deploys nothing while not active (e.g. after it disappeared)
+    totals = np.array([[int(bool(row[1]))] + [(value or 0) if row[1] else 0 for value in row[2:]] for row in rows],
+                      dtype=np.int64).reshape(-1, len(SERIES))
+    return times, totals
+
+# --- Downsampling for charts ---
+
+def largest_triangle_three_buckets(timestamps, values, threshold):
+    """
+    Indices of `threshold` points of the (timestamps, values) series picked with LTTB, which keeps
+    its visual shape (peaks and dips) where plain averaging would flatten them.
+    """
+    count = len(values)
+    if threshold >= count or threshold < 3:
+        return np.arange(count)
+    timestamps, values = np.asarray(timestamps, dtype=np.float64), np.asarray(values, dtype=np.float64)
+    selected = np.empty(threshold, dtype=np.int64)
+    selected[0], selected[-1] = 0, count - 1
+    # The points between the first and the last are split into threshold - 2 buckets
+    edges = np.linspace(1, count - 1, threshold - 1).astype(np.int64)
+    previous = 0
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+        # The average of the next bucket is the third vertex (the last point after the last bucket)
+        next_start, next_end = end, edges[bucket + 2] if bucket + 2 < len(edges) else count
+        next_x, next_y = timestamps[next_start:next_end].mean(), values[next_start:next_end].mean()
+        areas = np.abs((timestamps[previous] - next_x) * (values[start:end] - values[previous])
+                       - (timestamps[previous] - timestamps[start:end]) * (next_y - values[previous]))
+        previous = start + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+    return selected
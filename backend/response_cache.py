@@ -0,0 +1,155 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# --- API Response Cache ---
+# The database only changes when the ingest writes, so a response computed for a route and its
+# parameters stays valid until the data watermark (see server.get_data_watermark) moves. Responses are
+# kept in a per-process LRU; with `disk_path` they are also shared through a SQLite file, so several
+# server processes (e.g. gunicorn workers) compute each response once per ingest.
+
+class ResponseCache:
+    """
+    LRU of (etag, body, mimetype) keyed by request, valid for one data watermark.
+    When `get` is called with a new watermark every older entry is dropped.
+    """
+
+    def __init__(self, max_entries=256, disk_path=None):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.watermark = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.disk = _DiskResponseCache(disk_path, max_entries) if disk_path else None
+
+    def _check_watermark(self, watermark):
+        # Called with the lock held
+        if watermark != self.watermark:
+            if self.entries:
+                self.invalidations += 1
+            self.entries.clear()
+            self.watermark = watermark
+
+    def get(self, key, watermark):
+        """Returns the cached (etag, body, mimetype) for `key` at `watermark`, or None."""
+        with self.lock:
+            self._check_watermark(watermark)
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        entry = self.disk.get(key, watermark) if self.disk else None
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._store(key, entry)
+        return entry
+
+    def put(self, key, watermark, body, mimetype):
+        """Caches a response body computed at `watermark` and returns its (etag, body, mimetype)."""
+        entry = (hashlib.sha1(body).hexdigest(), body, mimetype)
+        with self.lock:
+            if watermark != self.watermark:
+                # Computed before the data moved on (another request already saw a newer watermark)
+                return entry
+            self._store(key, entry)
+        if self.disk:
+            self.disk.put(key, watermark, entry)
+        return entry
+
+    def _store(self, key, entry):
+        # Called with the lock held
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'shared': self.disk is not None,
+        }
+
+class _DiskResponseCache:
+    """SQLite-backed second level shared between processes, evicted by last access time."""
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = None
+        self.conn_pid = None
+
+    def _connection(self):
+        # Called with the lock held. Opened lazily, and again in a forked worker: a SQLite
+        # connection must not be used by a process other than the one that opened it.
+        if self.conn is not None and self.conn_pid == os.getpid():
+            return self.conn
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=OFF") # Losing the cache on a crash is harmless
+        conn.execute('''
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            watermark TEXT,
+            etag TEXT,
+            body BLOB,
+            mimetype TEXT,
+            accessed REAL
+        )
+        ''')
+        self.conn, self.conn_pid = conn, os.getpid()
+        return conn
+
+    def get(self, key, watermark):
+        try:
+            with self.lock:
+                conn = self._connection()
+                row = conn.execute("SELECT etag, body, mimetype FROM response_cache WHERE key = ? AND watermark IS ?",
+                                   (key, watermark)).fetchone()
+                if row is None:
+                    return None
+                conn.execute("UPDATE response_cache SET accessed = ? WHERE key = ?", (time.time(), key))
+            return row[0], bytes(row[1]), row[2]
+        except sqlite3.Error as e:
+            # The shared level is best effort: fall back to computing the response
+            print(f"Response cache: could not read the shared cache ({e}).")
+            return None
+
+    def put(self, key, watermark, entry):
+        etag, body, mimetype = entry
+        try:
+            with self.lock:
+                conn = self._connection()
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("DELETE FROM response_cache WHERE watermark IS NOT ?", (watermark,))
+                conn.execute("INSERT OR REPLACE INTO response_cache VALUES (?, ?, ?, ?, ?, ?)",
+                             (key, watermark, etag, body, mimetype, time.time()))
+                conn.execute('''
+                    DELETE FROM response_cache WHERE key IN (
+                        SELECT key FROM response_cache ORDER BY accessed DESC LIMIT -1 OFFSET ?
+                    )
+                ''', (self.max_entries,))
+                conn.execute("COMMIT")
+        except sqlite3.Error as e:
+            print(f"Response cache: could not write the shared cache ({e}).")
+            with self.lock:
+                if self.conn is not None and self.conn.in_transaction:
+                    self.conn.rollback()
@@ -5,9 +5,19 @@ from flask import Flask
 from flask import jsonify
 import sqlite3
 from flask import request
-from sqlalchemy import func
+from flask import Response, make_response
+from sqlalchemy import func, text, select, literal, literal_column, union_all
 from flask_cors import CORS
 import time
+import os
+import math
+import json
+import re
+import functools
+import gzip
+from urllib.parse import urlencode
+from response_cache import ResponseCache
+from db_metadata import chunked
 
 """
 D describe fires;
@@ -57,9 +67,9 @@ D describe fire_updates;
 
 # SQL Alchemy models for the tables above
 
-from sqlalchemy import create_engine, Column, Integer, String, Float
+from sqlalchemy import create_engine, event, Column, Integer, String, Float
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
 
 Base = declarative_base()
 
@@ -78,6 +88,9 @@ class Fire(Base):
     last_updated_commit_hash = Column(String)
     last_updated_data_timestamp = Column(Integer)
     is_currently_active = Column(Integer)
+    # Generated columns (see bd_manager.MIGRATIONS), derived from first_seen_data_timestamp
+    first_seen_day = Column(String)
+    first_seen_month = Column(String)
 
     def to_dict(self):
         return {
@@ -121,6 +134,42 @@ class FireUpdate(Base):
             'status_code': self.status_code
         }
 
+class DailyDistrictStats(Base):
+    # Rollup maintained by the ingest (see daily_stats.py), one row per first seen day and district
+    __tablename__ = 'daily_district_stats'
+    day = Column(String, primary_key=True)
+    district = Column(String, primary_key=True)
+    fire_count = Column(Integer)
+    total_man = Column(Integer)
+    total_terrain = Column(Integer)
+    total_aerial = Column(Integer)
+    max_duration = Column(Integer)
+    longest_fire_id = Column(String)
+    peak_man = Column(Integer)
+    peak_terrain = Column(Integer)
+    peak_aerial = Column(Integer)
+
+class FireSearch(Base):
+    # FTS5 index maintained by the ingest (see fire_search.py), searched with MATCH
+    __tablename__ = 'fires_search'
+    rowid = Column(Integer, primary_key=True)
+
+class FireSearchId(Base):
+    # Maps the rowids of fires_search to fire ids
+    __tablename__ = 'fire_search_ids'
+    search_rowid = Column(Integer, primary_key=True)
+    fire_id = Column(String)
+
+class FireGeo(Base):
+    # R*Tree of the fire positions maintained by the ingest (see fire_geo.py)
+    __tablename__ = 'fires_geo'
+    geo_rowid = Column(Integer, primary_key=True)
+    min_lat = Column(Float)
+    max_lat = Column(Float)
+    min_lng = Column(Float)
+    max_lng = Column(Float)
+    fire_id = Column(String)
+
 
 def createApp():
     return Flask(__name__)
@@ -132,36 +181,171 @@ CORS(app)
 def health_check():
     return jsonify(status="UP"), 200
 
+# Database access: one engine (and connection pool) for the whole process, configured through
+# the environment. The API never writes, so connections are opened read-only.
+DB_PATH = os.environ.get('FIRES_DB_PATH', 'fires.sqlite')
+DB_POOL_SIZE = int(os.environ.get('FIRES_DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('FIRES_DB_MAX_OVERFLOW', 10))
+DB_MMAP_SIZE = int(os.environ.get('FIRES_DB_MMAP_SIZE', 256 * 1024 * 1024))
+
+db_connections_opened = 0
+
+def createEngine():
+    engine = create_engine(
+        f'sqlite:///file:{DB_PATH}?mode=ro&uri=true',
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        # Pooled connections are handed to whichever request thread checks them out
+        connect_args={'check_same_thread': False},
+    )
+
+    @event.listens_for(engine, 'connect')
+    def configure_connection(dbapi_connection, connection_record):
+        global db_connections_opened
+        db_connections_opened += 1
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA query_only = ON')
+        cursor.execute(f'PRAGMA mmap_size = {DB_MMAP_SIZE}')
+        cursor.close()
+
+    return engine
+
+engine = createEngine()
+Session = scoped_session(sessionmaker(bind=engine))
+
+# Fork safety: with gunicorn --preload (see gunicorn.conf.py) the workers are forked from a process
+# that may already hold pooled connections. A SQLite connection must only be used by the process
+# that opened it, so each child starts with an empty pool, leaving the parent's connections open
+# for the parent. The stream tail, tile pool and shared response cache check their pid themselves.
+os.register_at_fork(after_in_child=lambda: engine.dispose(close=False))
+
+@app.teardown_appcontext
+def remove_db_session(exception=None):
+    # Returns the request's connection to the pool, even if the view didn't close its session
+    Session.remove()
+
 def getDBSession():
-    # Connect to the SQLite database with SQL Alchemy
-    engine = create_engine('sqlite:///fires.sqlite')
-    Session = sessionmaker(bind=engine)
     return Session()
 
-# Route to get all fires, paginated
+@app.route('/health/db-pool')
+def get_db_pool_stats():
+    pool = engine.pool
+    return jsonify({
+        'pool_size': pool.size(),
+        'checked_in': pool.checkedin(),
+        'checked_out': pool.checkedout(),
+        'overflow': pool.overflow(),
+        'connections_opened': db_connections_opened,
+    })
+
+# Response cache: API responses only change when the ingest writes, so they are cached per route and
+# parameters until the data version (script_metadata.data_version, incremented by every ingest
+# transaction, see ingest_daemon.py) or last_processed_commit_hash moves. Set
+# FIRES_RESPONSE_CACHE_PATH to share the cache between server processes through a SQLite file.
+RESPONSE_CACHE_SIZE = int(os.environ.get('FIRES_RESPONSE_CACHE_SIZE', 256))
+RESPONSE_CACHE_PATH = os.environ.get('FIRES_RESPONSE_CACHE_PATH')
+RESPONSE_CACHE_KEY_PARAMS = ('fromDate', 'toDate', 'cursor', 'page', 'page_size', 'search_term', 'field', 'ts', 'commit',
+                             'bbox', 'zoom', 'active', 'lat', 'lng', 'radius_km', 'limit',
+                             'resolution', 'district', 'points', 'resource')
+
+response_cache = ResponseCache(max_entries=RESPONSE_CACHE_SIZE, disk_path=RESPONSE_CACHE_PATH)
+
+def get_data_versions():
+    session = getDBSession()
+    rows = dict(session.execute(text(
+        "SELECT key, value FROM script_metadata WHERE key IN ('last_processed_commit_hash', 'data_version')"
+    )).all())
+    return rows.get('last_processed_commit_hash'), int(rows.get('data_version') or 0)
+
+def get_data_watermark():
+    # Databases written before the data version existed only have the commit hash
+    last_processed_commit_hash, data_version = get_data_versions()
+    return f'{last_processed_commit_hash}:{data_version}'
+
+def cached_response(view):
+    @functools.wraps(view)
+    def cached_view(*args, **kwargs):
+        if RESPONSE_CACHE_SIZE <= 0:
+            return view(*args, **kwargs)
+        key = request.path + '?' + urlencode([(name, request.args[name]) for name in RESPONSE_CACHE_KEY_PARAMS if name in request.args])
+        watermark = get_data_watermark()
+        entry = response_cache.get(key, watermark)
+        if entry is None:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            entry = response_cache.put(key, watermark, response.get_data(), response.mimetype)
+        etag, body, mimetype = entry
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = Response(body, mimetype=mimetype)
+        response.set_etag(etag)
+        # Browsers may keep the response but must revalidate it, which costs a 304 when nothing changed
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return cached_view
+
+@app.route('/health/response-cache')
+def get_response_cache_stats():
+    return jsonify(response_cache.stats())
+
+# Lets clients poll for new data cheaply: the version changes whenever the ingest writes
+@app.route('/api/data-version', methods=['GET'])
+def get_data_version():
+    last_processed_commit_hash, data_version = get_data_versions()
+    response = jsonify({'data_version': data_version, 'last_processed_commit_hash': last_processed_commit_hash})
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+def get_search_match_query(search_term):
+    # Every word must start a word of the location, concelho, freguesia or natureza ("sao jo" finds "São João")
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', search_term))
+
+# Route to get all fires, paginated by fire_id: pass the returned next_cursor as `cursor` to get the
+# following page, so any page costs the same as the first one
 @app.route('/api/fires', methods=['GET'])
+@cached_response
 def get_fires():
-    page = int(request.args.get('page', 0))
+    if 'page' in request.args:
+        # Offset pages are gone: ignoring `page` would serve the first page to a client looping over them
+        return jsonify({'message': 'page is no longer supported, pass the next_cursor of the previous page as cursor.'}), 400
     page_size = int(request.args.get('page_size', 25))
-    search_term = request.args.get('search_term', None)    
+    cursor = request.args.get('cursor', None)
+    search_term = request.args.get('search_term', None)
     session = getDBSession()
     # Get the data from the database
-    fires = []
-    if (search_term is None):
-        fires = session.query(Fire).offset(page * page_size).limit(page_size).all()
-    else:
-        print(search_term)
-        fires = session.query(Fire).filter(Fire.location.like("%" + search_term + "%")).offset(page * page_size).limit(page_size).all()
+    query = session.query(Fire).order_by(Fire.fire_id)
+    if cursor is not None:
+        query = query.filter(Fire.fire_id > cursor)
+    match_query = get_search_match_query(search_term) if search_term else None
+    if match_query:
+        query = query.filter(Fire.fire_id.in_(
+            select(FireSearchId.fire_id).where(FireSearchId.search_rowid.in_(
+                select(FireSearch.rowid).where(literal_column('fires_search').op('MATCH')(match_query))
+            ))
+        ))
+    # One extra row tells whether there is a next page
+    fires = query.limit(page_size + 1).all()
     # Convert the data to a list of dictionaries
-    fires_list = [fire.to_dict() for fire in fires]
+    fires_list = [fire.to_dict() for fire in fires[:page_size]]
     session.close()
     # Return the data as a JSON response
-    return jsonify(fires_list)
+    return jsonify({
+        'fires': fires_list,
+        'next_cursor': fires_list[-1]['fire_id'] if len(fires) > page_size else None,
+    })
+
+def get_date_filters():
+    # fromDate/toDate are optional, in milliseconds
+    from_date = request.args.get('fromDate', type=int)
+    to_date = request.args.get('toDate', type=int)
+    return (from_date / 1000 if from_date is not None else None,
+            to_date / 1000 if to_date is not None else None)
 
 def get_query_with_date_filters(query):
     # Apply date filters if provided
-    from_date = request.args.get('fromDate', type=int) / 1000
-    to_date = request.args.get('toDate', type=int) / 1000
+    from_date, to_date = get_date_filters()
     new_query = query
     if from_date is not None:
         new_query = new_query.filter(Fire.first_seen_data_timestamp >= from_date)
@@ -169,84 +353,141 @@ def get_query_with_date_filters(query):
         new_query = new_query.filter(Fire.first_seen_data_timestamp <= to_date)
     return new_query
 
+# Aggregates by first seen day come from the daily_district_stats rollup. The date filters are
+# timestamps, so only the days they fully cover are read from the rollup; the partial days at
+# either end are counted from the fires table.
+
+SECONDS_PER_DAY = 86400
+
+def format_day(day_number):
+    return time.strftime('%Y-%m-%d', time.gmtime(day_number * SECONDS_PER_DAY))
+
+def split_date_filters_by_day():
+    """
+    Returns (first_full_day, last_full_day, partial_day_ranges): the range of days (None for
+    unbounded) read from the rollup, and the (from, to) timestamp ranges read from `fires`.
+    """
+    from_date, to_date = get_date_filters()
+    first_full_day = last_full_day = None
+    partial_day_ranges = []
+    if from_date is not None:
+        first_full_day_number = math.ceil(from_date / SECONDS_PER_DAY)
+        first_full_day = format_day(first_full_day_number)
+        if first_full_day_number * SECONDS_PER_DAY > from_date:
+            partial_end = first_full_day_number * SECONDS_PER_DAY - 1
+            partial_day_ranges.append((from_date, partial_end if to_date is None else min(partial_end, to_date)))
+    if to_date is not None:
+        # A day is fully covered if its last second is
+        last_full_day_number = math.floor((to_date + 1) / SECONDS_PER_DAY) - 1
+        last_full_day = format_day(last_full_day_number)
+        partial_start = (last_full_day_number + 1) * SECONDS_PER_DAY
+        if partial_start <= to_date and (from_date is None or partial_start >= from_date):
+            partial_day_ranges.append((partial_start if from_date is None else max(partial_start, from_date), to_date))
+    return first_full_day, last_full_day, partial_day_ranges
+
+FIRE_COUNT_GROUPINGS = {
+    # grouping: (rollup expression, fires expression)
+    'day': (DailyDistrictStats.day, Fire.first_seen_day),
+    'month': (func.substr(DailyDistrictStats.day, 1, 7), Fire.first_seen_month),
+    'district': (DailyDistrictStats.district, Fire.district),
+}
+
+def fire_counts_subquery(grouping):
+    """
+    Subquery of (value, count) rows that, summed per value, count the fires matching the date filters
+    grouped by a FIRE_COUNT_GROUPINGS key: rollup rows for the whole days, one row per fire for the partial days.
+    """
+    rollup_column, fire_column = FIRE_COUNT_GROUPINGS[grouping]
+    first_full_day, last_full_day, partial_day_ranges = split_date_filters_by_day()
+
+    rollup_rows = select(rollup_column.label('value'), DailyDistrictStats.fire_count.label('count'))
+    if first_full_day is not None:
+        rollup_rows = rollup_rows.where(DailyDistrictStats.day >= first_full_day)
+    if last_full_day is not None:
+        rollup_rows = rollup_rows.where(DailyDistrictStats.day <= last_full_day)
+    parts = [rollup_rows]
+
+    for start, end in partial_day_ranges:
+        parts.append(select(fire_column.label('value'), literal(1).label('count')).where(
+            Fire.first_seen_data_timestamp >= start,
+            Fire.first_seen_data_timestamp <= end
+        ))
+    return (union_all(*parts) if len(parts) > 1 else rollup_rows).subquery()
+
+def count_fires_per(session, grouping):
+    """Returns {value: number of fires} for the fires matching the date filters, grouped by a FIRE_COUNT_GROUPINGS key."""
+    counts = fire_counts_subquery(grouping)
+    return dict(session.query(counts.c.value, func.sum(counts.c.count)).group_by(counts.c.value).all())
+
+def sorted_by_count(counts):
+    # Highest count first, ties by value
+    return sorted(counts.items(), key=lambda item: (-item[1], item[0] is not None, item[0] or ''))
 
 # Route to get number of fires grouped per month, for all time
 @app.route('/api/fires/months', methods=['GET'])
+@cached_response
 def get_fires_per_month():
     session = getDBSession()
-
-    query = session.query(
-        func.strftime('%Y-%m', func.datetime(Fire.first_seen_data_timestamp, 'unixepoch')).label('month'),
-        func.count().label('count')
-    )
-
-    query = get_query_with_date_filters(query)
-
-    results = query.group_by('month').order_by('month').all()
+    counts = count_fires_per(session, 'month')
     session.close()
+    results = sorted(counts.items(), key=lambda item: (item[0] is not None, item[0] or ''))
     # Convert the data to a list of dictionaries
     results = [{'month': month, 'count': count} for month, count in results]
     return jsonify(list(results))
 
 @app.route('/api/fires/total', methods=['GET'])
+@cached_response
 def get_fires_total():
     session = getDBSession()
-    
-    query = session.query(func.count(Fire.fire_id))
-    query = get_query_with_date_filters(query)
-    total = query.scalar()
-
+    total = sum(count_fires_per(session, 'district').values())
     session.close()
     return jsonify({'value': total})    
 
 @app.route('/api/fires/most-affected-district', methods=['GET'])
+@cached_response
 def get_most_affected_district():
     session = getDBSession()
-    query = session.query(
-        Fire.district,
-        func.count(Fire.fire_id).label('count')
-    ).group_by(Fire.district).order_by(func.count(Fire.fire_id).desc())
-
-    query = get_query_with_date_filters(query)
-    result = query.first()
+    results = sorted_by_count(count_fires_per(session, 'district'))
     session.close()
+    result = results[0] if results else None
     if result:
         return jsonify({'value': result[0], 'subValue': result[1]})
     else:
         return jsonify({'value': 'None'})
     
 @app.route('/api/fires/count-per-district', methods=['GET'])
+@cached_response
 def get_fires_count_per_district():
     session = getDBSession()
-    results = get_query_with_date_filters(session.query(
-        Fire.district,
-        func.count(Fire.fire_id).label('count')
-    ).group_by(Fire.district).order_by(func.count(Fire.fire_id).desc())).all()
+    results = sorted_by_count(count_fires_per(session, 'district'))
     session.close()
     # Convert the data to a list of dictionaries
     results = [{'district': district, 'count': count} for district, count in results]
     return jsonify(list(results))
 
 import numpy as np
+import duration_stats
+
+# Durations of all fires, sorted, reloaded when the ingest watermark moves
+fire_durations_cache = duration_stats.FireDurationsCache()
+
+def get_durations_in_hours():
+    # Sorted durations of the fires matching the date filters
+    fire_durations = fire_durations_cache.get(get_data_watermark(), engine.raw_connection)
+    return fire_durations.select(*get_date_filters()) / 3600
 
 @app.route('/api/fires/duration-histogram', methods=['GET'])
+@cached_response
 def get_fires_duration_histogram():
-    session = getDBSession()
-    
-    # Query to calculate the duration of each fire
-    durations = session.query((Fire.last_updated_data_timestamp - Fire.first_seen_data_timestamp).label('duration')).all()
-    session.close()
-    
-    # Extract durations into a list
-    duration_values = [d[0] / 3600 for d in durations if d[0] is not None]
-    # Define bins with a size of 0.5 for the first 30 bins
-    bin_edges = [i * 0.5 for i in range(25)]  # 0, 0.5, 1.0, ..., 15.0
+    duration_values = get_durations_in_hours()
+    # Define bins with a size of 0.5 for the first 24 bins
+    bin_edges = [i * 0.5 for i in range(25)]  # 0, 0.5, 1.0, ..., 12.0
     # Add the last bin edge for the last bin, with the max value
-    max_value = max(duration_values) if duration_values else 0
-    bin_edges.append(max_value)
+    max_value = float(duration_values[-1]) if len(duration_values) else 0
+    bin_edges.append(max(max_value, bin_edges[-1]))
     
     # Compute the histogram
-    histogram, bin_edges = np.histogram(duration_values, bins=bin_edges)
+    histogram = duration_stats.histogram(duration_values, bin_edges)
     # Format the histogram as a list of dictionaries
     histogram_data = [
         {'label': str(round(float(bin_edges[i]), 1)) + '-' + str(round(float(bin_edges[i + 1]),1)), 'count': int(histogram[i])}
@@ -258,87 +499,85 @@ def get_fires_duration_histogram():
     return jsonify(histogram_data)
 
 @app.route('/api/fires/duration-stats', methods=['GET'])
+@cached_response
 def get_fires_average_duration():
-    session = getDBSession()
-    # Calculate the average, median, and standard deviation of the duration
-    durations = session.query((Fire.last_updated_data_timestamp - Fire.first_seen_data_timestamp).label('duration')).all()
-    session.close()
-    # Extract durations into a list
-    duration_values = [d[0] / 3600 for d in durations if d[0] is not None]
+    # Calculate the average and percentiles of the duration
+    duration_values = get_durations_in_hours()
     if len(duration_values) == 0:
         return jsonify({'average': 0, 'median': 0, 'std_dev': 0})
     average = np.mean(duration_values)
-    median = np.median(duration_values)
-    value = f"Median: {median:.2f}"
-    return jsonify({'value': round(average, 2), 'subValue': value})
+    p50, p90, p99 = duration_stats.percentiles(duration_values, [0.5, 0.9, 0.99])
+    value = f"Median: {p50:.2f}"
+    return jsonify({
+        'value': round(average, 2),
+        'subValue': value,
+        'p50': round(float(p50), 2),
+        'p90': round(float(p90), 2),
+        'p99': round(float(p99), 2),
+    })
     
 
 @app.route('/api/fires/worst-day-stats', methods=['GET'])
+@cached_response
 def get_worst_day_stats():
     session = getDBSession()
     
-    # Step 1: Get the day with the most fires
-    worst_day_result = get_query_with_date_filters(session.query(
-        func.strftime('%Y-%m-%d', func.datetime(Fire.first_seen_data_timestamp, 'unixepoch')).label('day'),
-        func.count(Fire.fire_id).label('count')
-    ).group_by('day').order_by(func.count(Fire.fire_id).desc())).first()
-    
-    if not worst_day_result:
-        session.close()
-        return jsonify({'message': 'No data available for worst day stats.'})
-    
-    worst_day = worst_day_result.day
+    # The day with the most fires (ties: the earliest day) ...
+    day_counts = fire_counts_subquery('day')
+    worst_day = select(
+        day_counts.c.value.label('day'),
+        func.sum(day_counts.c.count).label('fire_count')
+    ).group_by(day_counts.c.value).order_by(func.sum(day_counts.c.count).desc(), day_counts.c.value).limit(1).subquery()
     
-    # Step 2: Get total resources deployed on the worst day
-    total_resources_result = session.query(
-        func.sum(func.coalesce(FireUpdate.man, 0)).label('total_man'),
-        func.sum(func.coalesce(FireUpdate.terrain, 0)).label('total_terrain'),
-        func.sum(func.coalesce(FireUpdate.aerial, 0)).label('total_aerial')
-    ).join(Fire, Fire.fire_id == FireUpdate.fire_id).filter(
-        func.strftime('%Y-%m-%d', func.datetime(Fire.first_seen_data_timestamp, 'unixepoch')) == worst_day
-    ).first()
+    # ... and its summary from the rollup rows of that day, in the same query
+    result = session.query(
+        worst_day.c.day,
+        worst_day.c.fire_count,
+        func.sum(DailyDistrictStats.total_man).label('total_man'),
+        func.sum(DailyDistrictStats.total_terrain).label('total_terrain'),
+        func.sum(DailyDistrictStats.total_aerial).label('total_aerial'),
+        func.sum(DailyDistrictStats.peak_man).label('peak_man'),
+        func.sum(DailyDistrictStats.peak_terrain).label('peak_terrain'),
+        func.sum(DailyDistrictStats.peak_aerial).label('peak_aerial'),
+        func.max(DailyDistrictStats.max_duration).label('max_duration'),
+        # Bare column next to the only max(): SQLite takes it from the row with the longest duration
+        DailyDistrictStats.longest_fire_id,
+        func.json_group_array(DailyDistrictStats.district).label('districts')
+    ).select_from(worst_day).join(
+        DailyDistrictStats, DailyDistrictStats.day.is_(worst_day.c.day)
+    ).group_by(worst_day.c.day).first()
     
-    total_man = total_resources_result.total_man or 0
-    total_terrain = total_resources_result.total_terrain or 0
-    total_aerial = total_resources_result.total_aerial or 0
-    
-    # Step 3: Get the largest duration of a fire and its ID on the worst day
-    largest_duration_result = session.query(
-        Fire.fire_id,
-        func.max(Fire.last_updated_data_timestamp - Fire.first_seen_data_timestamp).label('max_duration')
-    ).filter(
-        func.strftime('%Y-%m-%d', func.datetime(Fire.first_seen_data_timestamp, 'unixepoch')) == worst_day
-    ).first()
-    
-    largest_duration = (largest_duration_result.max_duration or 0) / 3600  # Convert to hours
-    fire_with_longest_duration = largest_duration_result.fire_id if largest_duration_result else None
-    
-    # Step 4: Get the districts that had fires on the worst day
-    districts_result = session.query(
-        Fire.district
-    ).filter(
-        func.strftime('%Y-%m-%d', func.datetime(Fire.first_seen_data_timestamp, 'unixepoch')) == worst_day
-    ).distinct().all()
+    session.close()
     
-    districts = [district[0] for district in districts_result]
+    if not result:
+        return jsonify({'message': 'No data available for worst day stats.'})
     
-    session.close()
+    largest_duration = (result.max_duration or 0) / 3600  # Convert to hours
+    districts = sorted(json.loads(result.districts), key=lambda district: (district is not None, district or ''))
     
     # Return the stats as JSON
     return jsonify({
-        'worst_day': worst_day,
-        'total_fires': worst_day_result.count,
+        'worst_day': result.day,
+        'total_fires': result.fire_count,
+        # Summed over every update of the day's fires
         'total_resources': {
-            'man': total_man,
-            'terrain': total_terrain,
-            'aerial': total_aerial
+            'man': result.total_man or 0,
+            'terrain': result.total_terrain or 0,
+            'aerial': result.total_aerial or 0
+        },
+        # Summed over the day's fires, of each fire's highest count
+        'peak_resources': {
+            'man': result.peak_man or 0,
+            'terrain': result.peak_terrain or 0,
+            'aerial': result.peak_aerial or 0
         },
         'largest_fire_duration_hours': f"{round(divmod(largest_duration,1)[0])}h{round(divmod(largest_duration,1)[1] * 60)}m",
-        'fire_with_longest_duration': fire_with_longest_duration,
+        'fire_with_longest_duration': result.longest_fire_id,
         'districts': districts
     })
 
 @app.route('/api/fires/available-date-range', methods=['GET'])
+@cached_response
 def get_available_date_range():
     session = getDBSession()
     
@@ -355,6 +594,359 @@ def get_available_date_range():
         })
     else:
         return jsonify({'message': 'No data available for date range.'})
-    
+
+import fire_history
+
+# Fire history: each fire_updates row stores the fields that changed (see fire_history.py), so a
+# fire's timeline is read from the deltas and its full state at any moment is rebuilt from the
+# nearest keyframe.
+
+@app.route('/api/fires/<fire_id>/changes', methods=['GET'])
+@cached_response
+def get_fire_changes(fire_id):
+    # Every field change of the fire, or only those of `field` (e.g. ?field=aerial)
+    dbapi_connection = engine.raw_connection()
+    try:
+        changes = fire_history.get_field_changes(dbapi_connection.cursor(), fire_id, request.args.get('field'))
+    finally:
+        dbapi_connection.close()
+    return jsonify(changes)
+
+@app.route('/api/fires/<fire_id>/state', methods=['GET'])
+@cached_response
+def get_fire_state(fire_id):
+    # The fire as of a commit (?commit=<hash>) or a moment (?ts=<ms>), or its latest state
+    commit_hash = request.args.get('commit')
+    ts = request.args.get('ts')
+    dbapi_connection = engine.raw_connection()
+    try:
+        cursor = dbapi_connection.cursor()
+        if commit_hash:
+            cursor.execute("SELECT commit_timestamp FROM fire_updates WHERE commit_hash = ? LIMIT 1", (commit_hash,))
+            row = cursor.fetchone()
+            if row is None:
+                return jsonify({'message': 'Unknown commit: no fire changed in it, use ts instead.'}), 404
+            timestamp = row[0]
+        else:
+            timestamp = int(ts) / 1000 if ts else None
+        if timestamp is not None:
+            cursor.execute("SELECT MAX(update_id) FROM fire_updates WHERE fire_id = ? AND commit_timestamp <= ?",
+                           (fire_id, timestamp))
+            update_id = cursor.fetchone()[0]
+            reconstructed = fire_history.reconstruct_fire_state(cursor, fire_id, update_id) if update_id else None
+        else:
+            reconstructed = fire_history.reconstruct_fire_state(cursor, fire_id)
+        if reconstructed is None:
+            return jsonify({'message': 'No state of this fire at that time.'}), 404
+        update_id, data, _ = reconstructed
+        cursor.execute("SELECT commit_hash, commit_timestamp, change_type FROM fire_updates WHERE update_id = ?", (update_id,))
+        update_commit_hash, commit_timestamp, change_type = cursor.fetchone()
+    finally:
+        dbapi_connection.close()
+    return jsonify({
+        'fire_id': fire_id,
+        'update_id': update_id,
+        'commit_hash': update_commit_hash,
+        'commit_timestamp': commit_timestamp,
+        'change_type': change_type,
+        'data': data,
+    })
+
+import fire_stream
+
+# Server-Sent Events of the fire_updates rows, from one shared tail per process (see fire_stream.py).
+# Each client holds a request thread for as long as it is connected: serve with threaded workers.
+STREAM_POLL_INTERVAL = float(os.environ.get('FIRES_STREAM_POLL_INTERVAL', 1.0))
+STREAM_MAX_CLIENTS = int(os.environ.get('FIRES_STREAM_MAX_CLIENTS', 100))
+STREAM_HEARTBEAT_INTERVAL = 15.0
+
+fire_update_stream = fire_stream.FireUpdateStream(engine.raw_connection, poll_interval=STREAM_POLL_INTERVAL)
+
+def get_list_arg(name):
+    # ?district=Faro&district=Beja or ?district=Faro,Beja
+    return {value.strip() for values in request.args.getlist(name) for value in values.split(',') if value.strip()}
+
+@app.route('/api/fires/stream', methods=['GET'])
+def stream_fire_updates():
+    # EventSource sends the id of the last event it got when it reconnects; `last_event_id` allows the same on the first connection
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        return jsonify({'message': 'Last-Event-ID must be an update_id.'}), 400
+    if fire_update_stream.clients >= STREAM_MAX_CLIENTS:
+        return jsonify({'message': 'Too many stream clients, try again later.'}), 503
+    events = fire_update_stream.subscribe(last_event_id, get_list_arg('district'), get_list_arg('natureza'),
+                                          heartbeat_interval=STREAM_HEARTBEAT_INTERVAL)
+    response = Response(events, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Proxies must not buffer the stream
+    return response
+
+@app.route('/health/fire-stream')
+def get_fire_stream_stats():
+    return jsonify(fire_update_stream.stats())
+
+import fire_geo
+
+# Map queries: the fires in a viewport or around a point are found through the fires_geo R*Tree
+# (see fire_geo.py). The R*Tree is rounded outwards to 32-bit floats, so the exact position test is
+# still made on the fires table, for the few rows the R*Tree returns.
+GEO_DEFAULT_LIMIT = 500
+GEO_MAX_LIMIT = 5000
+NEAR_MAX_RADIUS_KM = 500
+MAX_ZOOM = 22
+
+def get_query_in_box(query, west, south, east, north):
+    return query.join(FireGeo, FireGeo.fire_id == Fire.fire_id).filter(
+        FireGeo.max_lat >= south, FireGeo.min_lat <= north, FireGeo.max_lng >= west, FireGeo.min_lng <= east,
+        Fire.lat.between(south, north), Fire.lng.between(west, east),
+    )
+
+def get_geo_query(query, west, south, east, north):
+    # Optional filters shared by the map endpoints: fromDate/toDate and ?active=1
+    query = get_query_with_date_filters(get_query_in_box(query, west, south, east, north))
+    if request.args.get('active') in ('1', 'true'):
+        query = query.filter(Fire.is_currently_active == 1)
+    return query
+
+def get_geo_limit():
+    return max(1, min(request.args.get('limit', GEO_DEFAULT_LIMIT, type=int), GEO_MAX_LIMIT))
+
+def load_fires(session, fire_ids):
+    # Full rows of the given fires, by id, in chunks under SQLite's bound parameter limit
+    fires = {}
+    for chunk in chunked(fire_ids):
+        for fire in session.query(Fire).filter(Fire.fire_id.in_(chunk)):
+            fires[fire.fire_id] = fire
+    return fires
+
+# Fires in a viewport, ?bbox=west,south,east,north in degrees. Without `zoom`, up to `limit` fires.
+# With `zoom` (the map's zoom level), every fire in the viewport is grouped into clusters of about
+# 60 pixels at that zoom: a cell with one fire returns the fire, the others its count, centre and
+# bounds, so the response stays small whatever the number of fires.
+@app.route('/api/fires/bbox', methods=['GET'])
+@cached_response
+def get_fires_in_bbox():
+    try:
+        west, south, east, north = (float(value) for value in request.args['bbox'].split(','))
+    except (KeyError, ValueError):
+        return jsonify({'message': 'bbox=west,south,east,north is required.'}), 400
+    if not (-180 <= west <= east <= 180 and -90 <= south <= north <= 90):
+        return jsonify({'message': 'bbox must be west,south,east,north with west <= east and south <= north.'}), 400
+    zoom = request.args.get('zoom', type=int)
+    session = getDBSession()
+    if zoom is None:
+        limit = get_geo_limit()
+        fires = get_geo_query(session.query(Fire), west, south, east, north).order_by(Fire.fire_id).limit(limit + 1).all()
+        return jsonify({
+            'fires': [fire.to_dict() for fire in fires[:limit]],
+            'truncated': len(fires) > limit,
+        })
+
+    points = get_geo_query(session.query(Fire.fire_id, Fire.lat, Fire.lng), west, south, east, north).all()
+    fire_ids = [point[0] for point in points]
+    clusters = fire_geo.cluster_points([point[1] for point in points], [point[2] for point in points],
+                                       max(0, min(zoom, MAX_ZOOM)))
+    single_fires = load_fires(session, [fire_ids[indices[0]] for indices, _, _, _ in clusters if len(indices) == 1])
+    return jsonify({
+        'zoom': zoom,
+        'count': len(points),
+        'fires': [single_fires[fire_ids[indices[0]]].to_dict() for indices, _, _, _ in clusters if len(indices) == 1],
+        'clusters': [{'lat': lat, 'lng': lng, 'count': len(indices), 'bounds': bounds}
+                     for indices, lat, lng, bounds in clusters if len(indices) > 1],
+    })
+
+# Fires within `radius_km` (default 10) of ?lat=&lng=, nearest first, with their distance
+@app.route('/api/fires/near', methods=['GET'])
+@cached_response
+def get_fires_near():
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    radius_km = request.args.get('radius_km', 10.0, type=float)
+    if lat is None or lng is None or not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return jsonify({'message': 'lat and lng are required.'}), 400
+    if not 0 < radius_km <= NEAR_MAX_RADIUS_KM:
+        return jsonify({'message': f'radius_km must be between 0 and {NEAR_MAX_RADIUS_KM}.'}), 400
+    session = getDBSession()
+    fires = get_geo_query(session.query(Fire), *fire_geo.bounding_box(lat, lng, radius_km)).all()
+    distances = fire_geo.distances_km(lat, lng, [fire.lat for fire in fires], [fire.lng for fire in fires])
+    nearest = sorted((distance, fire.fire_id, fire) for distance, fire in zip(distances.tolist(), fires) if distance <= radius_km)
+    return jsonify({
+        'fires': [dict(fire.to_dict(), distance_km=round(distance, 3)) for distance, _, fire in nearest[:get_geo_limit()]],
+        'count': len(nearest),
+    })
+
+import fire_tiles
+
+# Map tiles of the fires (see fire_tiles.py), the unfiltered ones cached on disk in FIRES_TILE_CACHE_DIR
+# (default: tile_cache next to the database), built by FIRES_TILE_WORKERS threads per server process.
+TILE_CACHE_DIR = os.environ.get('FIRES_TILE_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(DB_PATH)), 'tile_cache'))
+TILE_WORKERS = int(os.environ.get('FIRES_TILE_WORKERS', 4))
+TILE_CACHE_MAX_ZOOM = int(os.environ.get('FIRES_TILE_CACHE_MAX_ZOOM', 12))
+MAX_TILE_ZOOM = 20
+
+tile_cache = fire_tiles.TileCache(engine.raw_connection, TILE_CACHE_DIR, workers=TILE_WORKERS,
+                                  max_cached_zoom=TILE_CACHE_MAX_ZOOM)
+
+# /api/tiles/6/30/24 (or 6/30/24.mvt, .pbf) is a Mapbox Vector Tile, 6/30/24.geojson gzipped GeoJSON.
+# Filtered by fromDate/toDate and natureza (repeated or comma-separated).
+@app.route('/api/tiles/<int:z>/<int:x>/<int:y>.<tile_format>')
+def get_fire_tile(z, x, y, tile_format):
+    if tile_format not in fire_tiles.TILE_FORMATS:
+        return jsonify({'message': f"Unknown tile format, use one of {', '.join(fire_tiles.TILE_FORMATS)}."}), 404
+    if z > MAX_TILE_ZOOM or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+        return jsonify({'message': 'No such tile.'}), 404
+    from_date, to_date = get_date_filters()
+    filters = (from_date, to_date, get_list_arg('natureza'))
+    fingerprint, tile = tile_cache.get(z, x, y, 'geojson' if tile_format == 'geojson' else 'mvt', filters)
+    if request.if_none_match.contains(fingerprint):
+        response = Response(status=304)
+    else:
+        response = Response(tile, mimetype=fire_tiles.TILE_FORMATS[tile_format])
+        if tile_format == 'geojson':
+            if 'gzip' in request.accept_encodings:
+                response.headers['Content-Encoding'] = 'gzip'
+            else:
+                response.set_data(gzip.decompress(tile))
+    response.set_etag(fingerprint)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Vary'] = 'Accept-Encoding'
+    return response
+
+# A view of its own rather than defaults={'tile_format': 'mvt'}, with which Werkzeug would answer
+# 6/30/24.mvt with a redirect to this url
+@app.route('/api/tiles/<int:z>/<int:x>/<int:y>')
+def get_fire_tile_default_format(z, x, y):
+    return get_fire_tile(z, x, y, 'mvt')
+
+@app.route('/health/tile-cache')
+def get_tile_cache_stats():
+    return jsonify(tile_cache.stats())
+
+import fire_intervals
+
+# Time travel: the activity intervals of the fires (see fire_intervals.py) give the fires active
+# at any moment, and the number of active fires and deployed resources over time, without
+# replaying fire_updates.
+
+# The fires active at ?ts=<ms>, with the status and resources logged for them at that moment
+@app.route('/api/fires/at', methods=['GET'])
+@cached_response
+def get_fires_active_at():
+    ts = request.args.get('ts', type=int)
+    if ts is None:
+        return jsonify({'message': 'ts (in milliseconds) is required.'}), 400
+    dbapi_connection = engine.raw_connection()
+    try:
+        intervals = fire_intervals.get_active_intervals(dbapi_connection.cursor(), ts / 1000)
+    finally:
+        dbapi_connection.close()
+    fires = load_fires(getDBSession(), [interval['fire_id'] for interval in intervals])
+    return jsonify({
+        'timestamp': ts // 1000,
+        'count': len(intervals),
+        'fires': [dict(fires[interval['fire_id']].to_dict() if interval['fire_id'] in fires else {},
+                       active_since=interval['start_ts'], update_id=interval['update_id'],
+                       **{name: interval[name] for name in ('status', 'status_code') + fire_intervals.RESOURCES})
+                  for interval in intervals],
+    })
+
+# Active fires and their summed resources between fromDate and toDate (default: the whole history),
+# one point per moment they changed
+@app.route('/api/fires/active-series', methods=['GET'])
+@cached_response
+def get_active_fires_series():
+    from_date, to_date = get_date_filters()
+    dbapi_connection = engine.raw_connection()
+    try:
+        cursor = dbapi_connection.cursor()
+        if from_date is None:
+            cursor.execute("SELECT commit_timestamp FROM fire_updates ORDER BY update_id LIMIT 1")
+            row = cursor.fetchone()
+            from_date = row[0] if row else 0
+        if to_date is None:
+            cursor.execute("SELECT commit_timestamp FROM fire_updates ORDER BY update_id DESC LIMIT 1")
+            row = cursor.fetchone()
+            to_date = row[0] if row else 0
+        if from_date > to_date:
+            return jsonify({'message': 'fromDate must be before toDate.'}), 400
+        series = fire_intervals.get_active_series(cursor, from_date, to_date)
+    finally:
+        dbapi_connection.close()
+    peak = max(series, key=lambda point: point['active_fires'])
+    return jsonify({'from': int(from_date), 'to': int(to_date), 'series': series, 'peak': peak})
+
+import resource_series
+
+# Resources deployed over time (see resource_series.py): the min, max and average of the active
+# fires and of each resource per bucket of ?resolution= (5min, hour or day). With ?points=N the
+# buckets are downsampled for charts with LTTB on the average of ?resource= (default man).
+
+def get_resolution_arg(default='hour'):
+    resolution = request.args.get('resolution', default)
+    return resolution, resource_series.RESOLUTIONS.get(resolution)
+
+def series_response(timestamps, series):
+    points = request.args.get('points', type=int)
+    resource = request.args.get('resource', 'man')
+    if resource not in resource_series.SERIES:
+        return jsonify({'message': f"resource must be one of {', '.join(resource_series.SERIES)}."}), 400
+    selected = slice(None)
+    if points:
+        selected = resource_series.largest_triangle_three_buckets(timestamps, series[resource]['avg'], points)
+    return jsonify({
+        'timestamps': np.asarray(timestamps)[selected].tolist(),
+        'series': {name: {stat: np.round(np.asarray(values)[selected], 3).tolist() for stat, values in stats.items()}
+                   for name, stats in series.items()},
+    })
+
+# Whole country, or one ?district=
+@app.route('/api/resources/series', methods=['GET'])
+@cached_response
+def get_resource_series():
+    resolution_name, resolution = get_resolution_arg()
+    if resolution is None:
+        return jsonify({'message': f"resolution must be one of {', '.join(resource_series.RESOLUTIONS)}."}), 400
+    from_date, to_date = get_date_filters()
+    dbapi_connection = engine.raw_connection()
+    try:
+        timestamps, series = resource_series.read_rollup(dbapi_connection.cursor(), resolution,
+                                                         request.args.get('district', resource_series.NATIONAL),
+                                                         from_date, to_date)
+    finally:
+        dbapi_connection.close()
+    return series_response(timestamps, series)
+
+# One fire's resources: every change (timestamp and counts from then on), or buckets with ?resolution=
+@app.route('/api/fires/<fire_id>/resources', methods=['GET'])
+@cached_response
+def get_fire_resources(fire_id):
+    resolution_name, resolution = get_resolution_arg(None)
+    if resolution_name is not None and resolution is None:
+        return jsonify({'message': f"resolution must be one of {', '.join(resource_series.RESOLUTIONS)}."}), 400
+    dbapi_connection = engine.raw_connection()
+    try:
+        cursor = dbapi_connection.cursor()
+        times, totals = resource_series.fire_resource_steps(cursor, fire_id)
+        horizon = resource_series.get_resource_rollup_horizon(cursor)
+    finally:
+        dbapi_connection.close()
+    if not len(times):
+        return jsonify({'message': 'No updates of this fire.'}), 404
+    if resolution is None:
+        return jsonify([dict(zip(('timestamp',) + resource_series.SERIES, [int(timestamp)] + counts))
+                        for timestamp, counts in zip(times.tolist(), totals.tolist())])
+    # Still active: its resources hold until the end of the data
+    end = max(horizon or times[-1], times[-1]) if totals[-1][0] else times[-1]
+    first_bucket = times[0] // resolution * resolution
+    bucket_starts = np.arange(first_bucket, max(end, first_bucket + 1), resolution, dtype=np.float64)
+    times, totals = np.insert(times, 0, first_bucket), np.vstack([np.zeros((1, totals.shape[1]), dtype=np.int64), totals])
+    minimum, maximum, avg = resource_series.bucket_stats(times, totals, bucket_starts, resolution, max(end, first_bucket + 1))
+    return series_response(bucket_starts.astype(np.int64), {
+        name: {'min': minimum[:, column], 'max': maximum[:, column], 'avg': avg[:, column]}
+        for column, name in enumerate(resource_series.SERIES)
+    })
+
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,35 @@
+from collections import OrderedDict
+
+# --- Parsed Snapshot Cache ---
+# Scrape commits frequently carry a byte-identical fogos.json (nothing changed, or a revert to an
+# earlier state). Since git gives us the blob object id of each snapshot, parsed fire maps can be
+# keyed by it and reused instead of decoding the same JSON again.
+
+class SnapshotCache:
+    """
+    Small LRU cache of parsed fire maps keyed by blob object id.
+    The cached maps are shared: callers must not mutate them or the fire dicts they contain.
+    """
+
+    def __init__(self, parse, max_entries=32):
+        self.parse = parse
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, blob_oid, content):
+        """Returns the parsed fire map for a blob, parsing `content` only on a cache miss."""
+        if blob_oid is None:
+            return self.parse(content)
+        fires_map = self.entries.get(blob_oid)
+        if fires_map is not None:
+            self.hits += 1
+            self.entries.move_to_end(blob_oid)
+            return fires_map
+        self.misses += 1
+        fires_map = self.parse(content)
+        self.entries[blob_oid] = fires_map
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return fires_map
@@ -0,0 +1,161 @@
+import argparse
+import json
+import os
+import time
+import tracemalloc
+import typing
+
+# --- Snapshot Parsers ---
+# Every fogos.json snapshot (~90 KB, pretty-printed) used to be decoded in full with json.loads
+# into nested dicts. The parsers here all return the same {fire id: fire dict} map as the reference
+# 'json' backend, bd_manager.parse_fire_data, with faster optional backends:
+#  - 'orjson': the same full decode, with orjson.
+#  - 'msgspec': decodes the envelope into a typed struct with each fire left as raw bytes. A fire
+#    whose bytes are identical to the previous snapshot reuses the dict decoded then, so only the
+#    fires that changed are decoded (and allocated), and unchanged fires share one dict.
+# The backend is chosen with FIRES_JSON_PARSER (or --json-parser in the ingest scripts); 'auto'
+# takes the fastest one installed. Fire dicts may be shared between snapshots: like the parsed
+# snapshot cache, callers must not mutate them.
+# Benchmark: python snapshot_parsers.py [repo_path] [json_file] [--commits 2000]
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+def parse_with_orjson(json_content):
+    if not json_content:
+        return {}
+    try:
+        data = orjson.loads(json_content)
+        if data.get("success") and isinstance(data.get("data"), list):
+            return {item['id']: item for item in data['data'] if isinstance(item, dict) and 'id' in item}
+        return {}
+    except (orjson.JSONDecodeError, TypeError, AttributeError):
+        return {}
+
+if msgspec is not None:
+    class _Snapshot(msgspec.Struct):
+        success: bool = False
+        data: typing.Union[typing.List[msgspec.Raw], None] = None
+
+class MsgspecSnapshotParser:
+    """
+    Parses snapshots with msgspec, decoding to dicts only the fires whose JSON changed since the
+    previously parsed snapshot. One instance per sequence of snapshots (e.g. per SnapshotCache).
+    """
+
+    def __init__(self):
+        self.snapshot_decoder = msgspec.json.Decoder(_Snapshot)
+        self.fire_decoder = msgspec.json.Decoder()
+        self.previous_fires = {} # Raw JSON bytes of each fire of the previous snapshot -> its dict
+        self.decoded_fires = 0
+        self.reused_fires = 0
+
+    def __call__(self, json_content):
+        if not json_content:
+            return {}
+        try:
+            snapshot = self.snapshot_decoder.decode(json_content)
+        except (msgspec.DecodeError, TypeError):
+            return {}
+        if not snapshot.success or snapshot.data is None:
+            return {}
+        fires_map = {}
+        fires_by_json = {}
+        for raw_fire in snapshot.data:
+            fire_json = bytes(raw_fire)
+            fire = self.previous_fires.get(fire_json)
+            if fire is None:
+                fire = self.fire_decoder.decode(fire_json)
+                if not isinstance(fire, dict) or 'id' not in fire:
+                    continue
+                self.decoded_fires += 1
+            else:
+                self.reused_fires += 1
+            fires_map[fire['id']] = fire
+            fires_by_json[fire_json] = fire
+        self.previous_fires = fires_by_json
+        return fires_map
+
+SNAPSHOT_PARSERS = ('json', 'orjson', 'msgspec')
+
+def available_snapshot_parsers():
+    return [name for name, module in (('json', json), ('orjson', orjson), ('msgspec', msgspec)) if module is not None]
+
+def make_snapshot_parser(name=None):
+    """
+    Returns a parse(json_content) -> {fire id: fire dict} function for backend `name` (default:
+    FIRES_JSON_PARSER, else 'auto'). Raises ValueError for a backend that isn't installed.
+    """
+    name = name or os.environ.get('FIRES_JSON_PARSER', 'auto')
+    if name == 'auto':
+        name = available_snapshot_parsers()[-1]
+    if name not in available_snapshot_parsers():
+        raise ValueError(f"JSON parser '{name}' is not available (installed: {', '.join(available_snapshot_parsers())})")
+    if name == 'msgspec':
+        return MsgspecSnapshotParser()
+    if name == 'orjson':
+        return parse_with_orjson
+    # Imported here: bd_manager imports this module
+    from bd_manager import parse_fire_data
+    return parse_fire_data
+
+# --- Benchmark ---
+
+def benchmark(repo_path, json_file_path_in_repo, commit_limit=None):
+    """
+    Parses the snapshots of the repository history with every available backend and compares them
+    with the reference parser, bd_manager.parse_fire_data.
+    """
+    import git
+    from git_blobs import list_commits, iter_file_blobs
+    from bd_manager import parse_fire_data
+    repo = git.Repo(repo_path)
+    commits = list_commits(repo)
+    if commit_limit:
+        commits = commits[-commit_limit:]
+    # Distinct snapshots in history order: the ingest never parses the same blob twice in a row
+    blobs = []
+    previous_blob_oid = None
+    for _, _, blob_oid, content in iter_file_blobs(repo, commits, json_file_path_in_repo):
+        if blob_oid is not None and blob_oid != previous_blob_oid:
+            blobs.append(content)
+        previous_blob_oid = blob_oid
+    total_bytes = sum(len(blob) for blob in blobs)
+    print(f"{len(blobs)} snapshots from {len(commits)} commits, {total_bytes / 1e6:.1f} MB of JSON.\n")
+
+    reference = [parse_fire_data(blob) for blob in blobs]
+    print(f"{'parser':<10}{'total s':>10}{'ms/snapshot':>14}{'MB/s':>10}{'kept MB':>10}")
+    for name in available_snapshot_parsers():
+        parse = make_snapshot_parser(name)
+        start = time.perf_counter()
+        results = [parse(blob) for blob in blobs]
+        seconds = time.perf_counter() - start
+
+        # Memory held by the parsed maps of every snapshot (a second pass, as tracemalloc slows it down)
+        parse = make_snapshot_parser(name)
+        tracemalloc.start()
+        kept_results = [parse(blob) for blob in blobs]
+        kept_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del kept_results
+
+        if results != reference:
+            raise AssertionError(f"JSON parser '{name}' does not return the same fires as bd_manager.parse_fire_data")
+        print(f"{name:<10}{seconds:>10.2f}{seconds * 1000 / max(len(blobs), 1):>14.2f}"
+              f"{total_bytes / 1e6 / max(seconds, 1e-9):>10.1f}{kept_bytes / 1e6:>10.1f}")
+    print("\nEvery parser returned the same fires.")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks the fogos.json snapshot parsers on a repository history.")
+    parser.add_argument("repo_path", nargs="?", default="../", help="Path of the git repository (default: ../)")
+    parser.add_argument("json_file", nargs="?", default="fogos.json", help="Path of the JSON file inside the repository (default: fogos.json)")
+    parser.add_argument("--commits", type=int, help="Only the most recent N commits")
+    args = parser.parse_args()
+    benchmark(args.repo_path, args.json_file, args.commits)
@@ -0,0 +1,106 @@
+import json
+import os
+import sqlite3
+import subprocess
+import tempfile
+import time
+import unittest
+import bd_creator
+import bd_manager
+import ingest_daemon
+
+# --- Regression: Non-Monotonic Commit Timestamps ---
+# A commit dated before its parent ends the previous interval of its fires before it starts. The
+# ingest must store it as an empty interval (the R*Tree rejects min_ts > max_ts), and the full,
+# parallel and incremental builds must agree. The same goes for a live snapshot dated before the
+# commits that follow it, while one dated in the future is rejected.
+# Usage: python -m unittest test_fire_intervals
+
+COMMIT_TIMESTAMPS = [1717200000, 1717199000, 1717203000] # The second commit is dated before the first
+
+def fire_snapshot(man):
+    return json.dumps({'success': True, 'data': [{
+        'id': '1', 'lat': 40.1, 'lng': -8.2, 'location': 'Local', 'district': 'Porto', 'concelho': 'Porto',
+        'freguesia': 'Sé', 'natureza': 'Mato', 'man': man, 'terrain': 2, 'aerial': 0, 'meios_aquaticos': 0,
+        'status': 'Em Curso', 'statusCode': 5, 'active': True,
+        'dateTime': {'sec': COMMIT_TIMESTAMPS[0]}, 'updated': {'sec': COMMIT_TIMESTAMPS[0] + man},
+    }]})
+
+def git(repo_path, *args, timestamp=None):
+    env = dict(os.environ, GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@example.com',
+               GIT_COMMITTER_NAME='test', GIT_COMMITTER_EMAIL='test@example.com')
+    if timestamp is not None:
+        env['GIT_AUTHOR_DATE'] = env['GIT_COMMITTER_DATE'] = f'@{timestamp} +0000'
+    return subprocess.run(['git', '-C', repo_path, *args], check=True, env=env, capture_output=True, text=True).stdout
+
+def read_derived_tables(db_path):
+    with sqlite3.connect(db_path) as conn:
+        return (conn.execute("SELECT update_id, min_ts, max_ts, start_ts, end_ts, man FROM fire_intervals ORDER BY update_id").fetchall(),
+                conn.execute("SELECT * FROM resource_rollup ORDER BY resolution, district, bucket").fetchall())
+
+class NonMonotonicHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.repo_path = os.path.join(self.directory.name, 'repo')
+        os.makedirs(self.repo_path)
+        git(self.repo_path, 'init', '-q')
+        for n, timestamp in enumerate(COMMIT_TIMESTAMPS):
+            with open(os.path.join(self.repo_path, 'fogos.json'), 'w') as snapshot_file:
+                snapshot_file.write(fire_snapshot(10 * (n + 1)))
+            git(self.repo_path, 'add', 'fogos.json')
+            git(self.repo_path, 'commit', '-q', '-m', f'c{n}', timestamp=timestamp)
+        self.commits = git(self.repo_path, 'rev-list', '--reverse', 'HEAD').split()
+        self.working_dir = os.getcwd()
+
+    def tearDown(self):
+        os.chdir(self.working_dir)
+        self.directory.cleanup()
+
+    def build_full(self, workers):
+        # bd_creator writes fires.sqlite in the working directory
+        build_dir = os.path.join(self.directory.name, f'full{workers}')
+        os.makedirs(build_dir)
+        os.chdir(build_dir)
+        bd_creator.process_repository(self.repo_path, 'fogos.json', workers=workers)
+        os.chdir(self.working_dir)
+        return os.path.join(build_dir, 'fires.sqlite')
+
+    def build_incremental(self):
+        db_path = os.path.join(self.directory.name, 'incremental.sqlite')
+        for commit in self.commits:
+            git(self.repo_path, 'checkout', '-q', commit)
+            bd_manager.process_repository_incrementally(self.repo_path, 'fogos.json', db_path=db_path)
+        return db_path
+
+    def test_builds_agree(self):
+        intervals, rollup = read_derived_tables(self.build_full(1))
+        # The first commit's interval is ended by the earlier second commit: empty
+        self.assertEqual([(start_ts, end_ts) for _, _, _, start_ts, end_ts, _ in intervals],
+                         [(COMMIT_TIMESTAMPS[0], COMMIT_TIMESTAMPS[0]), (COMMIT_TIMESTAMPS[1], COMMIT_TIMESTAMPS[2]),
+                          (COMMIT_TIMESTAMPS[2], None)])
+        self.assertTrue(all(min_ts <= max_ts for _, min_ts, max_ts, _, _, _ in intervals))
+        self.assertEqual(read_derived_tables(self.build_full(2)), (intervals, rollup))
+        self.assertEqual(read_derived_tables(self.build_incremental()), (intervals, rollup))
+
+    def test_live_snapshot_dated_before_next_commit(self):
+        db_path = os.path.join(self.directory.name, 'live.sqlite')
+        git(self.repo_path, 'checkout', '-q', self.commits[0])
+        bd_manager.process_repository_incrementally(self.repo_path, 'fogos.json', db_path=db_path)
+        ingest = ingest_daemon.LiveIngest(db_path)
+        try:
+            with self.assertRaises(ValueError):
+                ingest.apply_live_snapshot(fire_snapshot(99).encode('utf-8'), int(time.time()) + 3600)
+            ingest.apply_live_snapshot(fire_snapshot(99).encode('utf-8'), COMMIT_TIMESTAMPS[0] - 5000)
+        finally:
+            ingest.close()
+        for commit in self.commits[1:]:
+            git(self.repo_path, 'checkout', '-q', commit)
+            bd_manager.process_repository_incrementally(self.repo_path, 'fogos.json', db_path=db_path)
+        intervals, _ = read_derived_tables(db_path)
+        self.assertEqual(len(intervals), 4)
+        self.assertTrue(all(min_ts <= max_ts and (end_ts is None or start_ts <= end_ts)
+                            for _, min_ts, max_ts, start_ts, end_ts, _ in intervals))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,2 +1,3 @@
-from server import create_app
-app = create_app()
+# WSGI entry point for production servers: gunicorn -c gunicorn.conf.py wsgi:app
+# (the routes are registered on the app created by server.py)
+from server import app
@@ -14,7 +14,11 @@ export type Fire = {
   last_updated_data_timestamp: number | null
   is_currently_active: number | null
 }
-export type FiresResponse = Fire[]
+// Pages are ordered by fire_id: pass next_cursor as `cursor` to get the next one (null on the last page)
+export type FiresResponse = {
+  fires: Fire[]
+  next_cursor: string | null
+}
 
 // Types for /fires/months (GET)
 export type FiresPerMonth = {